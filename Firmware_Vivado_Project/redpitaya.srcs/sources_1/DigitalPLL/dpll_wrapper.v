@@ -24,6 +24,7 @@ module dpll_wrapper(
     output wire [16-1:0]      LoggerData,
     output wire               LoggerData_clk_enable,
     input  wire               LoggerIsWriting,
+    input  wire [32-1:0]      LoggerSamplesWritten,
 
     // System bus
     input  wire [ 32-1:0]     sys_addr   ,  // bus address
@@ -1626,7 +1627,8 @@ assign status_flags[8]  = 1'b0; // LED_G[2]
 assign status_flags[9]  = 1'b0; // LED_R[2]
 assign status_flags[10] = 1'b0; // residuals_ceo_fifo_has_too_little_samples;
 assign status_flags[11] = 1'b0; // residuals_optical_fifo_has_too_little_samples;
-assign status_flags[31:12] = 20'b0;
+assign status_flags[12] = LoggerIsWriting;
+assign status_flags[31:13] = 19'b0;
 
 
 // this module implements all of the register/status readout to the Zynq
@@ -1650,6 +1652,11 @@ registers_read registers_read_inst
     .DAC1_out({  {16{DACout1[15]}} , DACout1}),
     .DAC2_out({  {16{DACout2[15]}} , DACout2}),
 
+    // deep captures through the fifo
+    .logger_data(LoggerData),
+    .logger_data_clk_enable(LoggerData_clk_enable),
+    .logger_samples_written(LoggerSamplesWritten),
+
 
     // internal configuration bus
     .sys_addr        (  { 2'b0, sys_addr[32-1:2]}      ),  // address, note the divide by 4 again to map between zynq addresses and the legacy DPLL addresses
@@ -27,6 +27,12 @@ port (
     DAC1_out                               : in  std_logic_vector(32-1 downto 0);
     DAC2_out                               : in  std_logic_vector(32-1 downto 0);
 
+    -- data stream selected by the logger multiplexer, which can be sent to the fifo for deep captures
+    logger_data                            : in  std_logic_vector(16-1 downto 0) := (others => '0');
+    logger_data_clk_enable                 : in  std_logic := '0';
+    -- number of samples written by the logger since its last trigger, polled by monitor-tcp to know when a capture is complete
+    logger_samples_written                 : in  std_logic_vector(32-1 downto 0) := (others => '0');
+
 
     -- internal configuration bus
     sys_addr                               : in  std_logic_vector(32-1 downto 0);   -- bus address
@@ -59,6 +65,18 @@ architecture Behavioral of registers_read is
     signal data_counter_for_throughput_test : std_logic_vector(32-1 downto 0) := (others => '0');
     signal bWritesEnabled : std_logic := '0';
 
+    -- deep capture: the fifo is filled with the logger data instead of the throughput test counter.
+    -- one out of deep_capture_decimation valid samples is kept, and two samples are packed in each 32-bits word (first sample in the lsbs)
+    signal fifo_source_is_logger       : std_logic := '0';
+    signal deep_capture_decimation     : std_logic_vector(16-1 downto 0) := std_logic_vector(to_unsigned(1, 16));
+    signal decimation_counter          : unsigned(16-1 downto 0) := (others => '0');
+    signal packed_sample_lsbs          : std_logic_vector(16-1 downto 0) := (others => '0');
+    signal bHavePackedSampleLsbs       : std_logic := '0';
+    signal logger_data_packed          : std_logic_vector(32-1 downto 0) := (others => '0');
+    signal fifo_din                    : std_logic_vector(32-1 downto 0) := (others => '0');
+    signal fifo_full                   : std_logic := '0';
+    signal fifo_overflow               : std_logic := '0';   -- sticky, cleared by the fifo reset
+
     -- coregen fifo
     component fifo_generator_0 
     PORT (
@@ -97,7 +115,7 @@ begin
         clk        => clk,
         -- write port
         srst       => fifo_srst,
-        din        => data_counter_for_throughput_test,
+        din        => fifo_din,
         wr_en      => fifo_wr_en,
         
         -- read port
@@ -105,12 +123,14 @@ begin
         dout       => fifo_dout,
         
         -- status signals
-        full       => open,
+        full       => fifo_full,
         empty      => open,    -- we don't use this, instead we only use the prog_empty signal and read 10 samples at a time to minimize the overhead of checking fifo status
         data_count => fifo_data_count,
         prog_empty => fifo_prog_empty
     );
 
+    fifo_din <= logger_data_packed when fifo_source_is_logger = '1' else data_counter_for_throughput_test;
+
     -- process which controls the fifo (also fills the fifo with test data for the throughput test)
     process (clk)
     begin
@@ -119,6 +139,26 @@ begin
             if fifo_srst = '1' then
                 fifo_wr_en <= '0';
                 data_counter_for_throughput_test <= (others => '0');
+                decimation_counter <= (others => '0');
+                bHavePackedSampleLsbs <= '0';
+            elsif fifo_source_is_logger = '1' then
+                -- deep capture: decimated logger data, two samples per fifo word
+                fifo_wr_en <= '0';
+                if bWritesEnabled = '1' and logger_data_clk_enable = '1' then
+                    if resize(decimation_counter, 17) + 1 >= unsigned(deep_capture_decimation) then
+                        decimation_counter <= (others => '0');
+                        if bHavePackedSampleLsbs = '0' then
+                            packed_sample_lsbs    <= logger_data;
+                            bHavePackedSampleLsbs <= '1';
+                        else
+                            logger_data_packed    <= logger_data & packed_sample_lsbs;
+                            bHavePackedSampleLsbs <= '0';
+                            fifo_wr_en            <= '1';
+                        end if;
+                    else
+                        decimation_counter <= decimation_counter + 1;
+                    end if;
+                end if;
             else
                 -- 100 MHz/50 = 2 MHz data rate
                 -- 100 MHz/25 = 4 MHz data rate
@@ -139,13 +179,17 @@ begin
 
 
 
-            -- running max of the data count:
+            -- running max of the data count, and overflow detection:
             if fifo_srst = '1' then
                 fifo_data_count_max <= (others => '0');
+                fifo_overflow       <= '0';
             else
                 if unsigned(fifo_data_count) > unsigned(fifo_data_count_max) then
                     fifo_data_count_max <= fifo_data_count;
                 end if;
+                if fifo_wr_en = '1' and fifo_full = '1' then
+                    fifo_overflow <= '1';
+                end if;
             end if;
 
             -- delay line from sys_ren (at the right address) to sys_ack which matches the read latency
@@ -174,7 +218,10 @@ begin
             if sys_wen = '1' then
                 case sys_addr(20-1 downto 0) is
                     when x"00041" => bWritesEnabled   <= sys_wdata(0);
-                    when x"00042" => fifo_srst        <= sys_wdata(0);
+                    -- 0x42 is also the system identification trigger in dpll_wrapper.v, so the fifo reset has its own address
+                    when x"0004C" => fifo_srst        <= sys_wdata(0);
+                    when x"0004A" => deep_capture_decimation <= sys_wdata(16-1 downto 0);
+                    when x"0004B" => fifo_source_is_logger   <= sys_wdata(0);
 
                     when others => 
                 end case;
@@ -242,6 +289,9 @@ begin
                     when x"00039" => sys_ack <= sys_en; sys_rdata <= fifo_dout;             -- fifo read
 
                     when x"00040" => sys_ack <= sys_en;     sys_rdata <= std_logic_vector(resize(unsigned(fifo_data_count_max), 32));             -- max of fifo data_count
+                    when x"0003A" => sys_ack <= sys_en;     sys_rdata <= std_logic_vector(to_unsigned(0, 31)) &  fifo_overflow;               -- some samples were lost since the last fifo reset
+
+                    when x"0003B" => sys_ack <= sys_en;     sys_rdata <= logger_samples_written;               -- logger progress
 
                     when others   => sys_ack <= sys_en;     sys_rdata <=  (others => '0');
                 end case;
@@ -476,6 +476,7 @@ wire        [15:0] DACout2;
 wire [16-1:0] LoggerData;
 wire LoggerData_clk_enable;
 wire LoggerIsWriting;
+wire [32-1:0] LoggerSamplesWritten;
 
 reg dpll_output_selector;
 
@@ -527,6 +528,7 @@ dpll_wrapper dpll_wrapper_inst (
   .LoggerData              (  LoggerData                 ),
   .LoggerData_clk_enable   (  LoggerData_clk_enable      ),
   .LoggerIsWriting         (  LoggerIsWriting            ),
+  .LoggerSamplesWritten    (  LoggerSamplesWritten       ),
 
   // System bus
   .sys_addr                (  sys_addr                   ),  // address
@@ -634,6 +636,7 @@ ram_data_logger ram_data_logger_i (
   .data_in_clk_enable   (  LoggerData_clk_enable      ),
   // control interface
   .is_writing           (  LoggerIsWriting            ),
+  .samples_written      (  LoggerSamplesWritten       ),
   
   // CPU interface
   .sys_addr             (  sys_addr                   ),  // address
@@ -16,6 +16,7 @@ port (
     data_in_clk_enable                     : in  std_logic;
     -- control interface
     is_writing                             : out std_logic;
+    samples_written                        : out std_logic_vector(32-1 downto 0);   -- since the last trigger, lets the cpu know when the data it needs is ready
     
     -- CPU interface
     sys_addr                               : in  std_logic_vector(32-1 downto 0);   -- bus address
@@ -49,6 +50,7 @@ architecture Behavioral of ram_data_logger is
     signal data_valid     : std_logic  := '0';
     signal start_write_d1 : std_logic  := '0';
     signal start_write    : std_logic  := '0';
+    signal samples_written_counter : unsigned(32-1 downto 0) := (others => '0');
 begin
 
 
@@ -91,11 +93,13 @@ begin
                     when STATE_START =>
                         bWriting <= '1';    -- next data point will be written, unless this is the last
                         write_address <= (others => '0');
+                        samples_written_counter <= (others => '0');
                         FSM_state <= STATE_WRITE;
                         
                     when STATE_WRITE =>
                         bWriting <= '1';    -- next data point will be written, unless this is the last
                         if data_in_clk_enable = '1' then
+                            samples_written_counter <= samples_written_counter + 1;
                             
                             if write_address = (write_address'range => '1') then
                                 -- we are done, stop writing
@@ -116,6 +120,7 @@ begin
     end process;
 
     is_writing <= bWriting;
+    samples_written <= std_logic_vector(samples_written_counter);
 
     -- process which handles reading the ram and sending the results to the cpu
     -- also handles the registers reads and writes
@@ -122,6 +122,91 @@ typedef struct binary_packet_reboot_monitor_t {
 	uint32_t reserved2;	
 } binary_packet_reboot_monitor_t;
 
+// Batched register access: the header is followed by number_of_operations entries of type binary_packet_batch_entry_t.
+// All the read results are sent back in a single reply, in the order in which the reads appear in the batch.
+#define BATCH_OPERATION_WRITE 0
+#define BATCH_OPERATION_READ  1
+#define MAX_BATCH_OPERATIONS  1024
+uint32_t magic_bytes_batch = 0xABCD123A;
+typedef struct binary_packet_batch_t {
+	uint32_t magic_bytes;	// 0xABCD123A
+	uint32_t number_of_operations;
+	uint32_t reserved;
+} binary_packet_batch_t;
+
+typedef struct binary_packet_batch_entry_t {
+	uint32_t operation;		// BATCH_OPERATION_WRITE or BATCH_OPERATION_READ
+	uint32_t address;
+	uint32_t value;			// unused for reads
+} binary_packet_batch_entry_t;
+
+// Reads part of the logger buffer, starting at start_point. Lets the client split a large buffer read
+// into smaller requests, so that other register accesses can be interleaved in between.
+uint32_t magic_bytes_read_buffer_chunk = 0xABCD123B;
+typedef struct binary_packet_read_buffer_chunk_t {
+	uint32_t magic_bytes;	// 0xABCD123B
+	uint32_t start_point;
+	uint32_t number_of_points;
+} binary_packet_read_buffer_chunk_t;
+
+// Subscription to the zero-deadtime counter: after this packet, the connection is dedicated to streaming
+// one binary_counter_record_t per counter update, until the client closes it.
+// The records are pushed in groups of records_per_push, or sooner if the oldest unsent record is max_latency_us old.
+#define MAX_RECORDS_PER_PUSH 256
+uint32_t magic_bytes_subscribe_counters = 0xABCD123C;
+typedef struct binary_packet_subscribe_counters_t {
+	uint32_t magic_bytes;	// 0xABCD123C
+	uint32_t records_per_push;	// 1 to MAX_RECORDS_PER_PUSH
+	uint32_t max_latency_us;
+} binary_packet_subscribe_counters_t;
+
+typedef struct binary_counter_record_t {
+	uint32_t samples_number;
+	int64_t counter0;
+	int64_t counter1;
+	int32_t dac0;
+	int32_t dac1;
+	uint32_t dac2;
+} binary_counter_record_t;
+
+// Reads the counter samples which were buffered by the counter backlog thread, starting at first_samples_number.
+// The reply is a uint32_t number_of_records, followed by that many binary_counter_record_t, oldest first.
+// Fewer than max_records are returned only when there are no more samples in the backlog.
+#define MAX_BACKLOG_RECORDS_PER_READ 4096
+uint32_t magic_bytes_read_counter_backlog = 0xABCD123D;
+typedef struct binary_packet_read_counter_backlog_t {
+	uint32_t magic_bytes;	// 0xABCD123D
+	uint32_t first_samples_number;
+	uint32_t max_records;	// 1 to MAX_BACKLOG_RECORDS_PER_READ
+} binary_packet_read_counter_backlog_t;
+
+// Deep capture: fills data_buffer_with_fifo with the data selected by the logger multiplexer, through the fifo in registers_read.vhd,
+// then sends it. The fifo can only be drained at ~5e6 words/s, so the firmware keeps one sample out of decimation
+// and packs two 16-bits samples in each word. ADC captures don't have the reference phasor header of the logger captures.
+// The reply is a binary_deep_capture_reply_t, followed by number_of_points int16 samples.
+#define DEEP_CAPTURE_FLAG_OVERFLOW	1	// the fifo overflowed, so samples are missing
+#define DEEP_CAPTURE_FLAG_TIMEOUT	2	// the data stopped coming before the capture was complete
+uint32_t magic_bytes_deep_capture = 0xABCD123E;
+typedef struct binary_packet_deep_capture_t {
+	uint32_t magic_bytes;	// 0xABCD123E
+	uint32_t number_of_points;	// at most DEEP_CAPTURE_MAX_POINTS
+	uint32_t decimation;	// 1 to 65535
+} binary_packet_deep_capture_t;
+
+typedef struct binary_deep_capture_reply_t {
+	uint32_t number_of_points;
+	uint32_t flags;
+} binary_deep_capture_reply_t;
+
+// Waits until the logger has written number_of_samples samples since its last trigger, or until timeout_us.
+// The reply is a uint32_t: the number of samples written, which is smaller than number_of_samples on timeout.
+// Since the reply comes as soon as the data is ready, the client doesn't have to wait for a worst-case delay before reading the logger.
+uint32_t magic_bytes_wait_for_logger = 0xABCD123F;
+typedef struct binary_packet_wait_for_logger_t {
+	uint32_t magic_bytes;	// 0xABCD123F
+	uint32_t number_of_samples;
+	uint32_t timeout_us;
+} binary_packet_wait_for_logger_t;
 
 
 #pragma pack(pop)
@@ -272,6 +357,21 @@ void acq_GetDataFromLogger(uint32_t* size, int16_t* buffer_in)
     	printf("buffer_in[0] = %hd\n", buffer_in[0]);
 }
 
+void acq_GetDataChunkFromLogger(uint32_t start_point, uint32_t* size, int16_t* buffer_in)
+{
+    start_point = MIN(start_point, LOGGER_BUFFER_SIZE);
+    *size = MIN(*size, LOGGER_BUFFER_SIZE - start_point);
+
+    const volatile uint32_t* raw_buffer = (uint32_t*)((char*)map_base + LOGGER_BASE_ADDR + LOGGER_DATA_OFFSET);
+
+    if (bVerbose)
+    	printf("acq_GetDataChunkFromLogger: reading %u points, starting from point %u\n", *size, start_point);
+
+    for (uint32_t i = 0; i < (*size); ++i) {
+        buffer_in[i] = (raw_buffer[start_point + i]);
+    }
+}
+
 
 // based off acq_GetDataRawV2 in file acq_handler.c
 #define ADC_BUFFER_SIZE             (16*1024)
@@ -554,30 +654,43 @@ static void installTermSignalHandler()
 }
 
 
+// dpll bus addresses of the fifo in registers_read.vhd
+#define BUS_ADDR_FIFO_PROG_EMPTY		0x38	// read: 1 if the fifo has fewer than 10 words
+#define BUS_ADDR_FIFO_DATA				0x39	// read: pops one word
+#define BUS_ADDR_FIFO_OVERFLOW			0x3A	// read: 1 if the fifo overflowed since the last reset
+#define BUS_ADDR_FIFO_MAX_DATA_COUNT	0x40	// read: max number of words in the fifo since the last reset
+#define BUS_ADDR_FIFO_WRITES_ENABLED	0x41
+#define BUS_ADDR_FIFO_DECIMATION		0x4A
+#define BUS_ADDR_FIFO_SOURCE_IS_LOGGER	0x4B	// 0: throughput test counter, 1: logger data
+#define BUS_ADDR_FIFO_RESET				0x4C
+#define FIFO_WORDS_PER_READ 10	// the fifo is "not empty" when it holds at least that many words
+#define DEEP_CAPTURE_MAX_POINTS (2*FIFO_LOGGER_BUFFER_SIZE)
+#define DEEP_CAPTURE_TIMEOUT_US 1000000
+
 void continuous_fifo_read(  )
 {
 	uint32_t iChunk, iOut;
-    const volatile uint32_t* fifo_buffer = (uint32_t*)((char*)map_base + 4*0x00039U);
+    const volatile uint32_t* fifo_buffer = (uint32_t*)((char*)map_base + 4*BUS_ADDR_FIFO_DATA);
 
     // start the reading process by setting a few registers:
-    write_value(FPGA_MEMORY_START + 0x42*4, 'w', 1);	//    assert fifo synchronous reset (and also resets max_fifo_count)
-    write_value(FPGA_MEMORY_START + 0x42*4, 'w', 0);	// de-assert fifo synchronous reset
-    write_value(FPGA_MEMORY_START + 0x41*4, 'w', 1);	// bWritesEnabled = 1
+    write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_RESET*4, 'w', 1);	//    assert fifo synchronous reset (and also resets max_fifo_count)
+    write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_RESET*4, 'w', 0);	// de-assert fifo synchronous reset
+    write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_WRITES_ENABLED*4, 'w', 1);	// bWritesEnabled = 1
 
 
     // Read the fifo as quickly as we can
     iOut = 0;
     while (iOut < FIFO_LOGGER_BUFFER_SIZE) {
     	// wait until fifo is not empty
-    	while (read_value(FPGA_MEMORY_START + 0x38*4)) ;
+    	while (read_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_PROG_EMPTY*4)) ;
     	// "not empty" in this case means at least 10 samples in the fifo
-    	for (iChunk=0; iChunk<10; iChunk++)
+    	for (iChunk=0; iChunk<FIFO_WORDS_PER_READ; iChunk++)
         	data_buffer_with_fifo[iOut++] = (*fifo_buffer);
     }
-    write_value(FPGA_MEMORY_START + 0x41*4, 'w', 1);	// bWritesEnabled = 0
+    write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_WRITES_ENABLED*4, 'w', 0);	// bWritesEnabled = 0
 
     // what is max data count for fifo?
-    uint32_t max_fifo_count = read_value(FPGA_MEMORY_START + 0x40*4);
+    uint32_t max_fifo_count = read_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_MAX_DATA_COUNT*4);
 
     // show results, first few points of the buffer:
     for (iOut=0; iOut<50; iOut++)
@@ -589,6 +702,89 @@ void continuous_fifo_read(  )
 	return;
 }
 
+// Fills data_buffer_with_fifo with number_of_points samples of the data selected by the logger multiplexer.
+// Returns the number of points captured, which is smaller than requested if the data stopped coming (see DEEP_CAPTURE_FLAG_TIMEOUT).
+uint32_t deep_capture(uint32_t number_of_points, uint32_t decimation, uint32_t* flags)
+{
+	const volatile uint32_t* fifo_buffer = (uint32_t*)((char*)map_base + 4*BUS_ADDR_FIFO_DATA);
+	struct timespec time_last_data, time_now;
+	uint32_t iChunk, iOut, iPolls;
+	long int elapsed_us;
+
+	*flags = 0;
+	number_of_points = MIN(number_of_points, DEEP_CAPTURE_MAX_POINTS);
+	uint32_t number_of_words = (number_of_points+1)/2;
+
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_WRITES_ENABLED*4, 'w', 0);
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_DECIMATION*4, 'w', MAX(1, MIN(decimation, 0xFFFF)));
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_SOURCE_IS_LOGGER*4, 'w', 1);
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_RESET*4, 'w', 1);
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_RESET*4, 'w', 0);
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_WRITES_ENABLED*4, 'w', 1);
+
+	iOut = 0;
+	iPolls = 0;	// number of consecutive polls which found the fifo empty
+	while (iOut < number_of_words && !app_exit)
+	{
+		if (read_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_PROG_EMPTY*4))
+		{
+			// checking the time is much slower than polling the fifo, so we only do it once in a while
+			if (++iPolls % 4096 == 0)
+			{
+				clock_gettime(CLOCK_MONOTONIC, &time_now);
+				if (iPolls == 4096)
+					time_last_data = time_now;	// the fifo has been empty for a while, start timing
+				elapsed_us = 1000000L * (long int)(time_now.tv_sec-time_last_data.tv_sec) + (long int)(time_now.tv_nsec-time_last_data.tv_nsec)/1000L;
+				if (elapsed_us > DEEP_CAPTURE_TIMEOUT_US)
+				{
+					*flags |= DEEP_CAPTURE_FLAG_TIMEOUT;
+					break;
+				}
+			}
+			continue;
+		}
+		for (iChunk=0; iChunk<FIFO_WORDS_PER_READ && iOut < number_of_words; iChunk++)
+			data_buffer_with_fifo[iOut++] = (*fifo_buffer);
+		iPolls = 0;
+	}
+
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_WRITES_ENABLED*4, 'w', 0);
+	if (read_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_OVERFLOW*4) & 1)
+		*flags |= DEEP_CAPTURE_FLAG_OVERFLOW;
+	// leaves the fifo as continuous_fifo_read() expects it
+	write_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_SOURCE_IS_LOGGER*4, 'w', 0);
+
+	if (bVerbose)
+		printf("deep_capture: %u words captured, flags = %u, max fifo count = %u\n", iOut, *flags, read_value(FPGA_MEMORY_START + BUS_ADDR_FIFO_MAX_DATA_COUNT*4));
+	return MIN(number_of_points, 2*iOut);
+}
+
+#define BUS_ADDR_LOGGER_SAMPLES_WRITTEN	0x3B	// read: number of samples written by the logger since its last trigger
+#define LOGGER_POLL_PERIOD_US 20
+
+uint32_t wait_for_logger(uint32_t number_of_samples, uint32_t timeout_us)
+{
+	struct timespec time_start, time_now;
+	long int elapsed_us;
+	uint32_t samples_written = 0;
+
+	clock_gettime(CLOCK_MONOTONIC, &time_start);
+	while (!app_exit)
+	{
+		samples_written = read_value(FPGA_MEMORY_START + BUS_ADDR_LOGGER_SAMPLES_WRITTEN*4);
+		if (samples_written >= number_of_samples)
+			break;
+		clock_gettime(CLOCK_MONOTONIC, &time_now);
+		elapsed_us = 1000000L * (long int)(time_now.tv_sec-time_start.tv_sec) + (long int)(time_now.tv_nsec-time_start.tv_nsec)/1000L;
+		if (elapsed_us >= (long int)timeout_us)
+			break;
+		usleep(LOGGER_POLL_PERIOD_US);
+	}
+	if (bVerbose)
+		printf("wait_for_logger: %u samples written out of %u\n", samples_written, number_of_samples);
+	return samples_written;
+}
+
 void throughput_test(  )
 {
 	int32_t current_delta;
@@ -689,6 +885,244 @@ void *second_thread_function( void *ptr )
 }
 
 
+// dpll bus addresses of the zero-deadtime counter and of the DAC current values (see registers_read.vhd)
+#define BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER	0x30
+#define BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS	0x31
+#define BUS_ADDR_ZERO_DEADTIME_COUNTER0_MSBS	0x32
+#define BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS	0x33
+#define BUS_ADDR_ZERO_DEADTIME_COUNTER1_MSBS	0x34
+#define BUS_ADDR_DAC0_CURRENT					0x35
+#define BUS_ADDR_DAC1_CURRENT					0x36
+#define BUS_ADDR_DAC2_CURRENT					0x37
+// the counter updates at most every ~1 ms, so polling at 10 kHz catches every update
+#define COUNTER_POLL_PERIOD_US 100
+
+void read_counter_record(binary_counter_record_t* pRecord)
+{
+	// the values were latched when we read the samples number (see registers_read.vhd)
+	uint64_t lsbs, msbs;
+	lsbs = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS*4);
+	msbs = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_COUNTER0_MSBS*4);
+	pRecord->counter0 = (int64_t)((msbs << 32) | lsbs);
+	lsbs = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS*4);
+	msbs = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_COUNTER1_MSBS*4);
+	pRecord->counter1 = (int64_t)((msbs << 32) | lsbs);
+	pRecord->dac0 = (int32_t)read_value(FPGA_MEMORY_START + BUS_ADDR_DAC0_CURRENT*4);
+	pRecord->dac1 = (int32_t)read_value(FPGA_MEMORY_START + BUS_ADDR_DAC1_CURRENT*4);
+	pRecord->dac2 = read_value(FPGA_MEMORY_START + BUS_ADDR_DAC2_CURRENT*4);
+}
+
+// Reads the record of the sample which was latched by reading samples_number.
+// Any reader of the samples number re-latches the values (this process's backlog thread, a counter stream,
+// or a client which reads the registers directly), so we read the samples number again after the values,
+// and start over if a newer sample was latched in between.
+// Returns the samples number which matches the values.
+uint32_t read_latched_counter_record(binary_counter_record_t* pRecord, uint32_t samples_number)
+{
+	uint32_t samples_number_after;
+	while (1)
+	{
+		read_counter_record(pRecord);
+		samples_number_after = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4);
+		if (samples_number_after == samples_number)
+			break;
+		samples_number = samples_number_after;
+	}
+	pRecord->samples_number = samples_number;
+	return samples_number;
+}
+
+// Serves a counter subscription: polls the samples number register, and pushes a record each time it changes.
+// Returns 0 when the client closes the connection, -1 on a socket error.
+int stream_counter_records(int connfd, uint32_t records_per_push, uint32_t max_latency_us)
+{
+	binary_counter_record_t records[MAX_RECORDS_PER_PUSH];
+	uint32_t number_of_records = 0;
+	struct timespec time_first_record, time_now;
+	long int elapsed_us;
+	char discard_buffer[MAX_BUFF_SIZE];
+	int read_size;
+
+	records_per_push = MAX(1, MIN(records_per_push, MAX_RECORDS_PER_PUSH));
+	// makes sure that the current sample is sent right away
+	uint32_t last_samples_number = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4) - 1;
+
+	if (bVerbose)
+		printf("streaming counter records: records_per_push = %u, max_latency_us = %u\n", records_per_push, max_latency_us);
+
+	while (!app_exit)
+	{
+		// this read latches the counter and DAC values
+		uint32_t samples_number = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4);
+		if (samples_number != last_samples_number)
+		{
+			last_samples_number = read_latched_counter_record(&records[number_of_records], samples_number);
+			if (number_of_records == 0)
+				clock_gettime(CLOCK_MONOTONIC, &time_first_record);
+			number_of_records++;
+		}
+
+		if (number_of_records > 0)
+		{
+			clock_gettime(CLOCK_MONOTONIC, &time_now);
+			elapsed_us = 1000000L * (long int)(time_now.tv_sec-time_first_record.tv_sec) + (long int)(time_now.tv_nsec-time_first_record.tv_nsec)/1000L;
+			if (number_of_records >= records_per_push || elapsed_us >= (long int)max_latency_us)
+			{
+				if (send(connfd, records, number_of_records*sizeof(binary_counter_record_t), MSG_NOSIGNAL) < 0)
+					return -1;
+				number_of_records = 0;
+			}
+		}
+
+		// the client unsubscribes by closing the connection, anything else it sends is ignored
+		read_size = recv(connfd, discard_buffer, sizeof(discard_buffer), MSG_DONTWAIT);
+		if (read_size == 0)
+			return 0;
+		if (read_size < 0 && errno != EAGAIN && errno != EWOULDBLOCK)
+			return -1;
+
+		usleep(COUNTER_POLL_PERIOD_US);
+	}
+	return 0;
+}
+
+
+// Counter backlog: a thread of the parent process copies every counter sample into a ring buffer,
+// which is shared with the child processes that serve the connections (MAP_SHARED, so it survives the fork).
+// The thread is the only writer. It writes the record, then increments number_of_records,
+// so the readers only need to stay away from the oldest records, which are the next ones to be overwritten.
+// 2^16 records = 2 MB, which holds ~18 hours at 1 sample/s, or ~65 seconds at 1000 samples/s.
+// The requests are served by the child processes, which can't start a thread in the parent:
+// the thread idles until the first READ_COUNTER_BACKLOG request sets bRequested, and only then polls the PL.
+// It also stays away from the PL while a child runs a shell command (pause_count > 0),
+// since the GUI reprograms the FPGA with one ("cat /opt/red_pitaya_top.bit > /dev/xdevcfg").
+#define COUNTER_BACKLOG_SIZE (1U<<16)
+#define COUNTER_BACKLOG_GUARD 1024	// records which a reader never returns, since they might be overwritten while being sent
+#define COUNTER_BACKLOG_IDLE_PERIOD_US 10000
+typedef struct counter_backlog_t {
+	volatile uint32_t number_of_records;	// total number written since the start, the next one goes at number_of_records % COUNTER_BACKLOG_SIZE
+	volatile uint32_t bRequested;	// set by the first READ_COUNTER_BACKLOG request
+	volatile uint32_t pause_count;	// number of shell commands in progress, see pause_counter_backlog()
+	volatile uint32_t bPolling;	// set by the thread while it reads the PL
+	binary_counter_record_t records[COUNTER_BACKLOG_SIZE];
+} counter_backlog_t;
+
+counter_backlog_t* counter_backlog = NULL;
+binary_counter_record_t backlog_records[MAX_BACKLOG_RECORDS_PER_READ];	// holds the records of one reply
+
+void *counter_backlog_thread_function( void *ptr )
+{
+	binary_counter_record_t record;
+	uint32_t last_samples_number = 0;
+	bool bRestart = true;
+
+	while (!app_exit)
+	{
+		if (!counter_backlog->bRequested)
+		{
+			usleep(COUNTER_BACKLOG_IDLE_PERIOD_US);
+			continue;
+		}
+
+		counter_backlog->bPolling = 1;
+		__sync_synchronize();	// pairs with pause_counter_backlog(): either we see the pause, or it waits for us
+		if (counter_backlog->pause_count == 0)
+		{
+			if (bRestart)
+			{
+				// same as stream_counter_records(): makes sure that the current sample is recorded right away.
+				// Also after a pause, since the FPGA might have been reprogrammed
+				last_samples_number = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4) - 1;
+				bRestart = false;
+			}
+			// this read latches the counter and DAC values
+			uint32_t samples_number = read_value(FPGA_MEMORY_START + BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4);
+			if (samples_number != last_samples_number)
+			{
+				last_samples_number = read_latched_counter_record(&record, samples_number);
+				counter_backlog->records[counter_backlog->number_of_records % COUNTER_BACKLOG_SIZE] = record;
+				__sync_synchronize();	// the record must be complete before the readers can see it
+				counter_backlog->number_of_records++;
+			}
+		}
+		else
+			bRestart = true;
+		__sync_synchronize();
+		counter_backlog->bPolling = 0;
+		usleep(COUNTER_POLL_PERIOD_US);
+	}
+	return NULL;
+}
+
+// Called by the child processes around the shell commands: the thread doesn't touch the PL until the matching resume.
+// Waits for the thread to finish the record it might be reading.
+void pause_counter_backlog()
+{
+	if (counter_backlog == NULL)
+		return;
+	__sync_fetch_and_add(&counter_backlog->pause_count, 1);
+	__sync_synchronize();
+	while (counter_backlog->bPolling)
+		usleep(COUNTER_POLL_PERIOD_US);
+}
+
+void resume_counter_backlog()
+{
+	if (counter_backlog == NULL)
+		return;
+	__sync_fetch_and_sub(&counter_backlog->pause_count, 1);
+}
+
+int start_counter_backlog()
+{
+	pthread_t counter_backlog_thread;
+
+	counter_backlog = mmap(0, sizeof(counter_backlog_t), PROT_READ | PROT_WRITE, MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+	if (counter_backlog == MAP_FAILED)
+	{
+		counter_backlog = NULL;
+		return -1;
+	}
+	counter_backlog->number_of_records = 0;
+	counter_backlog->bRequested = 0;
+	counter_backlog->pause_count = 0;
+	counter_backlog->bPolling = 0;
+	if (pthread_create(&counter_backlog_thread, NULL, counter_backlog_thread_function, NULL))
+	{
+		munmap(counter_backlog, sizeof(counter_backlog_t));
+		counter_backlog = NULL;
+		return -1;
+	}
+	pthread_detach(counter_backlog_thread);
+	return 0;
+}
+
+// Copies up to max_records records, starting with the one with samples number first_samples_number
+// (or the oldest available one if that sample is gone already). Returns the number of records copied.
+uint32_t read_counter_backlog(uint32_t first_samples_number, uint32_t max_records, binary_counter_record_t* records_out)
+{
+	if (counter_backlog == NULL)
+		return 0;
+	// starts the polling, the first requests find the backlog empty
+	counter_backlog->bRequested = 1;
+
+	uint32_t number_of_records = counter_backlog->number_of_records;
+	__sync_synchronize();
+	uint32_t number_available = MIN(number_of_records, COUNTER_BACKLOG_SIZE - COUNTER_BACKLOG_GUARD);
+	uint32_t oldest = number_of_records - number_available;
+
+	// the samples numbers are increasing: skip the records older than first_samples_number, from the newest one
+	uint32_t first = number_of_records;
+	while (first != oldest && (int32_t)(counter_backlog->records[(first-1) % COUNTER_BACKLOG_SIZE].samples_number - first_samples_number) >= 0)
+		first--;
+
+	uint32_t number_to_copy = MIN(number_of_records - first, max_records);
+	for (uint32_t k = 0; k < number_to_copy; k++)
+		records_out[k] = counter_backlog->records[(first + k) % COUNTER_BACKLOG_SIZE];
+	return number_to_copy;
+}
+
+
 /**
  * This is main method of every child process. Here communication with client is handled.
  * @param connfd The communication port
@@ -748,6 +1182,10 @@ static int handleConnection(int connfd) {
     struct binary_packet_shell_command_t * pPacketShellCommand;
     // Variables for the "reboot" message
     bool bReboot = false;
+    // Variables for the "batch" message
+    bool bHaveBatchHeader = false;
+    struct binary_packet_batch_t * pPacketBatch;
+    uint32_t batch_read_values[MAX_BATCH_OPERATIONS];
 
     
 
@@ -1114,7 +1552,10 @@ static int handleConnection(int connfd) {
 									printf("shell command: '%s'\n", strCommand);
 
 								// send command to shell using system()
+								// the command might reprogram the FPGA: the counter backlog thread must not read the PL meanwhile
+								pause_counter_backlog();
 								system(strCommand);
+								resume_counter_backlog();
 
 								free(strCommand);
 
@@ -1165,6 +1606,174 @@ static int handleConnection(int connfd) {
 
 		        } // else if (message_magic_bytes == magic_bytes_reboot_monitor)
 
+	        	////////////////////////////////////////////////////////////
+	        	// Batch of register reads/writes, executed in order. All the read values are sent back in a single reply.
+	        	else if (message_magic_bytes == magic_bytes_batch)
+	        	{
+	        		// we need the header before we can figure out the size of this message.
+	        		if (!bHaveBatchHeader)
+	        		{
+	        			iRequiredBytes = sizeof(binary_packet_batch_t);
+	        			if (msg_end >= iRequiredBytes) {
+	        				pPacketBatch = (binary_packet_batch_t*) message_buff;
+	        				if (pPacketBatch->number_of_operations > MAX_BATCH_OPERATIONS)
+	        				{
+	        					if (bVerbose)
+	        						printf("batch packet has too many operations: %u (max %u)\n", pPacketBatch->number_of_operations, MAX_BATCH_OPERATIONS);
+	        					// we can't recover from this, the rest of the stream would be misinterpreted
+	        					return 0;
+	        				}
+	        				bHaveBatchHeader = true;
+			        		iRequiredBytes = sizeof(binary_packet_batch_t) + pPacketBatch->number_of_operations*sizeof(binary_packet_batch_entry_t);
+			        		if (bVerbose)
+			        			printf("Received batch header, number_of_operations = %u, iRequiredBytes = %u\n", pPacketBatch->number_of_operations, iRequiredBytes);
+	        			}
+	        		}
+	        		if (bHaveBatchHeader) {
+	        			if (msg_end >= iRequiredBytes) {
+	        				pPacketBatch = (binary_packet_batch_t*) message_buff;	// message_buff might have been reallocated since we parsed the header
+	        				struct binary_packet_batch_entry_t * pEntries = (binary_packet_batch_entry_t*) (message_buff + sizeof(binary_packet_batch_t));
+	        				uint32_t number_of_reads = 0;
+	        				for (uint32_t k = 0; k < pPacketBatch->number_of_operations; k++)
+	        				{
+	        					if (pEntries[k].operation == BATCH_OPERATION_WRITE)
+	        					{
+	        						write_value(pEntries[k].address, 'w', pEntries[k].value);
+	        					} else {
+	        						batch_read_values[number_of_reads] = read_value(pEntries[k].address);
+	        						number_of_reads++;
+	        					}
+	        				}
+	        				if (bVerbose)
+	        					printf("batch executed: %u operations, %u reads\n", pPacketBatch->number_of_operations, number_of_reads);
+
+	        				// send all the read values back in one go:
+	        				if (number_of_reads > 0)
+	        					send(connfd, batch_read_values, number_of_reads*sizeof(uint32_t), 0);
+
+			        		// reset our message parsing state variables
+			        		bHaveBatchHeader = false;
+			        		bytes_consumed = iRequiredBytes;
+			        		bHaveMagicBytes = false;
+			        		iRequiredBytes = sizeof(message_magic_bytes);
+	        			}
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_batch)
+
+	        	////////////////////////////////////////////////////////////
+	        	// Read part of the logger buffer
+	        	else if (message_magic_bytes == magic_bytes_read_buffer_chunk)
+	        	{
+	        		iRequiredBytes = sizeof(binary_packet_read_buffer_chunk_t);
+	        		if (msg_end >= iRequiredBytes) {
+		        		struct binary_packet_read_buffer_chunk_t * pPacketReadBufferChunk;
+		        		pPacketReadBufferChunk = (binary_packet_read_buffer_chunk_t*) message_buff;
+
+		        		if (bVerbose)
+		        			printf("Received a buffer chunk read packet: start_point = %u, number_of_points = %u\n", pPacketReadBufferChunk->start_point, pPacketReadBufferChunk->number_of_points);
+
+		        		uint32_t acq_size = pPacketReadBufferChunk->number_of_points;
+		        		acq_GetDataChunkFromLogger(pPacketReadBufferChunk->start_point, &acq_size, data_buffer);
+		        		send(connfd, data_buffer, (size_t)acq_size*sizeof(int16_t), 0);
+
+		        		// reset our message parsing state variables
+		        		bytes_consumed = sizeof(binary_packet_read_buffer_chunk_t);
+		        		bHaveMagicBytes = false;
+		        		iRequiredBytes = sizeof(message_magic_bytes);
+	        		} else {
+	        			if (bVerbose)
+	        				printf("Received a buffer chunk read packet, but we have not received the full packet yet.\n");
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_read_buffer_chunk)
+
+	        	////////////////////////////////////////////////////////////
+	        	// Subscription to the counter samples: this connection now only streams counter records, until the client closes it.
+	        	else if (message_magic_bytes == magic_bytes_subscribe_counters)
+	        	{
+	        		iRequiredBytes = sizeof(binary_packet_subscribe_counters_t);
+	        		if (msg_end >= iRequiredBytes) {
+		        		struct binary_packet_subscribe_counters_t * pPacketSubscribe;
+		        		pPacketSubscribe = (binary_packet_subscribe_counters_t*) message_buff;
+
+		        		if (bVerbose)
+		        			printf("Received a counter subscription packet: records_per_push = %u, max_latency_us = %u\n", pPacketSubscribe->records_per_push, pPacketSubscribe->max_latency_us);
+
+		        		read_size = stream_counter_records(connfd, pPacketSubscribe->records_per_push, pPacketSubscribe->max_latency_us);
+		        		goto loop_exit;	// we need to exit two nested while loops
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_subscribe_counters)
+
+	        	////////////////////////////////////////////////////////////
+	        	// Read the counter samples buffered by the counter backlog thread
+	        	else if (message_magic_bytes == magic_bytes_read_counter_backlog)
+	        	{
+	        		iRequiredBytes = sizeof(binary_packet_read_counter_backlog_t);
+	        		if (msg_end >= iRequiredBytes) {
+		        		struct binary_packet_read_counter_backlog_t * pPacketReadBacklog;
+		        		pPacketReadBacklog = (binary_packet_read_counter_backlog_t*) message_buff;
+
+		        		uint32_t max_records = MAX(1, MIN(pPacketReadBacklog->max_records, MAX_BACKLOG_RECORDS_PER_READ));
+		        		uint32_t number_of_records = read_counter_backlog(pPacketReadBacklog->first_samples_number, max_records, backlog_records);
+		        		if (bVerbose)
+		        			printf("Received a counter backlog read packet: first_samples_number = %u, sending %u records\n", pPacketReadBacklog->first_samples_number, number_of_records);
+
+		        		send(connfd, &number_of_records, sizeof(number_of_records), MSG_MORE);
+		        		send(connfd, backlog_records, number_of_records*sizeof(binary_counter_record_t), 0);
+
+		        		// reset our message parsing state variables
+		        		bytes_consumed = sizeof(binary_packet_read_counter_backlog_t);
+		        		bHaveMagicBytes = false;
+		        		iRequiredBytes = sizeof(message_magic_bytes);
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_read_counter_backlog)
+
+	        	////////////////////////////////////////////////////////////
+	        	// Deep capture through the fifo, then send the whole capture
+	        	else if (message_magic_bytes == magic_bytes_deep_capture)
+	        	{
+	        		iRequiredBytes = sizeof(binary_packet_deep_capture_t);
+	        		if (msg_end >= iRequiredBytes) {
+		        		struct binary_packet_deep_capture_t * pPacketDeepCapture;
+		        		pPacketDeepCapture = (binary_packet_deep_capture_t*) message_buff;
+
+		        		if (bVerbose)
+		        			printf("Received a deep capture packet: number_of_points = %u, decimation = %u\n", pPacketDeepCapture->number_of_points, pPacketDeepCapture->decimation);
+
+		        		binary_deep_capture_reply_t reply;
+		        		reply.number_of_points = deep_capture(pPacketDeepCapture->number_of_points, pPacketDeepCapture->decimation, &reply.flags);
+		        		send(connfd, &reply, sizeof(reply), MSG_MORE);
+		        		// the samples are little-endian int16, so the packed words can be sent as they are
+		        		send(connfd, data_buffer_with_fifo, (size_t)reply.number_of_points*sizeof(int16_t), 0);
+
+		        		// reset our message parsing state variables
+		        		bytes_consumed = sizeof(binary_packet_deep_capture_t);
+		        		bHaveMagicBytes = false;
+		        		iRequiredBytes = sizeof(message_magic_bytes);
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_deep_capture)
+
+	        	////////////////////////////////////////////////////////////
+	        	// Wait for the logger to hold the requested number of samples
+	        	else if (message_magic_bytes == magic_bytes_wait_for_logger)
+	        	{
+	        		iRequiredBytes = sizeof(binary_packet_wait_for_logger_t);
+	        		if (msg_end >= iRequiredBytes) {
+		        		struct binary_packet_wait_for_logger_t * pPacketWaitForLogger;
+		        		pPacketWaitForLogger = (binary_packet_wait_for_logger_t*) message_buff;
+
+		        		if (bVerbose)
+		        			printf("Received a wait for logger packet: number_of_samples = %u, timeout_us = %u\n", pPacketWaitForLogger->number_of_samples, pPacketWaitForLogger->timeout_us);
+
+		        		uint32_t samples_written = wait_for_logger(pPacketWaitForLogger->number_of_samples, pPacketWaitForLogger->timeout_us);
+		        		send(connfd, &samples_written, sizeof(samples_written), 0);
+
+		        		// reset our message parsing state variables
+		        		bytes_consumed = sizeof(binary_packet_wait_for_logger_t);
+		        		bHaveMagicBytes = false;
+		        		iRequiredBytes = sizeof(message_magic_bytes);
+	        		}
+	        	} // else if (message_magic_bytes == magic_bytes_wait_for_logger)
+
 	        	else {	// magic bytes didn't match any known packet type
 
 	        		if (bVerbose)
@@ -1211,7 +1820,7 @@ static int handleConnection(int connfd) {
 		// }
     }
 
-// loop_exit:
+loop_exit:
     free(message_buff);
 
     //
@@ -1329,6 +1938,13 @@ int main(int argc, char *argv[])
 
     printf("Server is listening on port %d\n", LISTEN_PORT);
 
+    // the counter backlog thread runs in this process, with its own memory map, for as long as the server runs.
+    // It only polls the PL once a client has asked for the backlog, see counter_backlog_t.
+    // each child process maps the FPGA memory again in handleConnection().
+    initMemoryMap();
+    if (start_counter_backlog() != 0)
+    	printf("Failed to start the counter backlog thread, the counter backlog will stay empty\n");
+
     // Socket is opened and listening on port. Now we can accept connections
     while(1)
     {
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Continuous logger captures for the live displays.
+#
+# XEM_GUI_MainWindow.getADCdata() does setup, trigger, wait, read and processing strictly in sequence, so the device sits idle
+# while the GUI computes and plots the spectra. Here, a worker thread owns the capture sequence, and each consumer (a stream)
+# always has its next frame captured in advance: as soon as a consumer takes frame N, the worker triggers and reads frame N+1,
+# while the consumer is processing frame N. The logger has a single RAM, so a capture cannot overlap the transfer of the previous one,
+# but everything else (waits, round trips, decoding on our side and the consumer's processing) runs concurrently.
+#
+# Typical use:
+#   stream = sl.capture_pipeline.addStream('ADC0', 2**15)
+#   frame = stream.takeFrame()            # non-blocking, None if the next frame is not ready yet
+# or, from a thread of its own:
+#   for frame in stream.frames():
+#       ...
+# or with a callback, which is called on a delivery thread of the stream:
+#   stream = sl.capture_pipeline.addStream('DDC0', 2**15, bReadAsDDC=True, callback=processFrame)
+#
+# The streams which ask for the same capture (same input, number of samples and decoding), typically from different windows,
+# share a single source: each capture of the source is delivered to all of its streams. A stream's max_age (usually a bit less than
+# the consumer's refresh period) is the time during which a frame is still fresh enough for it: the source is not captured again
+# within max_age of its last trigger, so the windows which refresh at the same rate all get the same frames,
+# and opening more windows doesn't add captures. When several sources need a capture, the one which uses the current logger input goes
+# first, then they are served in turn.
+#
+# The samples of an ADC/DAC frame are views into the receive buffers of the source, which are reused once all the streams
+# are done with them: they are only valid until the next frame is taken (or until the callback returns), so copy them to keep them.
+# The worker waits for the logger like the other functions, with the display priority (see LoggerArbiter.py).
+# When the GUI has started its I/O thread (sl.device_io, see DeviceIOThread.py), the worker queues each capture there instead of
+# accessing the device itself.
+
+from __future__ import print_function
+import concurrent.futures
+import threading
+import time
+import traceback
+import logging
+
+import numpy as np
+
+from RP_PLL import CommsError, CommsLoggeableError
+from LoggerArbiter import PRIORITY_DISPLAY
+
+class CaptureFrame():
+    def __init__(self, source, frame_number, samples, ref_exp0, trigger_time, read_time):
+        self.input_select = source.input_select
+        self.frame_number = frame_number    # counts the captures of the source, the consumer can detect skipped frames
+        self.samples = samples              # int16 (uint16 for DAC2) counts for ADC/DAC captures, instantaneous frequency in Hz for DDC captures
+        self.ref_exp0 = ref_exp0            # reference phasor of the ADC captures, see read_adc_samples_from_DDR2()
+        self.trigger_time = trigger_time    # time.perf_counter() just before the trigger
+        self.read_time = read_time          # time.perf_counter() at the end of the transfer
+
+class CaptureSource():
+    # one kind of capture, shared by all the streams which ask for it. Only used with the pipeline's lock held
+    def __init__(self, input_select, N_samples, bReadAsDDC):
+        self.input_select = input_select
+        self.N_samples = N_samples
+        self.bReadAsDDC = bReadAsDDC
+        self.streams = []
+        self.frame_count = 0
+        self.last_trigger_time = None
+        self.free_buffers = []
+        self.buffer_users = {}      # id(buffer) -> number of streams which hold this buffer, or have it pending
+
+    def getNextCaptureTime(self):
+        # the time after which a capture is needed, or None if all the streams have a frame waiting for them
+        max_ages = [stream.max_age for stream in self.streams if stream.pending_frame is None and not stream.bClosed]
+        if len(max_ages) == 0:
+            return None
+        if self.last_trigger_time is None:
+            return 0.
+        return self.last_trigger_time + min(max_ages)
+
+    def getOwner(self):
+        # name under which the captures appear in the logger's statistics
+        return ' + '.join(sorted(set(stream.owner for stream in self.streams)))
+
+    def getBuffer(self):
+        if len(self.free_buffers) > 0:
+            return self.free_buffers.pop()
+        return np.empty(self.N_samples, dtype=np.int16)
+
+    def deliver(self, frame, buffer):
+        # gives the frame to all the streams, replacing the frames which they have not taken yet
+        for stream in self.streams:
+            if stream.pending_buffer is not None:
+                self.releaseBuffer(stream.pending_buffer)
+            stream.pending_frame = frame
+            stream.pending_buffer = None if self.bReadAsDDC else buffer
+        if self.bReadAsDDC or len(self.streams) == 0:
+            # the samples were converted to Hz, the buffer is free already
+            self.free_buffers.append(buffer)
+        else:
+            self.buffer_users[id(buffer)] = len(self.streams)
+
+    def releaseBuffer(self, buffer):
+        self.buffer_users[id(buffer)] -= 1
+        if self.buffer_users[id(buffer)] == 0:
+            del self.buffer_users[id(buffer)]
+            self.free_buffers.append(buffer)
+
+class CaptureStream():
+    def __init__(self, pipeline, source, callback, owner, max_age):
+        self.pipeline = pipeline
+        self.source = source
+        self.input_select = source.input_select
+        self.N_samples = source.N_samples
+        self.bReadAsDDC = source.bReadAsDDC
+        self.owner = owner          # name under which the captures appear in the logger's statistics
+        self.max_age = max_age      # in seconds, see the comments at the top
+        self.bClosed = False
+        self.pending_frame = None   # captured, but not taken by the consumer yet
+        self.pending_buffer = None
+        self.held_frame = None      # taken by the consumer
+        self.held_buffer = None
+        self.delivery_thread = None
+        if callback is not None:
+            self.delivery_thread = threading.Thread(target=self.deliverFrames, args=(callback,), daemon=True)
+            self.delivery_thread.start()
+
+    def takeFrame(self, timeout=0.):
+        # returns the next frame, or None if it is not ready within timeout (None waits forever).
+        # The previous frame's buffer is given back to the pipeline, which starts capturing the frame after this one right away.
+        with self.pipeline.condition:
+            if not self.pipeline.condition.wait_for(lambda: self.pending_frame is not None or self.bClosed, timeout):
+                return None
+            if self.bClosed:
+                return None
+            self.releaseHeldFrame()
+            (self.held_frame, self.held_buffer) = (self.pending_frame, self.pending_buffer)
+            (self.pending_frame, self.pending_buffer) = (None, None)
+            self.pipeline.condition.notify_all()
+            return self.held_frame
+
+    def frames(self, timeout=None):
+        # generator over the frames, until the stream is closed (or no frame came within timeout)
+        while True:
+            frame = self.takeFrame(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    def releaseHeldFrame(self):
+        # called with the pipeline's lock held
+        if self.held_buffer is not None:
+            self.source.releaseBuffer(self.held_buffer)
+        (self.held_frame, self.held_buffer) = (None, None)
+
+    def deliverFrames(self, callback):
+        for frame in self.frames():
+            try:
+                callback(frame)
+            except Exception:
+                logging.error(traceback.format_exc())
+            with self.pipeline.condition:
+                # the consumer is done with this frame
+                self.releaseHeldFrame()
+                self.pipeline.condition.notify_all()
+
+    def close(self):
+        with self.pipeline.condition:
+            self.bClosed = True
+            self.pipeline.condition.notify_all()
+        # the callback might still be using its frame
+        if self.delivery_thread is not None and self.delivery_thread is not threading.current_thread():
+            self.delivery_thread.join()
+        self.pipeline.removeStream(self)
+
+class CapturePipeline():
+
+    # wait before retrying after a communication error
+    ERROR_RETRY_PERIOD = 0.5
+
+    def __init__(self, sl):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':CapturePipeline'
+
+        self.sl = sl
+        self.sources = {}           # (input_select, N_samples, bReadAsDDC) -> CaptureSource
+        self.source_order = []      # the sources are served in turn
+        self.condition = threading.Condition()
+        self.thread = None
+        # statistics, see getStatistics()
+        self.frames_captured = 0
+        self.frames_delivered = 0
+        self.time_busy = 0.
+        self.time_start = None
+
+    def addStream(self, input_select, N_samples, bReadAsDDC=False, callback=None, owner='CapturePipeline', max_age=0.):
+        # input_select is a key of sl.LOGGER_MUX. The first frame is captured right away
+        key = (input_select, int(N_samples), bReadAsDDC)
+        with self.condition:
+            source = self.sources.get(key)
+            if source is None:
+                source = CaptureSource(*key)
+                self.sources[key] = source
+                self.source_order.append(source)
+            stream = CaptureStream(self, source, callback, owner, max_age)
+            source.streams.append(stream)
+            if self.thread is None:
+                self.time_start = time.perf_counter()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+        return stream
+
+    def removeStream(self, stream):
+        bSourceRemoved = False
+        with self.condition:
+            stream.bClosed = True
+            source = stream.source
+            if stream in source.streams:
+                if stream.pending_buffer is not None:
+                    source.releaseBuffer(stream.pending_buffer)
+                stream.releaseHeldFrame()
+                (stream.pending_frame, stream.pending_buffer) = (None, None)
+                source.streams.remove(stream)
+                if len(source.streams) == 0:
+                    del self.sources[(source.input_select, source.N_samples, source.bReadAsDDC)]
+                    self.source_order.remove(source)
+                    bSourceRemoved = True
+            self.condition.notify_all()
+        if bSourceRemoved and self.sl.device_io is not None:
+            # nobody wants its capture anymore, even if it is already running
+            self.sl.device_io.cancelRequestsFrom(source)
+
+    def getStatistics(self):
+        # returns (frames_captured, frames_delivered, device_busy_fraction):
+        # frames_delivered counts a frame once per stream which received it, and device_busy_fraction
+        # is the fraction of the time spent capturing and transferring frames
+        if self.time_start is None:
+            return (0, 0, 0.)
+        return (self.frames_captured, self.frames_delivered, self.time_busy/max(time.perf_counter() - self.time_start, 1e-9))
+
+    def nextSource(self, time_now):
+        # called with the lock held: returns (source, None) for the source to capture now,
+        # or (None, delay) when no capture is needed before delay seconds (None: until a stream takes a frame)
+        ready_sources = []
+        next_capture_time = None
+        for source in self.source_order:
+            capture_time = source.getNextCaptureTime()
+            if capture_time is None:
+                continue
+            if capture_time <= time_now:
+                ready_sources.append(source)
+            elif next_capture_time is None or capture_time < next_capture_time:
+                next_capture_time = capture_time
+        if len(ready_sources) == 0:
+            return (None, None if next_capture_time is None else next_capture_time - time_now)
+        # the logger's input doesn't need to be switched for this one
+        last_selector = getattr(self.sl, 'last_selector', None)
+        for source in ready_sources:
+            if self.sl.LOGGER_MUX[source.input_select] == last_selector:
+                break
+        else:
+            source = ready_sources[0]
+        # served in turn: goes to the end of the list
+        self.source_order.remove(source)
+        self.source_order.append(source)
+        return (source, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    (source, delay) = self.nextSource(time.perf_counter())
+                    if source is not None:
+                        break
+                    self.condition.wait(delay)
+                buffer = source.getBuffer()
+                owner = source.getOwner()
+                source.last_trigger_time = time.perf_counter()
+            try:
+                frame = self.capture(source, buffer, owner)
+            except CommsLoggeableError as e:
+                logging.error("Exception occurred", exc_info=True)
+                frame = None
+                time.sleep(self.ERROR_RETRY_PERIOD)
+            except CommsError as e:
+                # do not log exception (because it's simply an obvious follow-up to a previous one)
+                frame = None
+                time.sleep(self.ERROR_RETRY_PERIOD)
+            except Exception:
+                logging.error(traceback.format_exc())
+                frame = None
+                time.sleep(self.ERROR_RETRY_PERIOD)
+            with self.condition:
+                if frame is None:
+                    source.free_buffers.append(buffer)
+                else:
+                    self.frames_delivered += len(source.streams)
+                    source.deliver(frame, buffer)
+                self.condition.notify_all()
+
+    def capture(self, source, buffer, owner):
+        # same sequence as getADCdata(), into the source's buffer
+        sl = self.sl
+        if sl.device_io is not None:
+            return self.captureOnDeviceIOThread(source, buffer, owner)
+        # our own thread never holds the logger, so we can wait as long as needed
+        with sl.logger_arbiter.acquire(owner, PRIORITY_DISPLAY, timeout=None):
+            if len(source.streams) == 0:
+                # closed while we were waiting
+                return None
+            sl.setup_write(sl.LOGGER_MUX[source.input_select], source.N_samples)
+            trigger_time = time.perf_counter()
+            sl.trigger_write()
+            sl.wait_for_write()
+            if source.bReadAsDDC:
+                samples = sl.read_ddc_samples_from_DDR2(data_buffer=buffer)
+                ref_exp0 = None
+            else:
+                (samples, ref_exp0) = sl.read_adc_samples_from_DDR2(data_buffer=buffer)
+            read_time = time.perf_counter()
+        self.frames_captured += 1
+        self.time_busy += read_time - trigger_time
+        source.frame_count += 1
+        return CaptureFrame(source, source.frame_count, samples, ref_exp0, trigger_time, read_time)
+
+    def captureOnDeviceIOThread(self, source, buffer, owner):
+        # the GUI's device accesses all go through its I/O thread (see DeviceIOThread.py), the captures wait there in turn with the others,
+        # and the more urgent requests are executed between the chunks of the transfer.
+        # (imported here, since DeviceIOThread.py needs PyQt5 and the device layer otherwise doesn't)
+        from DeviceIOThread import LoggerCaptureRequest
+        request = LoggerCaptureRequest(source.input_select, source.N_samples, source.bReadAsDDC, PRIORITY_DISPLAY, owner=source, data_buffer=buffer, logger_owner=owner)
+        try:
+            result = self.sl.device_io.submit(request).result()
+        except concurrent.futures.CancelledError:
+            return None
+        if source.bReadAsDDC:
+            (samples, ref_exp0) = (result, None)
+        else:
+            (samples, ref_exp0) = result
+        self.frames_captured += 1
+        self.time_busy += request.read_time - request.trigger_time
+        source.frame_count += 1
+        return CaptureFrame(source, source.frame_count, samples, ref_exp0, request.trigger_time, request.read_time)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Reference phasors and filter taps of the software DDC (SuperLaserLand_JD_RP.frontend_DDC_processing()).
+#
+# Demodulating a capture of N samples needs exp(-j*2*pi*f_reference*n) for n in [0, N), which costs much more than the demodulation
+# and the filter themselves, and is the same for every capture as long as the DDC settings don't change. The displays capture at a fixed
+# length, so the kernels are computed once per (reference frequency, N, filter) and kept in a small LRU cache:
+#   (ref_exp, lpf, N_filter) = sl.ddc_kernels.getKernels(frequency_in_int, N, filter_select)
+# The set_ddc0_ref_freq(), set_ddc1_ref_freq() and set_ddc_filter() functions drop the entries of the settings they replace.
+# The arrays are shared by all the callers, so they are read-only.
+
+from __future__ import print_function
+import threading
+import collections
+
+import numpy as np
+
+FREQUENCY_MASK = (1 << 48) - 1     # the DDC frequencies are in units of fs/2**48, modulo 2**48
+
+def ddc_filter_taps(filter_select):
+    # returns (lpf, N_filter): the taps of the filter, and the number of samples to drop at the start of the filtered signal.
+    # There are two versions of the firmware in use: one uses a 20points boxcar filter,
+    # the other one uses a wider bandwidth filter, consisting of a cascade of a 2-pts boxcar, another 2-pts boxcar, and finally a 4-points boxcar.
+    if filter_select == 0:
+        N_filter = 16
+        lpf = np.convolve(np.ones(2, dtype=float)/2., np.ones(2, dtype=float)/2.)
+        lpf = np.convolve(np.ones(4, dtype=float)/4., lpf)
+    elif filter_select == 1:
+        N_filter = 20
+        lpf = np.convolve(np.ones(4, dtype=float)/4., np.ones(16, dtype=float)/16.)
+    elif filter_select == 2:
+        N_filter = 16+2
+        lpf = np.array([4533, 11833, 14589, 7610, -2628, -5400, -350, 3293, 1086, -1867, -1080, 956, 800, -462, -650, 338])/(2.**15-1)
+        lpf = np.convolve(np.ones(2, dtype=float)/2., lpf)
+    else:
+        raise ValueError('unknown DDC filter: {}'.format(filter_select))
+    return (lpf, N_filter)
+
+def reference_phasor(frequency_in_int, N, dtype=np.complex128):
+    # exp(-1j*2*pi*frequency_in_int/2**48*n) for n in [0, N).
+    # The phase is accumulated modulo 2**48 on integers, like the DDC's NCO, so that it stays exact for long captures
+    phase_in_int = (np.uint64(frequency_in_int & FREQUENCY_MASK) * np.arange(N, dtype=np.uint64)) & np.uint64(FREQUENCY_MASK)
+    return np.exp(-1j*2*np.pi/2**48 * phase_in_int.astype(np.float64)).astype(dtype)
+
+def fir_filter(x, lpf, N_filter, decimation=1):
+    # same as lfilter(lpf, 1, x)[N_filter:][::decimation], but only the output samples which are kept are computed.
+    # x and lpf should have matching precisions (complex64 and float32, or complex128 and float64), the output has the type of x
+    if decimation == 1:
+        return np.convolve(x, lpf)[N_filter:len(x)]
+    N_out = max(0, (len(x) - N_filter + decimation - 1) // decimation)
+    y = np.zeros(N_out, dtype=np.result_type(x, lpf))
+    for k in range(len(lpf)):
+        # the first N_filter-k samples are the zero initial state of the filter, as in lfilter()
+        first_sample = N_filter - k
+        if first_sample >= 0:
+            y += lpf[k] * x[first_sample:first_sample + N_out*decimation:decimation]
+        else:
+            N_skipped = (-first_sample + decimation - 1) // decimation
+            first_sample += N_skipped*decimation
+            y[N_skipped:] += lpf[k] * x[first_sample:first_sample + (N_out-N_skipped)*decimation:decimation]
+    return y
+
+class DDCKernelCache():
+    MAX_ENTRIES = 8
+    MAX_BYTES = 2**27   # the phasor of a full logger capture is 16 bytes per sample in complex128
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()     # least recently used first
+        self.number_of_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def getKernels(self, frequency_in_int, N, filter_select, dtype=np.complex128):
+        # returns (ref_exp, lpf, N_filter), see reference_phasor() and ddc_filter_taps(). lpf has the real type matching dtype
+        dtype = np.dtype(dtype)
+        key = (frequency_in_int & FREQUENCY_MASK, int(N), filter_select, dtype)
+        with self.lock:
+            kernels = self.entries.get(key)
+            if kernels is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return kernels
+            self.misses += 1
+
+        # computed without the lock, two threads which miss at the same time both compute the same kernels
+        ref_exp = reference_phasor(key[0], key[1], dtype)
+        (lpf, N_filter) = ddc_filter_taps(filter_select)
+        lpf = lpf.astype(ref_exp.real.dtype)
+        ref_exp.setflags(write=False)
+        lpf.setflags(write=False)
+        kernels = (ref_exp, lpf, N_filter)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = kernels
+                self.number_of_bytes += ref_exp.nbytes
+                while len(self.entries) > 1 and (len(self.entries) > self.MAX_ENTRIES or self.number_of_bytes > self.MAX_BYTES):
+                    self.number_of_bytes -= self.entries.popitem(last=False)[1][0].nbytes
+        return kernels
+
+    def invalidate(self, frequency_in_int=None, filter_select=None):
+        # drops the entries for this reference frequency and/or this filter, or all of them without arguments
+        with self.lock:
+            for key in list(self.entries):
+                if frequency_in_int is not None and key[0] != frequency_in_int & FREQUENCY_MASK:
+                    continue
+                if filter_select is not None and key[2] != filter_select:
+                    continue
+                self.number_of_bytes -= self.entries.pop(key)[0].nbytes
+
+    def getStatistics(self):
+        # returns (hits, misses, number_of_entries, number_of_bytes)
+        with self.lock:
+            return (self.hits, self.misses, len(self.entries), self.number_of_bytes)
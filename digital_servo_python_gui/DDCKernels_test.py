@@ -0,0 +1,53 @@
+import numpy as np
+from scipy.signal import lfilter
+
+from DDCKernels import DDCKernelCache, ddc_filter_taps, reference_phasor, fir_filter
+
+def test_fir_filter():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(1000) + 1j*rng.standard_normal(1000)
+    for filter_select in range(3):
+        (lpf, N_filter) = ddc_filter_taps(filter_select)
+        expected = lfilter(lpf, 1, x)[N_filter:]
+        assert(np.allclose(fir_filter(x, lpf, N_filter), expected))
+        for decimation in [2, 7, 64]:
+            assert(np.allclose(fir_filter(x, lpf, N_filter, decimation), expected[::decimation]))
+        # complex64 in, complex64 out
+        y = fir_filter(x.astype(np.complex64), lpf.astype(np.float32), N_filter, 3)
+        assert(y.dtype == np.complex64 and np.allclose(y, expected[::3], atol=1e-4))
+    # the outputs which depend on the initial state of the filter
+    (lpf, N_filter) = ddc_filter_taps(1)
+    assert(np.allclose(fir_filter(x, lpf, 5, 3), lfilter(lpf, 1, x)[5::3]))
+
+def test_kernel_cache():
+    cache = DDCKernelCache()
+    frequency_in_int = int(round(0.2 * 2**48))
+    (ref_exp, lpf, N_filter) = cache.getKernels(frequency_in_int, 1000, 2)
+    assert(np.allclose(ref_exp, np.exp(-1j*2*np.pi*frequency_in_int/2**48*np.arange(1000))))
+    # negative frequencies (as read back from the device) are the same as modulo 2**48
+    assert(cache.getKernels(frequency_in_int - 2**48, 1000, 2)[0] is ref_exp)
+    assert(not ref_exp.flags.writeable)
+    ref_exp64 = cache.getKernels(frequency_in_int, 1000, 2, np.complex64)[0]
+    assert(ref_exp64.dtype == np.complex64 and np.allclose(ref_exp64, ref_exp, atol=1e-6))
+    assert(cache.getStatistics()[:3] == (1, 2, 2))
+
+    cache.invalidate(filter_select=1)
+    assert(cache.getStatistics()[2] == 2)
+    cache.invalidate(frequency_in_int=frequency_in_int)
+    assert(cache.getStatistics()[2] == 0)
+
+    # least recently used first out
+    for N in range(100, 100 + cache.MAX_ENTRIES):
+        cache.getKernels(frequency_in_int, N, 0)
+    cache.getKernels(frequency_in_int, 100, 0)
+    cache.getKernels(frequency_in_int, 99, 0)
+    (hits, misses, number_of_entries, number_of_bytes) = cache.getStatistics()
+    assert(number_of_entries == cache.MAX_ENTRIES and (frequency_in_int, 101, 0, np.dtype(np.complex128)) not in cache.entries)
+    assert(number_of_bytes == sum(kernels[0].nbytes for kernels in cache.entries.values()))
+
+def test_reference_phasor_long_capture():
+    # the phase stays exact however long the capture is
+    frequency_in_int = 2**47 + 12345
+    N = 2**22
+    ref_exp = reference_phasor(frequency_in_int, N)
+    assert(abs(ref_exp[-1] - np.exp(-1j*2*np.pi*((frequency_in_int*(N-1)) % 2**48)/2**48)) < 1e-9)
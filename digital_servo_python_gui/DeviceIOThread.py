@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Worker thread which performs the device accesses on behalf of the GUI.
+# Requests are queued with submit() (or the helper functions below) and each one returns a concurrent.futures.Future,
+# so that the GUI thread never blocks on the socket, and background tasks (temperature control, auto-recover, etc)
+# can share the device safely with the widgets.
+#
+# Typical use from a widget:
+#   future = sl.device_io.read_register(address_uint32)
+#   future.add_done_callback(...)            # called from the I/O thread
+# or, to get the result back on the GUI thread:
+#   sl.device_io.submit(request, callback=self.displayValue)
+# The widgets use submit_request(sl, request, ...), which executes the request right away on the calling thread
+# when no I/O thread was started (stand-alone windows and tests).
+#
+# Requests are served by priority (PRIORITY_CRITICAL first), then in submission order.
+# Logger captures read the buffer in chunks, and the more urgent requests which arrive in the meantime
+# are executed between two chunks, so that a relock does not wait behind a 32k-samples display capture.
+# Requests submitted with an owner widget are cancelled when that widget is closed, including a capture which is already running.
+
+from __future__ import print_function
+import abc
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+import weakref
+import traceback
+import logging
+
+from PyQt5 import QtCore
+
+from RP_PLL import CommsError, CommsLoggeableError
+
+# Request priorities, lowest value is served first (the logger captures keep theirs in LoggerArbiter.py):
+PRIORITY_CRITICAL   = 0     # lock-critical writes (relock, auto-unlock, etc)
+PRIORITY_NORMAL     = 1     # register reads/writes from the widgets
+PRIORITY_DISPLAY    = 2     # captures which are only used for display
+
+class DeviceRequest(abc.ABC):
+    # Base class for the requests handled by DeviceIOThread. Subclasses implement execute(sl), which runs in the I/O thread.
+    def __init__(self, priority=PRIORITY_NORMAL, owner=None):
+        self.future = concurrent.futures.Future()
+        self.priority = priority
+        self.owner = owner          # the object which consumes the result, used by DeviceIOThread.cancelRequestsFrom()
+        self.bCancelled = False
+        self.between_chunks = None  # set by DeviceIOThread, runs the more urgent requests during long transfers
+
+    @abc.abstractmethod
+    def execute(self, sl):
+        # performs the device accesses, the return value is the result of the future
+        pass
+
+    def cancel(self):
+        # a request which is still queued is simply never executed,
+        # one which is already running is aborted at its next scheduling point (see checkpoint())
+        self.bCancelled = True
+        self.future.cancel()
+
+    def checkpoint(self):
+        # called by long requests between two parts of their work
+        if self.bCancelled:
+            raise concurrent.futures.CancelledError()
+        if self.between_chunks is not None:
+            self.between_chunks()
+            if self.bCancelled:
+                raise concurrent.futures.CancelledError()
+
+class RegisterWriteRequest(DeviceRequest):
+    def __init__(self, address_uint32, data_32bits, bSigned=False, priority=PRIORITY_NORMAL, owner=None):
+        super(RegisterWriteRequest, self).__init__(priority, owner)
+        self.address_uint32 = address_uint32
+        self.data_32bits = data_32bits
+        self.bSigned = bSigned
+
+    def execute(self, sl):
+        if self.bSigned:
+            sl.dev.write_Zynq_register_int32(self.address_uint32, self.data_32bits)
+        else:
+            sl.dev.write_Zynq_register_uint32(self.address_uint32, self.data_32bits)
+
+class RegisterReadRequest(DeviceRequest):
+    def __init__(self, address_uint32, bSigned=False, priority=PRIORITY_NORMAL, owner=None):
+        super(RegisterReadRequest, self).__init__(priority, owner)
+        self.address_uint32 = address_uint32
+        self.bSigned = bSigned
+
+    def execute(self, sl):
+        if self.bSigned:
+            return sl.dev.read_Zynq_register_int32(self.address_uint32)
+        else:
+            return sl.dev.read_Zynq_register_uint32(self.address_uint32)
+
+class LoggerCaptureRequest(DeviceRequest):
+    # Same sequence as XEM_GUI_MainWindow.getADCdata(): setup, trigger, wait, then read back the samples.
+    # The result is (samples_out, ref_exp0) for ADC/DAC captures, or the instantaneous frequency for DDC captures.
+    # The samples are read in chunks, with a scheduling point between each chunk.
+    # data_buffer and logger_owner are passed on to read_adc_samples_from_DDR2() and to the logger arbiter (see CapturePipeline.py)
+    def __init__(self, input_select, N_samples, bReadAsDDC=False, priority=PRIORITY_DISPLAY, owner=None, data_buffer=None, logger_owner='DeviceIOThread: capture'):
+        super(LoggerCaptureRequest, self).__init__(priority, owner)
+        self.input_select = input_select
+        self.N_samples = N_samples
+        self.bReadAsDDC = bReadAsDDC
+        self.data_buffer = data_buffer
+        self.logger_owner = logger_owner
+        self.trigger_time = None    # time.perf_counter() just before the trigger
+        self.read_time = None       # time.perf_counter() at the end of the transfer
+
+    def execute(self, sl):
+        # Wait for our turn on the DDR2 logger (raises LoggerBusyError, a CommsError, if it stays in use),
+        # and block access to any other function until we are done:
+        with sl.logger_arbiter.acquire(self.logger_owner, self.priority):
+            self.checkpoint()
+            sl.setup_write(sl.LOGGER_MUX[self.input_select], self.N_samples)
+            self.trigger_time = time.perf_counter()
+            sl.trigger_write()
+            sl.wait_for_write()
+            self.checkpoint()
+            if self.bReadAsDDC:
+                result = sl.read_ddc_samples_from_DDR2(between_chunks=self.checkpoint, data_buffer=self.data_buffer)
+            else:
+                result = sl.read_adc_samples_from_DDR2(between_chunks=self.checkpoint, data_buffer=self.data_buffer)
+            self.read_time = time.perf_counter()
+            return result
+
+class FileWriteRequest(DeviceRequest):
+    def __init__(self, strFilenameLocal, strFilenameRemote, priority=PRIORITY_NORMAL, owner=None):
+        super(FileWriteRequest, self).__init__(priority, owner)
+        self.strFilenameLocal = strFilenameLocal
+        self.strFilenameRemote = strFilenameRemote
+
+    def execute(self, sl):
+        sl.dev.write_file_on_remote(self.strFilenameLocal, self.strFilenameRemote)
+
+class FunctionCallRequest(DeviceRequest):
+    # runs any function (typically a SuperLaserLand_JD_RP method) in the I/O thread.
+    # use submit(request, priority=...) to change its priority, since the keyword arguments go to the function
+    def __init__(self, function, *args, **kwargs):
+        super(FunctionCallRequest, self).__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def execute(self, sl):
+        return self.function(*self.args, **self.kwargs)
+
+class InterruptibleCallRequest(FunctionCallRequest):
+    # same, for the long functions which take a between_chunks argument (see SuperLaserLand_JD_RP.capture_long()):
+    # they get the request's checkpoint(), so that the more urgent requests are executed in between, and the function is aborted
+    # (with a CancelledError) if the request gets cancelled
+    def execute(self, sl):
+        return self.function(*self.args, between_chunks=self.checkpoint, **self.kwargs)
+
+
+def execute_request(sl, request):
+    # runs the request on the calling thread, the outcome goes to its future
+    if not request.future.set_running_or_notify_cancel():
+        # cancelled before it could run
+        return
+    try:
+        result = request.execute(sl)
+    except Exception as e:
+        request.future.set_exception(e)
+    else:
+        request.future.set_result(result)
+
+def deliver_result(callback, future):
+    # calls callback with the result of a completed request, unless it failed because of the device or was cancelled
+    if future.cancelled():
+        return
+    try:
+        result = future.result()
+    except concurrent.futures.CancelledError:
+        # cancelled while it was running
+        return
+    except CommsLoggeableError as e:
+        logging.error(traceback.format_exc())
+        return
+    except CommsError as e:
+        return
+    callback(result)
+
+def submit_request(sl, request, callback=None, priority=None, owner=None):
+    # same as sl.device_io.submit(), but without an I/O thread the request is executed right away,
+    # and the callback called before we return
+    device_io = getattr(sl, 'device_io', None)
+    if device_io is not None:
+        return device_io.submit(request, callback, priority, owner)
+    if priority is not None:
+        request.priority = priority
+    if owner is not None:
+        request.owner = owner
+    execute_request(sl, request)
+    if callback is not None:
+        deliver_result(callback, request.future)
+    return request.future
+
+
+class DeviceIOThread(QtCore.QObject):
+
+    PRIORITY_STOP = PRIORITY_DISPLAY + 1    # the stop request is served after everything which was already queued
+
+    # emitted from the I/O thread, delivered on the GUI thread (queued connection)
+    resultReady = QtCore.pyqtSignal(object, object)
+    socketError = QtCore.pyqtSignal(object)
+
+    def __init__(self, sl, controller=None):
+        super(DeviceIOThread, self).__init__()
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':DeviceIOThread'
+
+        self.sl = sl
+        self.controller = controller
+        # holds (priority, sequence_number, request) tuples. The sequence number keeps the requests with the same priority in order
+        self.request_queue = queue.PriorityQueue()
+        self.sequence_number = itertools.count()
+        # the requests being executed: the one run by run(), then the urgent ones it runs at its scheduling points, innermost last
+        self.running_requests = []
+        self.watched_owners = weakref.WeakSet()
+
+        # socket errors are reported to us instead of directly to the controller,
+        # since the controller's reconnection logic needs to run on the GUI thread
+        self.sl.dev.controller = self
+        # the widgets find us there, see submit_request()
+        self.sl.device_io = self
+
+        self.resultReady.connect(self.deliverResult)
+        self.socketError.connect(self.controllerSocketErrorEvent)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.request_queue.put((self.PRIORITY_STOP, next(self.sequence_number), None))
+        self.thread.join()
+
+    def run(self):
+        while True:
+            (priority, sequence_number, request) = self.request_queue.get()
+            if request is None:
+                return
+            self.executeRequest(request)
+
+    @property
+    def current_request(self):
+        # the request which is actually executing, None if the thread is idle
+        running_requests = self.running_requests
+        return running_requests[-1] if running_requests else None
+
+    def executeRequest(self, request):
+        self.running_requests.append(request)
+        request.between_chunks = lambda: self.runUrgentRequests(request.priority)
+        try:
+            execute_request(self.sl, request)
+        finally:
+            request.between_chunks = None
+            self.running_requests.pop()
+
+    def runUrgentRequests(self, priority):
+        # scheduling point, called from inside a running request:
+        # executes the queued requests which have a strictly higher priority.
+        # Captures are left in the queue, since they need the logger which is currently in use.
+        while True:
+            try:
+                (next_priority, sequence_number, request) = self.request_queue.get_nowait()
+            except queue.Empty:
+                return
+            if next_priority >= priority or request is None or isinstance(request, LoggerCaptureRequest):
+                self.request_queue.put((next_priority, sequence_number, request))
+                return
+            self.executeRequest(request)
+
+    def submit(self, request, callback=None, priority=None, owner=None):
+        # returns the request's Future. If callback is given, it gets called on the GUI thread with the result
+        if priority is not None:
+            request.priority = priority
+        if owner is not None:
+            request.owner = owner
+        if isinstance(request.owner, QtCore.QObject) and request.owner not in self.watched_owners:
+            # cancel the requests of this widget when it gets closed
+            request.owner.installEventFilter(self)
+            self.watched_owners.add(request.owner)
+        if callback is not None:
+            request.future.add_done_callback(lambda f: self.resultReady.emit(callback, f))
+        self.request_queue.put((request.priority, next(self.sequence_number), request))
+        return request.future
+
+    def cancelRequestsFrom(self, owner):
+        # cancels all the queued requests of owner, and its running ones, including a request interrupted by urgent requests
+        with self.request_queue.mutex:
+            queued_requests = [request for (priority, sequence_number, request) in self.request_queue.queue if request is not None]
+        for request in queued_requests + list(self.running_requests):
+            if request.owner is owner:
+                request.cancel()
+
+    def eventFilter(self, obj, event):
+        if event.type() == QtCore.QEvent.Close:
+            self.cancelRequestsFrom(obj)
+        return False
+
+    def deliverResult(self, callback, future):
+        deliver_result(callback, future)
+
+    #######################################################
+    # Helper functions for the common requests
+    #######################################################
+
+    def write_register(self, address_uint32, data_32bits, bSigned=False, callback=None, priority=PRIORITY_NORMAL, owner=None):
+        return self.submit(RegisterWriteRequest(address_uint32, data_32bits, bSigned, priority, owner), callback)
+
+    def read_register(self, address_uint32, bSigned=False, callback=None, priority=PRIORITY_NORMAL, owner=None):
+        return self.submit(RegisterReadRequest(address_uint32, bSigned, priority, owner), callback)
+
+    def capture(self, input_select, N_samples, bReadAsDDC=False, callback=None, priority=PRIORITY_DISPLAY, owner=None):
+        return self.submit(LoggerCaptureRequest(input_select, N_samples, bReadAsDDC, priority, owner), callback)
+
+    def write_file(self, strFilenameLocal, strFilenameRemote, callback=None, priority=PRIORITY_NORMAL, owner=None):
+        return self.submit(FileWriteRequest(strFilenameLocal, strFilenameRemote, priority, owner), callback)
+
+    def call(self, function, *args, **kwargs):
+        return self.submit(FunctionCallRequest(function, *args, **kwargs))
+
+    #######################################################
+    # Socket errors
+    #######################################################
+
+    def socketErrorEvent(self, e):
+        # called by RP_PLL_device, from whichever thread hit the error
+        if self.controller is None:
+            # we are running in stand-alone mode
+            self.sl.dev.CloseTCPConnection()
+            raise CommsLoggeableError(e)
+
+        if threading.current_thread() is threading.main_thread():
+            self.controller.socketErrorEvent(e)
+        else:
+            self.sl.dev.valid_socket = False    # the controller will drop the socket, but other requests should fail right away
+            self.socketError.emit(e)
+            raise CommsLoggeableError(e)
+
+    def controllerSocketErrorEvent(self, e):
+        try:
+            self.controller.socketErrorEvent(e)
+        except CommsLoggeableError:
+            logging.error(traceback.format_exc())
@@ -0,0 +1,177 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from DeviceIOThread import DeviceIOThread, DeviceRequest, FunctionCallRequest, LoggerCaptureRequest, PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_DISPLAY
+from MonitorTCP_simulator_test import connect_to_simulator
+
+def test_abstract_request():
+    with pytest.raises(TypeError):
+        DeviceRequest()
+
+def test_requests_order():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        assert(sl.device_io is device_io)
+        # keeps the I/O thread busy while we queue the others
+        release = threading.Event()
+        blocker = device_io.submit(FunctionCallRequest(release.wait, 5.))
+
+        executed = []
+        def record(name):
+            executed.append((name, threading.current_thread()))
+            return name
+        futures = []
+        for (name, priority) in [('display', PRIORITY_DISPLAY), ('normal 1', PRIORITY_NORMAL), ('critical', PRIORITY_CRITICAL), ('normal 2', PRIORITY_NORMAL)]:
+            futures.append(device_io.submit(FunctionCallRequest(record, name), priority=priority))
+        # the DAC's current value follows its offset while the loop is open
+        write = device_io.write_register(sl.BUS_ADDR_DAC_offset[0]*4, 321)
+        read = device_io.read_register(sl.BUS_ADDR_DAC0_CURRENT*4, bSigned=True)
+        assert(not any(future.done() for future in futures))
+
+        release.set()
+        assert(blocker.result(timeout=5.))
+        assert([future.result(timeout=5.) for future in futures] == ['display', 'normal 1', 'critical', 'normal 2'])
+        # by priority, then in submission order, all on the I/O thread
+        assert([name for (name, thread) in executed] == ['critical', 'normal 1', 'normal 2', 'display'])
+        assert(all(thread is device_io.thread for (name, thread) in executed))
+        write.result(timeout=5.)
+        assert(read.result(timeout=5.) == 321)
+
+        # a failed request hands its exception to the caller, and the thread goes on
+        with pytest.raises(ZeroDivisionError):
+            device_io.call(lambda: 1/0).result(timeout=5.)
+        (samples, ref_exp0) = device_io.capture('ADC0', 2**12).result(timeout=10.)
+        assert(len(samples) == 2**12-9)
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_capture_pipeline_on_device_io():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        captured_on = []
+        capture = sl.capture_pipeline.captureOnDeviceIOThread
+        def recordingCapture(*args):
+            captured_on.append(threading.current_thread())
+            return capture(*args)
+        sl.capture_pipeline.captureOnDeviceIOThread = recordingCapture
+        stream = sl.capture_pipeline.addStream('ADC0', 2**12)
+        frames = [stream.takeFrame(timeout=10.) for k in range(3)]
+        stream.close()
+        assert([frame.frame_number for frame in frames] == [1, 2, 3])
+        assert(all(len(frame.samples) == 2**12-9 and frame.read_time > frame.trigger_time for frame in frames))
+        # the pipeline's thread only queues the captures
+        assert(len(captured_on) >= 3 and device_io.thread not in captured_on)
+        assert(sl.logger_arbiter.snapshot()['CapturePipeline']['grants'] >= 3)
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def wait_until_running(device_io, request, timeout=5.):
+    time_start = time.perf_counter()
+    while device_io.current_request is not request:
+        assert(time.perf_counter() - time_start < timeout)
+        time.sleep(1e-3)
+
+def test_critical_request_preempts_capture():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        # slow enough that the capture is still being read when the critical write arrives
+        sim.bandwidth = 2**17
+        capture = LoggerCaptureRequest('ADC0', 2**15)
+        device_io.submit(capture)
+        wait_until_running(device_io, capture)
+        display = device_io.submit(FunctionCallRequest(time.perf_counter), priority=PRIORITY_DISPLAY)
+        critical = device_io.submit(FunctionCallRequest(sl.set_dac_offset, 0, 789), priority=PRIORITY_CRITICAL)
+        critical.result(timeout=5.)
+        # served between two chunks of the capture, while the display request waits for it to end
+        assert(not capture.future.done() and not display.done())
+        (samples, ref_exp0) = capture.future.result(timeout=10.)
+        assert(len(samples) == 2**15-9)
+        assert(display.result(timeout=5.) > capture.read_time)
+        assert(sl.dev.read_many_int32([sl.BUS_ADDR_DAC0_CURRENT*4])[0] == 789)
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_cancel_requests_from_owner():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        sim.bandwidth = 2**17
+        owner = object()
+        capture = LoggerCaptureRequest('ADC0', 2**15, owner=owner)
+        device_io.submit(capture)
+        queued = device_io.capture('ADC1', 2**12, owner=owner)
+        other = device_io.capture('ADC1', 2**12)
+        wait_until_running(device_io, capture)
+        device_io.cancelRequestsFrom(owner)
+        # the running capture stops at its next chunk, the queued one never runs
+        with pytest.raises(concurrent.futures.CancelledError):
+            capture.future.result(timeout=5.)
+        assert(queued.cancelled())
+        # the logger was given back
+        sim.bandwidth = None
+        (samples, ref_exp0) = other.result(timeout=10.)
+        assert(len(samples) == 2**12-9)
+        assert(sl.logger_arbiter.holder is None)
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_cancel_interrupted_request():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        sim.bandwidth = 2**17
+        owner = object()
+        capture = LoggerCaptureRequest('ADC0', 2**15, owner=owner)
+        device_io.submit(capture)
+        wait_until_running(device_io, capture)
+        # an urgent request of another owner runs between two chunks of the capture
+        release = threading.Event()
+        urgent = FunctionCallRequest(release.wait, 5.)
+        device_io.submit(urgent, priority=PRIORITY_CRITICAL)
+        wait_until_running(device_io, urgent)
+        device_io.cancelRequestsFrom(owner)
+        release.set()
+        assert(urgent.future.result(timeout=5.))
+        # the capture is still cancelled, at its next chunk
+        with pytest.raises(concurrent.futures.CancelledError):
+            capture.future.result(timeout=5.)
+        assert(device_io.running_requests == [])
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_pipeline_cancels_removed_source():
+    (sim, sl) = connect_to_simulator()
+    device_io = DeviceIOThread(sl)
+    try:
+        sim.bandwidth = 2**17
+        stream = sl.capture_pipeline.addStream('ADC0', 2**15)
+        time_start = time.perf_counter()
+        while not isinstance(device_io.current_request, LoggerCaptureRequest):
+            assert(time.perf_counter() - time_start < 5.)
+            time.sleep(1e-3)
+        capture = device_io.current_request
+        assert(capture.owner is stream.source)
+        stream.close()
+        # nobody is left to take the frame: the capture is aborted
+        with pytest.raises(concurrent.futures.CancelledError):
+            capture.future.result(timeout=5.)
+    finally:
+        device_io.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
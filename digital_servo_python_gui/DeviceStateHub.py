@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Shared reads of the device status for all the windows.
+#
+# Each window used to read what it displays at each of its own refreshes: the status flags and LEDs from every
+# XEM_GUI_MainWindow.timerEvent(), the zero-deadtime counter and the DAC currents from every FreqErrorWindowWithTempControlV2,
+# so the register traffic grew with the number of windows open. Here, a snapshot of all these values is read in a single
+# transaction, and every window which asks for the device state within max_age of the last read gets that same snapshot:
+#   snapshot = sl.state_hub.getSnapshot(max_age=0.4)
+#   (LED_G0, LED_R0, LED_G1, LED_R1, LED_G2, LED_R2) = snapshot.leds()
+# With max_age a bit less than the refresh period of the windows, there is at most one read per period no matter how many windows
+# refresh at that rate.
+#
+# The counter samples which were updated between two snapshots are not lost: a window which needs all of them subscribes,
+#   subscription = sl.state_hub.subscribe(owner='CEO counter', callback=None)
+# and each snapshot read (by any window) adds its new counter records to the subscription, see takeCounterRecords(), which
+# returns them in the format of RP_PLL.CounterSubscription (records for sl.scale_counter_records()). The snapshot itself only costs
+# one round trip: the device's counter backlog (see read_counter_backlog()) is only read when more than one counter sample
+# was updated since the previous snapshot. The optional callback is called with each new snapshot, from the thread which read it.
+
+from __future__ import print_function
+import threading
+import time
+import collections
+import logging
+
+import numpy as np
+
+from RP_PLL import CommsError, CounterSubscription
+
+class DeviceStateSnapshot():
+    def __init__(self, snapshot_number, read_time, status_flags, counter_record, counter_records):
+        self.snapshot_number = snapshot_number  # counts the snapshots read by the hub
+        self.read_time = read_time              # time.perf_counter() at the end of the read
+        self.status_flags = status_flags        # BUS_ADDR_STATUS_FLAGS
+        self.counter_record = counter_record    # the current counter values, as one record of dtype CounterSubscription.RECORD_DTYPE
+        self.counter_records = counter_records  # the counter records which are new since the previous snapshot, oldest first
+        self.samples_number = int(counter_record['samples_number'][0])
+        dac2 = int(counter_record['dac2'][0])
+        if dac2 > 0xFFFF0000:   # greater than 16 bits, same as in read_dual_mode_counter()
+            dac2 = dac2 - 0xFFFF0000
+        self.dac_currents = (int(counter_record['dac0'][0]), int(counter_record['dac1'][0]), dac2)
+
+    def extractBit(self, N_bit):
+        return (self.status_flags >> N_bit) & 1
+
+    def statusFlags(self):
+        # same as SuperLaserLand_JD_RP.readStatusFlags(): (output0_has_data, output1_has_data, PipeA1FifoEmpty, crash_monitor_has_data)
+        return (self.extractBit(0) == 0, self.extractBit(1) == 0, self.extractBit(2), self.extractBit(3))
+
+    def leds(self):
+        # same as SuperLaserLand_JD_RP.readLEDs(): (LED_G0, LED_R0, LED_G1, LED_R1, LED_G2, LED_R2)
+        return tuple(self.extractBit(N_bit) for N_bit in range(4, 10))
+
+class DeviceStateSubscription():
+    MAX_PENDING_RECORDS = 2**16     # the oldest records are dropped beyond that, scale_counter_records() then reports them as dropped
+
+    def __init__(self, hub, owner, callback):
+        self.hub = hub
+        self.owner = owner
+        self.callback = callback
+        self.pending_records = collections.deque()
+        self.number_of_pending_records = 0
+        self.bClosed = False
+
+    def deliver(self, snapshot):
+        # called by the hub with its lock held
+        if len(snapshot.counter_records) > 0:
+            self.pending_records.append(snapshot.counter_records)
+            self.number_of_pending_records += len(snapshot.counter_records)
+            while self.number_of_pending_records - len(self.pending_records[0]) >= self.MAX_PENDING_RECORDS:
+                self.number_of_pending_records -= len(self.pending_records.popleft())
+
+    def takeCounterRecords(self):
+        # all the counter records read since the last call, oldest first
+        with self.hub.lock:
+            if len(self.pending_records) == 0:
+                return np.empty(0, dtype=CounterSubscription.RECORD_DTYPE)
+            records = np.concatenate(self.pending_records)
+            self.pending_records.clear()
+            self.number_of_pending_records = 0
+        return records
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+class DeviceStateHub():
+
+    def __init__(self, sl):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':DeviceStateHub'
+
+        self.sl = sl
+        self.lock = threading.RLock()
+        self.snapshot = None
+        self.subscriptions = []
+        self.last_samples_number = None
+        self.snapshots_read = 0
+        self.snapshots_requested = 0
+        self.backlog_reads = 0
+
+    def subscribe(self, owner='DeviceStateHub', callback=None):
+        subscription = DeviceStateSubscription(self, owner, callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscription.bClosed = True
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def getSnapshot(self, max_age=0.):
+        # the last snapshot if it was read less than max_age seconds ago, otherwise a new one.
+        # Concurrent callers wait for the read in progress instead of doing their own
+        with self.lock:
+            self.snapshots_requested += 1
+            if self.snapshot is None or time.perf_counter() - self.snapshot.read_time >= max_age:
+                self.publish(self.readSnapshot())
+            return self.snapshot
+
+    def getStatistics(self):
+        # returns (snapshots_read, snapshots_requested, backlog_reads)
+        with self.lock:
+            return (self.snapshots_read, self.snapshots_requested, self.backlog_reads)
+
+    def readSnapshot(self):
+        # called with the lock held
+        sl = self.sl
+        # the samples number register must stay first in the batch since reading it is what latches the counter values,
+        # see read_dual_mode_counter(), which also explains the second read of the samples number
+        while True:
+            with sl.dev.transaction() as t:
+                samples_number = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4)
+                counter0_lsbs = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS*4)
+                counter0_msbs = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_COUNTER0_MSBS*4)
+                counter1_lsbs = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS*4)
+                counter1_msbs = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_COUNTER1_MSBS*4)
+                dac0 = t.read_Zynq_register_int32(sl.BUS_ADDR_DAC0_CURRENT*4)
+                dac1 = t.read_Zynq_register_int32(sl.BUS_ADDR_DAC1_CURRENT*4)
+                dac2 = t.read_Zynq_register_uint32(sl.BUS_ADDR_DAC2_CURRENT*4)
+                status_flags = t.read_Zynq_register_uint32(sl.BUS_ADDR_STATUS_FLAGS*4)
+                samples_number_check = t.read_Zynq_register_uint32(sl.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4)
+            if samples_number_check.value == samples_number.value:
+                break
+        read_time = time.perf_counter()
+
+        counter_record = np.zeros(1, dtype=CounterSubscription.RECORD_DTYPE)
+        counter_record['samples_number'] = samples_number.value
+        counter_record['counter0'] = np.array((counter0_lsbs.value, counter0_msbs.value), dtype=np.uint32).view(np.int64)
+        counter_record['counter1'] = np.array((counter1_lsbs.value, counter1_msbs.value), dtype=np.uint32).view(np.int64)
+        counter_record['dac0'] = dac0.value
+        counter_record['dac1'] = dac1.value
+        counter_record['dac2'] = dac2.value
+
+        self.snapshots_read += 1
+        return DeviceStateSnapshot(self.snapshots_read, read_time, status_flags.value, counter_record, self.newCounterRecords(counter_record))
+
+    def newCounterRecords(self, counter_record):
+        # the counter records since the previous snapshot, called with the lock held
+        samples_number = int(counter_record['samples_number'][0])
+        if self.last_samples_number is None:
+            increments = 1
+            # monitor-tcp only starts filling the backlog once it is asked for, so that we find the samples we miss from now on
+            try:
+                self.sl.dev.read_counter_backlog(samples_number, 1)
+            except CommsError as e:
+                self.logger.warning('Red_Pitaya_GUI{}: could not read the counter backlog: {}'.format(self.logger_name, e))
+        else:
+            increments = (samples_number - self.last_samples_number) & 0xFFFFFFFF
+        if increments == 0:
+            return counter_record[:0]
+        records = counter_record
+        if increments > 1:
+            # we missed some samples since the previous snapshot: they are still in the device's backlog
+            try:
+                records = self.readCounterBacklog(self.last_samples_number + 1)
+                self.backlog_reads += 1
+                # the backlog can already hold newer samples, they will come with the next snapshot
+                records = records[((samples_number - records['samples_number'].astype(np.int64)) & 0xFFFFFFFF) < (1 << 31)]
+            except CommsError as e:
+                self.logger.warning('Red_Pitaya_GUI{}: could not read the counter backlog: {}'.format(self.logger_name, e))
+            if len(records) == 0 or int(records['samples_number'][-1]) != samples_number:
+                # the backlog is filled by polling, it can lag behind the registers we just read
+                records = np.concatenate((records, counter_record))
+        self.last_samples_number = int(records['samples_number'][-1])
+        return records
+
+    def readCounterBacklog(self, first_samples_number):
+        batches = []
+        while True:
+            records = self.sl.dev.read_counter_backlog(first_samples_number)
+            batches.append(records)
+            if len(records) < self.sl.dev.MAX_BACKLOG_RECORDS_PER_READ:
+                break
+            first_samples_number = int(records['samples_number'][-1]) + 1
+        return np.concatenate(batches)
+
+    def publish(self, snapshot):
+        # called with the lock held
+        self.snapshot = snapshot
+        for subscription in list(self.subscriptions):
+            subscription.deliver(snapshot)
+            if subscription.callback is not None:
+                subscription.callback(snapshot)
@@ -6,7 +6,7 @@ by JD Deschenes, October 2013
 from __future__ import print_function
 
 import time
-from PyQt5 import QtGui, Qt
+from PyQt5 import QtGui, Qt, QtCore
 #import PyQt5.Qwt5 as Qwt
 import numpy as np
 
@@ -14,6 +14,7 @@ import numpy as np
 #from SuperLaserLand_JD2 import SuperLaserLand_JD2
 from DisplayTransferFunctionWindow import DisplayTransferFunctionWindow
 import weakref
+from LoggerArbiter import LoggerBusyError, PRIORITY_NORMAL
 
 import sys # only used for sys.stdout.flush() because Syper's console sometimes doesn't show all print() outputs before crashing...
 
@@ -26,6 +27,7 @@ class DisplayVNAWindow(QtGui.QWidget):
     def __init__(self, sl=None):
         super(DisplayVNAWindow, self).__init__()
         self.sl = weakref.proxy(sl)
+        self.wait_loop = None   # runs while we wait for a system identification, see runSytemIdentification()
         self.initUI()
         
     def getSystemIdentificationSettings(self):
@@ -41,84 +43,18 @@ class DisplayVNAWindow(QtGui.QWidget):
 
     def runSytemIdentification(self):
     
-        # Check if another function is currently using the DDR2 logger:
-        if self.sl.bDDR2InUse:
-            print('DDR2 logger in use, cannot run identification')
+        # Wait for our turn on the DDR2 logger, and block access to any other function until we are done
+        # (the lease is released even if the measurement fails):
+        try:
+            lease = self.sl.logger_arbiter.acquire('DisplayVNAWindow: system identification', PRIORITY_NORMAL)
+        except LoggerBusyError as e:
+            print('DDR2 logger in use, cannot run identification (%s)' % e)
             return
-        # Block access to the DDR2 Logger to any other function until we are done:
-        self.sl.bDDR2InUse = True
-        
-        # Reset the bStop flag (which is set when the user presses the stop button)
-        self.bStop = False
-        # The dither will be stopped by sl.setup_system_identification()
-        self.qbtn_dither.setChecked(False)
-        
-        # Reset the progress bar
-        self.qprogress_ident.setValue(0)
-        
-        (input_select, output_select, first_modulation_frequency_in_hz, last_modulation_frequency_in_hz, number_of_frequencies, System_settling_time, output_amplitude) = self.readSystemIdentificationSettings()
-        
-        self.sl.setup_system_identification(input_select, output_select, first_modulation_frequency_in_hz, last_modulation_frequency_in_hz, number_of_frequencies, System_settling_time, output_amplitude)
-        total_wait_time = 0.1+1.3*self.sl.get_system_identification_wait_time()
-        print('Waiting for %f sec...\n' % total_wait_time)
-        
-        # If the wait time is to be > 1 minute, then give the chance to the user to cancel the action
-        if total_wait_time > 60:
-            reply = QtGui.QMessageBox.question(self, 'Long operation',
-                'Warning! The requested identification will take %.1f minute(s), are you sure you want to continue?' % (total_wait_time/60), QtGui.QMessageBox.Yes | 
-                QtGui.QMessageBox.No, QtGui.QMessageBox.No)
-            if reply == QtGui.QMessageBox.No:
-                self.sl.bDDR2InUse = False
-                return
-            
-        
-        self.sl.trigger_system_identification()
-        
-        
-        ## Wait until the transfer function measurement is finished, while updating the progress bar:
-        start_time = time.perf_counter()
-        if total_wait_time > 0.1:
-            # Split the wait time in chunks, updating the progress bar every time
-            # TODO.
-            # Should implement the wait not as time.sleep(). but by recording the start time, and updating the display
-            # while we wait, because sleep() will freeze the GUI. Not the best solution anyway but it shouldn't be that bad
-            # especially if we havea nicely updated progress bar.
-#            time.sleep(total_wait_time)
-            qapp = QtGui.QApplication.instance()
-            
-            while (time.perf_counter()-start_time < total_wait_time) and self.bStop == False:
-                self.qprogress_ident.setValue(  100 * (time.perf_counter()-start_time)/total_wait_time )
-#                self.qprogress_ident.update()
-                self.qprogress_ident.repaint()
-                qapp.processEvents()
-#                print('Updating')
-                time.sleep(20e-3)
-        else:
-            # Wait time is low enough to just use sleep() without giving the impression that the GUI has crashed.
-            time.sleep(total_wait_time)
-        
-        if self.bStop == True:
-            # Operation was cancelled by user
-            self.sl.bDDR2InUse = False
-            self.bStop = False
-            self.qprogress_ident.setValue(0)
-            self.sl.setVNA_mode_register(0, 1, 0)
+        with lease:
+            result = self.measureTransferFunction()
+        if result is None:
             return
-            
-        #print('runSytemIdentification(): before read')
-        ## Read out the results from the FPGA:
-        try:
-            (transfer_function_complex, frequency_axis) = self.sl.read_VNA_samples_from_DDR2()
-            # print('len(transfer_function_complex) = %d, len(frequency_axis) = %d' % (len(transfer_function_complex), len(frequency_axis)))
-            # print(np.real(transfer_function_complex))
-            # print(np.imag(transfer_function_complex))
-        except:
-            self.sl.bDDR2InUse = False
-            print("Exception reading VNA samples from DDR2")
-            raise
-            
-        # Signal to other functions that they can use the DDR2 logger
-        self.sl.bDDR2InUse = False
+        (transfer_function_complex, frequency_axis) = result
 
         #print('runSytemIdentification(): after read')
         
@@ -186,6 +122,75 @@ class DisplayVNAWindow(QtGui.QWidget):
         
 
         
+    def measureTransferFunction(self):
+        # runs the system identification, while holding the logger.
+        # returns (transfer_function_complex, frequency_axis), or None if it was cancelled
+        
+        # Reset the bStop flag (which is set when the user presses the stop button)
+        self.bStop = False
+        # The dither will be stopped by sl.setup_system_identification()
+        self.qbtn_dither.setChecked(False)
+        
+        # Reset the progress bar
+        self.qprogress_ident.setValue(0)
+        
+        (input_select, output_select, first_modulation_frequency_in_hz, last_modulation_frequency_in_hz, number_of_frequencies, System_settling_time, output_amplitude) = self.readSystemIdentificationSettings()
+        
+        self.sl.setup_system_identification(input_select, output_select, first_modulation_frequency_in_hz, last_modulation_frequency_in_hz, number_of_frequencies, System_settling_time, output_amplitude)
+        total_wait_time = self.sl.get_system_identification_wait_time()
+        print('Waiting for %f sec...\n' % total_wait_time)
+        
+        # If the wait time is to be > 1 minute, then give the chance to the user to cancel the action
+        if total_wait_time > 60:
+            reply = QtGui.QMessageBox.question(self, 'Long operation',
+                'Warning! The requested identification will take %.1f minute(s), are you sure you want to continue?' % (total_wait_time/60), QtGui.QMessageBox.Yes | 
+                QtGui.QMessageBox.No, QtGui.QMessageBox.No)
+            if reply == QtGui.QMessageBox.No:
+                return None
+            
+        
+        self.sl.trigger_system_identification()
+        
+        
+        ## Wait until the transfer function measurement is finished, while updating the progress bar:
+        # the future is done as soon as the VNA has written its last record (or if stopClicked() aborts the wait),
+        # and the GUI keeps running in a local event loop in the meantime
+        future = self.sl.wait_for_system_identification_async()
+        if total_wait_time > 0.1:
+            self.wait_loop = QtCore.QEventLoop()
+            wait_loop = self.wait_loop
+            future.add_done_callback(lambda f: QtCore.QMetaObject.invokeMethod(wait_loop, 'quit', QtCore.Qt.QueuedConnection))
+            progress_timer = QtCore.QTimer()
+            progress_timer.timeout.connect(self.updateIdentificationProgress)
+            progress_timer.start(100)
+            if not future.done():
+                self.wait_loop.exec_()
+            progress_timer.stop()
+            self.wait_loop = None
+        else:
+            # Wait time is low enough to just block without giving the impression that the GUI has crashed.
+            future.result()
+        
+        if self.bStop == True:
+            # Operation was cancelled by user
+            self.bStop = False
+            self.qprogress_ident.setValue(0)
+            self.sl.setVNA_mode_register(0, 1, 0)
+            return None
+            
+        #print('runSytemIdentification(): before read')
+        ## Read out the results from the FPGA:
+        try:
+            (transfer_function_complex, frequency_axis) = self.sl.read_VNA_samples_from_DDR2()
+            # print('len(transfer_function_complex) = %d, len(frequency_axis) = %d' % (len(transfer_function_complex), len(frequency_axis)))
+            # print(np.real(transfer_function_complex))
+            # print(np.imag(transfer_function_complex))
+        except:
+            print("Exception reading VNA samples from DDR2")
+            raise
+            
+        return (transfer_function_complex, frequency_axis)
+
     def readSystemIdentificationSettings(self):
         # Input select
         try:
@@ -285,8 +290,19 @@ class DisplayVNAWindow(QtGui.QWidget):
         
     def stopClicked(self):
         self.bStop = True   # This signals the waiting loop to cancel the operation
+        self.sl.abort_logger_wait()
+        if self.wait_loop is not None:
+            self.wait_loop.quit()
         return
         
+    def updateIdentificationProgress(self):
+        # the logger counts the samples written by the VNA, which is a better measure of the progress than the elapsed time
+        try:
+            samples_written = self.sl.read_logger_samples_written()
+        except Exception:
+            return
+        self.qprogress_ident.setValue(min(100, 100 * samples_written/max(self.sl.Num_samples_write, 1)))
+        
     def ditherClicked(self):
         # Check if dither is set, then call 
 #        setVNA_mode_register(self, trigger_dither, stop_flag, bSquareWave):
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Background readout of the dither lock-ins, which measure the VCO gain.
+#
+# The lock-in of each DAC with its dither enabled produces one result per integration period (N_periods periods of the
+# modulation). XEM_GUI_MainWindow.timerDitherEvent() used to read two results per refresh and display their mean, which blocked
+# the display on the device and gave a noisy estimate, since both reads usually returned the same integration anyway.
+# Here, a worker thread reads the lock-ins of all the enabled dithers in a single batch once per integration period, and keeps
+# the last WINDOW_SIZE results of each DAC for their running mean and standard deviation. The outliers (glitches of the lock-in,
+# or a read which straddles two integrations) are counted but left out of the statistics.
+# The display only asks for the current estimate, which never waits for the device:
+#   (VCO_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers) = sl.dither_sampler.getVCOGainEstimate(dac_number)
+# The statistics start over when the dither settings of that DAC change.
+# The worker is stopped with the communication (XEM_GUI3.controller.stopCommunication()), the display starts it again.
+
+from __future__ import print_function
+import threading
+import collections
+import logging
+
+import numpy as np
+
+from RP_PLL import CommsError
+
+class DitherStatistics():
+    # lock-in results of one DAC, in raw counts. Only used with the sampler's lock held
+
+    WINDOW_SIZE = 100           # number of results in the running statistics
+    MIN_RESULTS_FOR_OUTLIERS = 5
+    OUTLIER_THRESHOLD = 6.      # in robust standard deviations (from the median absolute deviation) away from the median
+
+    def __init__(self, settings):
+        self.settings = settings    # the dither settings these results were obtained with
+        self.results = collections.deque(maxlen=self.WINDOW_SIZE)
+        self.last_result = None
+
+    def add(self, result):
+        # returns False for the results which are not new (same integration as the previous read) and for the first one
+        if result == self.last_result:
+            return False
+        bFirstResult = (self.last_result is None)
+        self.last_result = result
+        if bFirstResult:
+            # its integration might have started before the settings changed
+            return False
+        self.results.append(result)
+        return True
+
+    def getStatistics(self):
+        # (mean, std, N_results, N_outliers) of the results in the window, mean and std are None without results.
+        # The outliers are found against the median of the window, so that they can't bias the reference they are compared to
+        results = np.array(self.results, dtype=np.float64)
+        N_outliers = 0
+        if len(results) >= self.MIN_RESULTS_FOR_OUTLIERS:
+            median = np.median(results)
+            robust_std = 1.4826*np.median(np.abs(results - median))
+            if robust_std > 0:
+                bValid = np.abs(results - median) <= self.OUTLIER_THRESHOLD*robust_std
+                N_outliers = len(results) - np.count_nonzero(bValid)
+                results = results[bValid]
+        if len(results) == 0:
+            return (None, None, 0, N_outliers)
+        return (np.mean(results), np.std(results), len(results), N_outliers)
+
+class DitherSampler():
+
+    NUMBER_OF_DITHERS = 2       # there is no dither on DAC2
+    MIN_READ_PERIOD = 10e-3     # shorter integrations are only subsampled, in seconds
+    IDLE_PERIOD = 0.1           # in seconds, when no dither is enabled
+    ERROR_RETRY_PERIOD = 0.5
+    CONFIDENCE_LEVEL_IN_STD = 1.96  # 95 % confidence interval on the mean, the results of consecutive integrations are independent
+
+    def __init__(self, sl):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':DitherSampler'
+
+        self.sl = sl
+        self.lock = threading.Lock()
+        self.statistics = [DitherStatistics(None) for k in range(self.NUMBER_OF_DITHERS)]
+        self.thread = None
+        self.bStop = threading.Event()
+        self.reads = 0
+        self.bCommsError = False    # the read failures are only logged once, until a read succeeds again
+
+    def start(self):
+        # the worker is also started by the first getStatistics() or getVCOGainEstimate()
+        with self.lock:
+            if self.thread is None:
+                # each worker has its own stop event, so that a worker which is still finishing its read after stop(bWait=False)
+                # can't be revived by the next start()
+                self.bStop = threading.Event()
+                self.thread = threading.Thread(target=self.run, args=(self.bStop,), daemon=True)
+                self.thread.start()
+
+    def stop(self, bWait=True):
+        # with bWait=False, the worker exits after its current read. This is needed when the caller might hold the device's lock,
+        # for example on a socket error, which can even be raised by the worker itself
+        with self.lock:
+            (thread, bStop) = (self.thread, self.bStop)
+            self.thread = None
+        if thread is not None:
+            bStop.set()
+            if bWait and thread is not threading.current_thread():
+                thread.join()
+
+    def getSettings(self, dac_number):
+        sl = self.sl
+        return (sl.dither_enable[dac_number], sl.modulation_period_divided_by_4_minus_one[dac_number],
+                sl.N_periods_integration_minus_one[dac_number], sl.dither_amplitude[dac_number])
+
+    def getIntegrationTime(self, dac_number):
+        # in seconds, also the time between two lock-in results
+        sl = self.sl
+        return 4*(sl.modulation_period_divided_by_4_minus_one[dac_number]+1) * (sl.N_periods_integration_minus_one[dac_number]+1) / sl.fs
+
+    def getStatistics(self, dac_number):
+        # (mean, std, N_results, N_outliers) of the lock-in results of DAC #dac_number, in raw counts.
+        # mean and std are None until the first result is read
+        self.start()
+        with self.lock:
+            statistics = self.statistics[dac_number]
+            if statistics.settings != self.getSettings(dac_number):
+                return (None, None, 0, 0)
+            return statistics.getStatistics()
+
+    def getVCOGainEstimate(self, dac_number):
+        # (VCO_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers): the VCO gain is in [VCO_gain - confidence_interval,
+        # VCO_gain + confidence_interval] with 95 % confidence. VCO_gain_in_Hz_per_Volts is None until the first result is read
+        (mean, std, N_results, N_outliers) = self.getStatistics(dac_number)
+        if mean is None:
+            return (None, None, N_results, N_outliers)
+        # There is an implicit (-) sign because the DDC has to shift the frequency to 0.
+        # This means that the detected gain will be positive when the VCO sign checkbox is correctly tuned
+        (VCO_gain_in_Hz_per_Volts, std_in_Hz_per_Volts) = self.sl.scaleDitherResultsToHzPerVolts(np.array((-mean, std)), dac_number)
+        confidence_interval = self.CONFIDENCE_LEVEL_IN_STD*abs(std_in_Hz_per_Volts)/np.sqrt(N_results)
+        return (VCO_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers)
+
+    def readResults(self, dac_numbers):
+        # lock-in results of dac_numbers, all read in a single batch
+        sl = self.sl
+        addresses = []
+        for dac_number in dac_numbers:
+            if dac_number == 0:
+                addresses.extend((sl.BUS_ADDR_DITHER0_LOCKIN_REAL_LSB*4, sl.BUS_ADDR_DITHER0_LOCKIN_REAL_MSB*4))
+            else:
+                addresses.extend((sl.BUS_ADDR_DITHER1_LOCKIN_REAL_LSB*4, sl.BUS_ADDR_DITHER1_LOCKIN_REAL_MSB*4))
+        return sl.dev.read_many_uint32(addresses).view(np.int64)
+
+    def run(self, bStop):
+        while not bStop.is_set():
+            with self.lock:
+                settings = [self.getSettings(dac_number) for dac_number in range(self.NUMBER_OF_DITHERS)]
+                for dac_number in range(self.NUMBER_OF_DITHERS):
+                    if self.statistics[dac_number].settings != settings[dac_number]:
+                        self.statistics[dac_number] = DitherStatistics(settings[dac_number])
+            dac_numbers = [dac_number for dac_number in range(self.NUMBER_OF_DITHERS) if settings[dac_number][0]]
+            if len(dac_numbers) == 0:
+                bStop.wait(self.IDLE_PERIOD)
+                continue
+            # the lock-ins produce a result per integration period, reading faster would only read the same ones again
+            read_period = max(self.MIN_READ_PERIOD, min(self.getIntegrationTime(dac_number) for dac_number in dac_numbers))
+            try:
+                results = self.readResults(dac_numbers)
+            except CommsError as e:
+                if not self.bCommsError:
+                    self.logger.warning('Red_Pitaya_GUI{}: could not read the dither lock-ins: {}'.format(self.logger_name, e))
+                    self.bCommsError = True
+                bStop.wait(self.ERROR_RETRY_PERIOD)
+                continue
+            with self.lock:
+                self.bCommsError = False
+                self.reads += 1
+                for (dac_number, result) in zip(dac_numbers, results):
+                    statistics = self.statistics[dac_number]
+                    # results read with the previous settings are dropped
+                    if statistics.settings == settings[dac_number]:
+                        statistics.add(int(result))
+            bStop.wait(read_period)
@@ -24,15 +24,23 @@ import sys
 import AsyncSocketComms
 
 import weakref
+import concurrent.futures
 
 # stuff for Python 3 port
 import pyqtgraph as pg
 import logging
 
 from SocketErrorLogger import logCommsErrorsAndBreakoutOfFunction
+from DeviceIOThread import FunctionCallRequest, submit_request, PRIORITY_CRITICAL, PRIORITY_DISPLAY
 
 class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
 
+    REFRESH_PERIOD = 0.5    # in seconds
+    SHARED_DATA_AGE_FRACTION = 0.8  # a device state snapshot younger than this fraction of the refresh period is reused, see DeviceStateHub.py
+
+    # emitted from the temperature controller's thread, delivered on the GUI thread (queued connection)
+    temperatureSetpointResult = QtCore.pyqtSignal(object)
+
     def __init__(self, sl, strTitle, sp, output_number=0, strNameTemplate='', custom_style_sheet='', port_number=0, xem_gui_mainwindow=0):
         super(FreqErrorWindowWithTempControlV2, self).__init__()
 
@@ -48,6 +56,15 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
         self.sp = sp
         self.timerID = None
         self.client = None
+        # the writes to the temperature controller's socket, one at a time and in order, see sendTemperatureSetpoint()
+        self.temp_control_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.temperatureSetpointResult.connect(self.temperatureSetpointSent)
+        # our last read of the counters through the I/O thread, see timerEvent()
+        self.counter_read = None
+        # the lock to unlock transition in progress, see checkAutoUnlock()
+        self.auto_unlock = None
+        # every counter sample, from the snapshots read by any window
+        self.counter_subscription = self.sl.state_hub.subscribe(owner=strTitle)
         self.bIncrementalOnly = False
         
         # Need to pass xem_gui_window as a parameter (to control DAC offset)
@@ -146,7 +163,13 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
 
     def startTimers(self):
         # print("startTimers(): %s" % self.strTitle)
-        self.timerID = self.startTimer(500)
+        if self.counter_subscription.bClosed:
+            # closed with the window, see closeEvent()
+            self.counter_subscription = self.sl.state_hub.subscribe(owner=self.strTitle)
+        else:
+            # the records which came while we were stopped would all be displayed at once
+            self.counter_subscription.takeCounterRecords()
+        self.timerID = self.startTimer(int(round(1e3*self.REFRESH_PERIOD)))
 
     def killTimers(self):
         
@@ -214,6 +237,13 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
         self.bValid_counters = (np.zeros(self.N_history_counters) == 1)
         self.bValid_dacs = (np.zeros(self.N_history_dacs) == 1)
         self.bVeryFirst = True
+        # the pending records belong to the previous history
+        self.counter_subscription.takeCounterRecords()
+
+    def closeEvent(self, event):
+        # otherwise the hub keeps queuing the counter records for us, startTimers() subscribes again
+        self.counter_subscription.close()
+        super(FreqErrorWindowWithTempControlV2, self).closeEvent(event)
             
     def openOutputFiles(self):
         
@@ -473,7 +503,11 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
         self.qchk_triangular.setChecked(self.sl.bTriangularAveraging)
         self.qchk_triangular.blockSignals(False)
         
-        self.displayFreqCounter()
+        if self.counter_read is not None and not self.counter_read.done():
+            # the I/O thread hasn't got to our previous read yet, the new samples will come with it
+            return
+        # the device is read by the I/O thread (see DeviceIOThread.py), and displayFreqCounter() gets called back on our thread
+        self.counter_read = submit_request(self.sl, FunctionCallRequest(self.readFreqCounter), callback=self.displayFreqCounter, priority=PRIORITY_DISPLAY, owner=self)
         
         return
 
@@ -560,22 +594,12 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                         
                         self.last_update = time.perf_counter()
 
-                        try:                        
-                            print('Sending a new setpoint: %f degrees' % self.setpoint_change)
-                            self.logger.debug('Red_Pitaya_GUI{}: Sending a new setpoint : {} degrees'.format(self.logger_name, self.setpoint_change))
-                            if self.bIncrementalOnly:
-                                self.client.send_text('%f\n' % delta_temperature)
-                            else:
-                                self.client.send_text('%f\n' % self.setpoint_change)
-                        except:
-                            e = sys.exc_info()[0]
-                            # If we get here, this probably means that the TCP connection to the temperature controller was lost.
-                            self.closeTCPConnection()
-                            print('Exception occurred sending the new temperature setpoint.')
-                            print(str(e))
-                            self.logger.warning('Red_Pitaya_GUI{}: Exception occurred sending the new temperature setpoint. Connection probably lost. {}'.format(self.logger_name, str(e)))
-                            
-#                            raise
+                        print('Sending a new setpoint: %f degrees' % self.setpoint_change)
+                        self.logger.debug('Red_Pitaya_GUI{}: Sending a new setpoint : {} degrees'.format(self.logger_name, self.setpoint_change))
+                        if self.bIncrementalOnly:
+                            self.sendTemperatureSetpoint('%f\n' % delta_temperature)
+                        else:
+                            self.sendTemperatureSetpoint('%f\n' % self.setpoint_change)
                         return
                     
                 else:
@@ -588,16 +612,9 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                 ### -> Was removed, the Laser Controller GUI only keeps the lastest value in memory    
                 if self.qchk_clear_temp_control.isChecked() == True:
                     self.setpoint_change = 0.
-                    try:
-                        print('Clearing Temperature Control')
-                        self.client.send_text('%f\n' % self.setpoint_change)
-                        self.qchk_clear_temp_control.setChecked(False)
-                    except:
-                        e = sys.exc_info()[0]
-                        # If we get here, this probably means that the TCP connection to the temperature controller was lost.
-                        print('Exception occurred sending the new temperature setpoint.')
-                        print(str(e))
-                        self.client = None
+                    print('Clearing Temperature Control')
+                    self.sendTemperatureSetpoint('%f\n' % self.setpoint_change)
+                    self.qchk_clear_temp_control.setChecked(False)
                 else:
                     return
             else:   # self.client == None
@@ -609,6 +626,29 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
        # else:
 #            print('Temp control disactivated.')
 
+    def sendTemperatureSetpoint(self, text):
+        # the socket to the temperature controller is written by a thread of its own, so that a stalled connection
+        # neither blocks the GUI nor delays the device requests of the I/O thread
+        future = self.temp_control_executor.submit(self.sendTextToTempControl, self.client, text)
+        future.add_done_callback(lambda f: self.temperatureSetpointResult.emit(f.result()))
+
+    def sendTextToTempControl(self, client, text):
+        # runs in temp_control_executor's thread. Returns None, or the exception if the text couldn't be sent
+        try:
+            client.send_text(text)
+        except Exception as e:
+            return e
+        return None
+
+    def temperatureSetpointSent(self, e):
+        if e is None:
+            return
+        # If we get here, this probably means that the TCP connection to the temperature controller was lost.
+        self.closeTCPConnection()
+        print('Exception occurred sending the new temperature setpoint.')
+        print(str(e))
+        self.logger.warning('Red_Pitaya_GUI{}: Exception occurred sending the new temperature setpoint. Connection probably lost. {}'.format(self.logger_name, str(e)))
+
     @logCommsErrorsAndBreakoutOfFunction(((np.nan, np.nan)))
     def runAutoRecover(self, output_number, current_dac):
         # Try to read the lock state
@@ -632,11 +672,14 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                 rec_threshold = float(self.qedit_rec_thresh.text())
                 if np.abs(current_dac - dac_mean) > rec_threshold*dac_std:
                 # If the current DAC value is out of bounds, relock to the average
-                    self.sl.set_dac_offset(output_number, int(dac_mean))
-                    self.xem_gui_mainwindow.qloop_filters[output_number].qchk_lock.setChecked(False)
-                    self.xem_gui_mainwindow.qloop_filters[output_number].updateFilterSettings()
-                    self.xem_gui_mainwindow.qloop_filters[output_number].qchk_lock.setChecked(True)
-                    self.xem_gui_mainwindow.qloop_filters[output_number].updateFilterSettings()
+                    loop_filter = self.xem_gui_mainwindow.qloop_filters[output_number]
+                    loop_filter.qchk_lock.setChecked(False)
+                    unlocked_design = loop_filter.getActualControllerDesign()
+                    loop_filter.qchk_lock.setChecked(True)
+                    locked_design = loop_filter.getActualControllerDesign()
+                    # the writes go ahead of everything else queued in the I/O thread, including the display captures (see DeviceIOThread.py)
+                    submit_request(self.sl, FunctionCallRequest(self.relock, output_number, int(dac_mean), loop_filter, unlocked_design, locked_design),
+                        priority=PRIORITY_CRITICAL, owner=loop_filter)
                     print("{}: channel {} lost lock".format(time.strftime('%c'),output_number))
                 else:
                 # If the current DAC value is in bounds, add it to the DAC history
@@ -655,6 +698,12 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
             # Return NANs for plotting
             return (np.nan, np.nan)
 
+    def relock(self, output_number, dac_offset, loop_filter, unlocked_design, locked_design):
+        # runs in the I/O thread: moves the DAC offset to dac_offset, and clears the loop filter by unlocking and locking it again
+        self.sl.set_dac_offset(output_number, dac_offset)
+        loop_filter.writeFilterSettings(unlocked_design)
+        loop_filter.writeFilterSettings(locked_design)
+
     def checkAutoUnlock(self, output_number, DAC_output):
         # Try to read the lock state
         try:
@@ -668,15 +717,48 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
 
             if DAC_output < unlock_threshold or DAC_output > 1-unlock_threshold:
                 # If the current DAC value is out of bounds, we unlock
-                self.xem_gui_mainwindow.qchk_lock.setChecked(False)
-                self.xem_gui_mainwindow.chkLockClickedEvent()
+                if self.auto_unlock is not None and not self.auto_unlock.done():
+                    # already on its way
+                    return
+                # the loop is opened by the I/O thread ahead of everything else queued there (see DeviceIOThread.py),
+                # then the main window does the rest of the lock to unlock transition
+                loop_filter = self.xem_gui_mainwindow.qloop_filters[output_number]
+                unlocked_design = loop_filter.getActualControllerDesign()[:5] + (False,)
+                if output_number == 1:
+                    integrator_settings = loop_filter.getIntegratorSettings(bModeOff=True)
+                else:
+                    integrator_settings = None
+                self.auto_unlock = submit_request(self.sl, FunctionCallRequest(self.unlock, loop_filter, unlocked_design, integrator_settings),
+                    callback=self.finishAutoUnlock, priority=PRIORITY_CRITICAL, owner=loop_filter)
                 print("{}: channel {} lost lock. Doing lock to unlock transition".format(time.strftime('%c'),output_number))
                 self.logger.critical('Red_Pitaya_GUI{}: Channel {} lost lock. DAC too close to the rail.'.format(self.logger_name, output_number))
                 # logger.warning("{}: channel {} lost lock. Doing lock to unlock transition".format(time.strftime('%c'),output_number))
    
+    def readFreqCounter(self):
+        # runs in the I/O thread, returns (freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output) for displayFreqCounter()
+        # the other windows might already have read the device state during this refresh period
+        snapshot = self.sl.state_hub.getSnapshot(max_age=self.SHARED_DATA_AGE_FRACTION*self.REFRESH_PERIOD)
+        # all the counter samples since our last refresh, so none are dropped when we are late
+        records = self.counter_subscription.takeCounterRecords()
+        (freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output) = self.sl.scale_counter_records(records, self.output_number)
+        if freq_counter_samples is None:
+            # no new counter sample, only the current DAC values, like read_dual_mode_counter()
+            (DAC0_output, DAC1_output, DAC2_output) = [np.array((dac_current,)) for dac_current in snapshot.dac_currents]
+        return (freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output)
+
+    def unlock(self, loop_filter, unlocked_design, integrator_settings):
+        # runs in the I/O thread
+        loop_filter.writeFilterSettings(unlocked_design)
+        if integrator_settings is not None:
+            loop_filter.writeIntegratorSettings(integrator_settings)
+
+    def finishAutoUnlock(self, result):
+        self.xem_gui_mainwindow.qchk_lock.setChecked(False)
+        self.xem_gui_mainwindow.chkLockClickedEvent()
+
     @logCommsErrorsAndBreakoutOfFunction()
-    def displayFreqCounter(self):
-        (freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output) = self.sl.read_dual_mode_counter(self.output_number)
+    def displayFreqCounter(self, counter_data):
+        (freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output) = counter_data
         # print(freq_counter_samples, time_axis, DAC0_output, DAC1_output, DAC2_output)
         # try:
             
@@ -705,7 +787,7 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                 if self.output_number == 0:
                 # Run auto recovery for DAC0
                     dac_mean, dac_thrsh = self.runAutoRecover(self.output_number, np.mean(DAC0_output))
-                    DAC0_output_voltage = DAC0_output/float(self.sl.DACs_limit_high[0] - self.sl.DACs_limit_low[0])*2.
+                    DAC0_output_voltage = DAC0_output[-1]/float(self.sl.DACs_limit_high[0] - self.sl.DACs_limit_low[0])*2.
                     dac_output = (DAC0_output - self.sl.DACs_limit_low[0]).astype(np.float)/float(self.sl.DACs_limit_high[0] - self.sl.DACs_limit_low[0])   #We want the graph scale between 0 and 1
                     dac_mean = dac_mean/float(self.sl.DACs_limit_high[0] - self.sl.DACs_limit_low[0])*2.
                     dac_thrsh = dac_thrsh/float(self.sl.DACs_limit_high[0] - self.sl.DACs_limit_low[0])*2.
@@ -716,13 +798,13 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                 self.file_output_dac0.write(DAC0_output)
 
                 if self.output_number == 0:
-                    self.checkAutoUnlock(self.output_number, DAC0_output)                
+                    self.checkAutoUnlock(self.output_number, DAC0_output[-1:])
                 
             if DAC1_output is not None:
                 if self.output_number == 1:
                 # Run auto recovery for DAC1
                     dac_mean, dac_thrsh = self.runAutoRecover(self.output_number, np.mean(DAC1_output))
-                    DAC1_output_voltage = DAC1_output/float(self.sl.DACs_limit_high[1] - self.sl.DACs_limit_low[1])*2.
+                    DAC1_output_voltage = DAC1_output[-1]/float(self.sl.DACs_limit_high[1] - self.sl.DACs_limit_low[1])*2.
                     dac_output = (DAC1_output - self.sl.DACs_limit_low[1]).astype(np.float)/float(self.sl.DACs_limit_high[1] - self.sl.DACs_limit_low[1])    #We want the graph scale between 0 and 1
                     dac_mean = dac_mean/float(self.sl.DACs_limit_high[1] - self.sl.DACs_limit_low[1])*2.
                     dac_thrsh = dac_thrsh/float(self.sl.DACs_limit_high[1] - self.sl.DACs_limit_low[1])*2.
@@ -733,15 +815,15 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                 self.file_output_dac1.write(DAC1_output)
                 
             if DAC2_output is not None:
-                DAC2_output_voltage = DAC2_output/float(self.sl.DACs_limit_high[2] - self.sl.DACs_limit_low[2])*2.
+                DAC2_output_voltage = DAC2_output[-1]/float(self.sl.DACs_limit_high[2] - self.sl.DACs_limit_low[2])*2.
                 # Scale to minimum and maximum limits: 0 means minimum, 1 means maximum
                 DAC2_output = (DAC2_output - self.sl.DACs_limit_low[2]).astype(np.float)/float(self.sl.DACs_limit_high[2] - self.sl.DACs_limit_low[2])
                 # Write data to disk:
                 self.file_output_dac2.write(DAC2_output)
                 
                 if self.output_number == 1:
-                    self.checkAutoUnlock(self.output_number, DAC2_output)
-                    self.runTempControlLoop(time.perf_counter(), DAC2_output)
+                    self.checkAutoUnlock(self.output_number, DAC2_output[-1:])
+                    self.runTempControlLoop(time.perf_counter(), DAC2_output[-1:])
                 
                 
                 
@@ -764,23 +846,30 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                     self.file_output_counter1.write(freq_counter_samples)
                             
                 # Record the new chunk of data in the buffer:
+                # after a long pause we can get more samples than the history holds, only the last ones are kept
+                freq_counter_samples = freq_counter_samples[-self.N_history_counters:]
+                dac_output = dac_output[-self.N_history_dacs:]
+                if self.output_number == 1:
+                    DAC2_output = DAC2_output[-self.N_history_dacs:]
 
 #                print('len = %d' % len(freq_counter_samples))
                 self.freq_history[:-len(freq_counter_samples)] = self.freq_history[len(freq_counter_samples):]
                 self.freq_history[-len(freq_counter_samples):] = freq_counter_samples
                 
-                self.DAC_history[:-1] = self.DAC_history[1:]
-                self.DAC_history[-1:] = dac_output
-                self.DAC_mean_history[:-1] = self.DAC_mean_history[1:]
-                self.DAC_mean_history[-1:] = dac_mean
-                self.DAC_thrsh_history[:-1] = self.DAC_thrsh_history[1:]
-                self.DAC_thrsh_history[-1:] = dac_thrsh
-                self.bValid_dacs[:-1] = self.bValid_dacs[1:]
-                self.bValid_dacs[-1:] = True
+                # one DAC sample per counter sample
+                N_new = len(dac_output)
+                self.DAC_history[:-N_new] = self.DAC_history[N_new:]
+                self.DAC_history[-N_new:] = dac_output
+                self.DAC_mean_history[:-N_new] = self.DAC_mean_history[N_new:]
+                self.DAC_mean_history[-N_new:] = dac_mean
+                self.DAC_thrsh_history[:-N_new] = self.DAC_thrsh_history[N_new:]
+                self.DAC_thrsh_history[-N_new:] = dac_thrsh
+                self.bValid_dacs[:-N_new] = self.bValid_dacs[N_new:]
+                self.bValid_dacs[-N_new:] = True
 
                 if self.output_number == 1:
-                    self.DAC2_history[:-1] = self.DAC2_history[1:]
-                    self.DAC2_history[-1:] = DAC2_output
+                    self.DAC2_history[:-N_new] = self.DAC2_history[N_new:]
+                    self.DAC2_history[-N_new:] = DAC2_output
 
                 
     #            self.time_history[:-len(freq_counter_samples)] = self.time_history[len(freq_counter_samples):]
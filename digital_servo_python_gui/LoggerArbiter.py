@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Arbitration of the DDR2 logger, which only holds one capture at a time.
+#
+# Every function which uses the logger (setup_write(), trigger_write(), then reading the samples back) holds a lease for the
+# whole sequence:
+#   with sl.logger_arbiter.acquire('CEO lock: getADCdata', priority=PRIORITY_DISPLAY):
+#       ...
+# or, when the lease has to outlive the function (a system identification which runs for minutes):
+#   lease = sl.logger_arbiter.acquire('system identification')
+#   ...
+#   lease.release()
+# A busy logger doesn't make the capture fail anymore: acquire() waits in a queue, served by priority (lowest value first)
+# and then in arrival order, so every window gets its turn under load. acquire() raises LoggerBusyError if the logger is still
+# busy after timeout seconds, or right away if it is held by the calling thread itself (for example a display refresh
+# which runs from the event loop of a system identification), since waiting could never succeed.
+# The arbiter keeps per-owner statistics (grants, timeouts, waits and hold times), see snapshot() and formatSummary().
+
+from __future__ import print_function
+import heapq
+import itertools
+import threading
+import time
+
+from RP_PLL import CommsError
+
+# Priorities, lowest value is served first (same values as in DeviceIOThread.py):
+PRIORITY_CRITICAL   = 0
+PRIORITY_NORMAL     = 1     # measurements requested by the user: system identification, data export
+PRIORITY_DISPLAY    = 2     # captures which are only used for display
+
+class LoggerBusyError(CommsError):
+    # handled like the other communication errors by the callers: the capture is simply not done
+    pass
+
+class LoggerLease():
+    def __init__(self, arbiter, owner, priority):
+        self.arbiter = arbiter
+        self.owner = owner
+        self.priority = priority
+        self.thread = threading.current_thread()
+        self.request_time = time.perf_counter()
+        self.grant_time = None
+
+    def release(self):
+        # can be called more than once
+        self.arbiter.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class LoggerArbiter():
+
+    DEFAULT_TIMEOUT = 2.    # in seconds, long enough for several captures of the other windows
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.holder = None
+        self.wait_queue = []    # heap of (priority, sequence_number, lease)
+        self.sequence_number = itertools.count()
+        self.counters = {}      # owner -> dict of counters, see snapshot()
+        self.time_start = time.perf_counter()
+
+    def acquire(self, owner, priority=PRIORITY_NORMAL, timeout=DEFAULT_TIMEOUT):
+        # returns a LoggerLease once the logger is ours. timeout=None waits forever, timeout=0 doesn't wait at all
+        lease = LoggerLease(self, owner, priority)
+        with self.condition:
+            if self.isHeldByCurrentThread():
+                self.count(owner, 'refusals')
+                raise LoggerBusyError('logger in use by {} in the same thread'.format(self.holder.owner))
+            entry = (priority, next(self.sequence_number), lease)
+            heapq.heappush(self.wait_queue, entry)
+            if not self.condition.wait_for(lambda: self.holder is None and self.wait_queue[0] is entry, timeout):
+                self.wait_queue.remove(entry)
+                heapq.heapify(self.wait_queue)
+                self.count(owner, 'timeouts')
+                # the next one in the queue might be able to go now
+                self.condition.notify_all()
+                raise LoggerBusyError('logger in use by {}'.format(self.holder.owner if self.holder is not None else 'higher priority requests'))
+            heapq.heappop(self.wait_queue)
+            lease.grant_time = time.perf_counter()
+            self.holder = lease
+            wait_time = lease.grant_time - lease.request_time
+            counters = self.count(owner, 'grants')
+            counters['total_wait'] += wait_time
+            counters['max_wait'] = max(counters['max_wait'], wait_time)
+        return lease
+
+    def release(self, lease):
+        with self.condition:
+            if self.holder is not lease:
+                return
+            self.holder = None
+            hold_time = time.perf_counter() - lease.grant_time
+            counters = self.count(lease.owner)
+            counters['total_hold'] += hold_time
+            counters['max_hold'] = max(counters['max_hold'], hold_time)
+            self.condition.notify_all()
+
+    def isBusy(self):
+        return self.holder is not None
+
+    def isHeldByCurrentThread(self):
+        holder = self.holder
+        return holder is not None and holder.thread is threading.current_thread()
+
+    def currentOwner(self):
+        holder = self.holder
+        return holder.owner if holder is not None else None
+
+    def count(self, owner, name=None):
+        # called with the lock held, returns the counters of owner
+        counters = self.counters.get(owner)
+        if counters is None:
+            counters = {'grants': 0, 'timeouts': 0, 'refusals': 0, 'total_wait': 0., 'max_wait': 0., 'total_hold': 0., 'max_hold': 0.}
+            self.counters[owner] = counters
+        if name is not None:
+            counters[name] += 1
+        return counters
+
+    def reset(self):
+        with self.condition:
+            self.counters = {}
+            self.time_start = time.perf_counter()
+
+    def snapshot(self):
+        # returns a copy of the counters: {owner: {'grants', 'timeouts', 'refusals', 'total_wait', 'max_wait', 'total_hold', 'max_hold'}}
+        # timeouts counts the requests which gave up waiting, refusals those made while the same thread held the logger
+        with self.condition:
+            return {owner: dict(counters) for (owner, counters) in self.counters.items()}
+
+    def formatSummary(self):
+        elapsed = time.perf_counter() - self.time_start
+        lines = ['Logger usage over the last {:.1f} s:'.format(elapsed)]
+        for (owner, counters) in sorted(self.snapshot().items(), key=lambda item: item[1]['total_hold'], reverse=True):
+            lines.append('{:>6d} grants, {:>4d} timeouts, {:>4d} refusals, {:8.3f} s held ({:5.1f} %), wait mean {:8.3f} ms, max {:8.3f} ms: {}'.format(
+                counters['grants'], counters['timeouts'], counters['refusals'], counters['total_hold'], 100.*counters['total_hold']/max(elapsed, 1e-9),
+                1e3*counters['total_wait']/max(counters['grants'], 1), 1e3*counters['max_wait'], owner))
+        return '\n'.join(lines)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+
+from LoggerArbiter import LoggerArbiter, LoggerBusyError, PRIORITY_NORMAL, PRIORITY_DISPLAY
+
+def test_wait_queue_order():
+    arbiter = LoggerArbiter()
+    order = []
+    lease = arbiter.acquire('holder')
+
+    def capture(owner, priority):
+        with arbiter.acquire(owner, priority, timeout=5):
+            order.append(owner)
+
+    threads = []
+    for (owner, priority) in [('display 1', PRIORITY_DISPLAY), ('display 2', PRIORITY_DISPLAY), ('measurement', PRIORITY_NORMAL)]:
+        threads.append(threading.Thread(target=capture, args=(owner, priority)))
+        threads[-1].start()
+        # make sure they queue in this order
+        while len(arbiter.wait_queue) < len(threads):
+            time.sleep(1e-3)
+    lease.release()
+    for thread in threads:
+        thread.join()
+    # by priority first, then first come, first served
+    assert(order == ['measurement', 'display 1', 'display 2'])
+    assert(not arbiter.isBusy())
+    assert(arbiter.snapshot()['display 2']['grants'] == 1)
+
+def test_timeout_and_refusal():
+    arbiter = LoggerArbiter()
+    with arbiter.acquire('system identification'):
+        # the same thread can never get it: refused right away, instead of waiting for the timeout
+        time_start = time.perf_counter()
+        with pytest.raises(LoggerBusyError):
+            arbiter.acquire('display', PRIORITY_DISPLAY, timeout=5)
+        assert(time.perf_counter() - time_start < 1)
+
+        errors = []
+        def capture():
+            try:
+                arbiter.acquire('other window', PRIORITY_DISPLAY, timeout=0.05)
+            except LoggerBusyError as e:
+                errors.append(e)
+        thread = threading.Thread(target=capture)
+        thread.start()
+        thread.join()
+        assert(len(errors) == 1)
+    # released by the context manager, even after the exceptions
+    arbiter.acquire('display', timeout=0).release()
+    counters = arbiter.snapshot()
+    assert(counters['display']['refusals'] == 1 and counters['display']['grants'] == 1)
+    assert(counters['other window']['timeouts'] == 1)
+    assert(arbiter.wait_queue == [])
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Decoding of the logger buffers which hold records rather than plain samples.
+#
+# The functions below only create numpy views over the bytes received from the logger (see read_raw_bytes_from_DDR2()),
+# so decoding costs no copy and no arithmetic, whatever the size of the buffer. They take anything which exposes a buffer:
+# the int16/uint8 arrays from the logger, bytes, or a np.memmap of a file, which is how long sweeps saved to disk are decoded offline:
+#   records = load_vna_records('sweep.bin')
+#   (transfer_function_complex, frequency_axis) = vna_transfer_function(records, output_gain, first_modulation_frequency, modulation_frequency_step, fs)
+# A sweep which arrives in several blocks (more frequencies than the logger holds) can be decoded block by block with VNARecordStream,
+# which only copies the records which straddle two blocks.
+
+from __future__ import print_function
+import numpy as np
+
+# System identification VNA, one record per tested frequency. The DDR contains 16-bits words, least significant first:
+# INTEGRATOR_REALPART_BITS15_TO_0 ... INTEGRATOR_REALPART_BITS63_TO_48, INTEGRATOR_IMAGPART_BITS15_TO_0 ... INTEGRATOR_IMAGPART_BITS63_TO_48,
+# INTEGRATION_TIME_BITS15_TO_0, INTEGRATION_TIME_BITS31_TO_16
+# so each tested frequency produces 2*64+32 bits (20 bytes), which are little-endian integers once seen as bytes.
+VNA_RECORD_DTYPE = np.dtype([('real', '<i8'), ('imag', '<i8'), ('integration_time', '<u4')])   # packed, no padding
+
+# Counter samples written to the logger (LOGGER_MUX['COUNTER']): one little-endian int16 per sample
+COUNTER_SAMPLE_DTYPE = np.dtype('<i2')
+
+def as_bytes(data):
+    # uint8 view of data, without copy
+    if isinstance(data, np.ndarray):
+        return data.reshape(-1).view(np.uint8)
+    return np.frombuffer(data, dtype=np.uint8)
+
+def decode_records(data, dtype, max_records=None):
+    # view of the complete records at the start of data, the incomplete one at the end (if any) is left out
+    data = as_bytes(data)
+    N_records = len(data)//dtype.itemsize
+    if max_records is not None:
+        N_records = min(N_records, int(max_records))
+    return data[:N_records*dtype.itemsize].view(dtype)
+
+def decode_vna_records(data, number_of_frequencies=None):
+    # structured array of dtype VNA_RECORD_DTYPE: fields 'real', 'imag' and 'integration_time'
+    return decode_records(data, VNA_RECORD_DTYPE, number_of_frequencies)
+
+def decode_counter_samples(data, number_of_samples=None):
+    return decode_records(data, COUNTER_SAMPLE_DTYPE, number_of_samples)
+
+def load_vna_records(strFilename, number_of_frequencies=None, offset=0):
+    # records saved with records.tofile() or as the raw logger bytes. The file is mapped, not read: only the records used are loaded
+    data = np.memmap(strFilename, dtype=np.uint8, mode='r', offset=offset)
+    return decode_vna_records(data, number_of_frequencies)
+
+def vna_frequency_axis(first_modulation_frequency, modulation_frequency_step, number_of_frequencies, fs):
+    # in Hz, the frequency settings are in units of fs/2**48
+    return (first_modulation_frequency + modulation_frequency_step * np.arange(number_of_frequencies, dtype=np.uint64)).astype(np.float64)/2**48*fs
+
+def vna_transfer_function(records, output_gain, first_modulation_frequency, modulation_frequency_step, fs):
+    # returns (transfer_function_complex, frequency_axis)
+    # The overall gain of the measurement is such that a pure loop-back system from the output of the VNA to the input
+    # will give a modulus equal to overall_gain:
+    overall_gain = 2.**(15-1) * output_gain * records['integration_time'].astype(np.float64) # the additionnal divide by two is because cos(x) = 1/2*exp(jx)+1/2*exp(-jx)
+    transfer_function_complex = (records['real'] + 1j*records['imag']) / overall_gain
+    frequency_axis = vna_frequency_axis(first_modulation_frequency, modulation_frequency_step, len(records), fs)
+    return (transfer_function_complex, frequency_axis)
+
+class VNARecordStream():
+    # decodes a sweep which arrives in consecutive blocks of bytes. feed() returns the records completed by each block, as a list
+    # of structured arrays: the record which started in the previous block (a copy), if any, then a view of the block
+    def __init__(self):
+        self.partial_record = np.empty(0, dtype=np.uint8)
+
+    def feed(self, data):
+        data = as_bytes(data)
+        blocks = []
+        if len(self.partial_record) > 0:
+            N_missing = VNA_RECORD_DTYPE.itemsize - len(self.partial_record)
+            self.partial_record = np.concatenate((self.partial_record, data[:N_missing]))
+            data = data[N_missing:]
+            if len(self.partial_record) < VNA_RECORD_DTYPE.itemsize:
+                return blocks
+            blocks.append(decode_vna_records(self.partial_record))
+        records = decode_vna_records(data)
+        blocks.append(records)
+        self.partial_record = data[len(records)*VNA_RECORD_DTYPE.itemsize:].copy()
+        return blocks
@@ -0,0 +1,38 @@
+import numpy as np
+
+import LoggerRecords
+
+def make_records(N):
+    records = np.zeros(N, dtype=LoggerRecords.VNA_RECORD_DTYPE)
+    records['real'] = np.arange(N) * -(1 << 40) + 3
+    records['imag'] = -np.arange(N) - 1
+    records['integration_time'] = 0xFFFFFFF0
+    return records
+
+def test_decode_vna_records(tmp_path):
+    records = make_records(10)
+    # as received from the logger: int16 samples, plus an incomplete record at the end
+    data_buffer = np.concatenate((records.view(np.int16), np.zeros(3, dtype=np.int16)))
+    decoded = LoggerRecords.decode_vna_records(data_buffer)
+    assert(np.array_equal(decoded, records))
+    # a view, not a copy
+    assert(np.shares_memory(decoded, data_buffer))
+    assert(len(LoggerRecords.decode_vna_records(data_buffer, number_of_frequencies=4)) == 4)
+
+    # offline, from a file
+    records.tofile(str(tmp_path / 'sweep.bin'))
+    assert(np.array_equal(LoggerRecords.load_vna_records(str(tmp_path / 'sweep.bin')), records))
+
+    (transfer_function_complex, frequency_axis) = LoggerRecords.vna_transfer_function(decoded, 1., 2**40, 2**30, 125e6)
+    assert(np.allclose(transfer_function_complex, (records['real'] + 1j*records['imag'])/(2.**14*0xFFFFFFF0)))
+    assert(frequency_axis[1] - frequency_axis[0] == 2**30/2**48*125e6)
+
+def test_vna_record_stream():
+    records = make_records(100)
+    data = records.view(np.uint8)
+    stream = LoggerRecords.VNARecordStream()
+    decoded = []
+    # blocks which cut the records anywhere, including blocks smaller than a record
+    for (start, stop) in [(0, 7), (7, 15), (15, 333), (333, 1000), (1000, len(data))]:
+        decoded.extend(stream.feed(data[start:stop]))
+    assert(np.array_equal(np.concatenate(decoded), records))
@@ -670,10 +670,14 @@ class LoopFiltersUI(Qt.QWidget):
 #        print('LoopFiltersUI::updateFilterSettings(): Entering')
 #		traceback.print_stack()
 
-		(P_gain, I_gain, II_gain, D_gain, D_coef, bLock) = self.getActualControllerDesign()
-		
-		self.sl.pll[self.filter_number].set_pll_settings(self.sl, P_gain, I_gain, II_gain, D_gain, D_coef, bLock)
+		self.writeFilterSettings(self.getActualControllerDesign())
 #        print('LoopFiltersUI::updateFilterSettings(): Exiting')
+
+	def writeFilterSettings(self, design):
+		# design is (P_gain, I_gain, II_gain, D_gain, D_coef, bLock), as returned by getActualControllerDesign().
+		# Doesn't touch the UI, so that the lock-critical writes can be made from the I/O thread (see DeviceIOThread.py)
+		(P_gain, I_gain, II_gain, D_gain, D_coef, bLock) = design
+		self.sl.pll[self.filter_number].set_pll_settings(self.sl, P_gain, I_gain, II_gain, D_gain, D_coef, bLock)
 		
 	@logCommsErrorsAndBreakoutOfFunction()
 	def getFilterSettings(self):
@@ -45,6 +45,12 @@ class LoopFiltersUI_DAC1_and_DAC2(Qt.QWidget):
     def updateFilterSettings(self):
         self.dac1_ui.updateFilterSettings()
 
+    def getActualControllerDesign(self):
+        return self.dac1_ui.getActualControllerDesign()
+
+    def writeFilterSettings(self, design):
+        self.dac1_ui.writeFilterSettings(design)
+
     def getValues(self):
         self.dac1_ui.kc = self.kc
         self.dac1_ui.getValues()
@@ -150,14 +156,14 @@ class LoopFiltersUI_DAC1_and_DAC2(Qt.QWidget):
 
 
 
-    def setIntegratorGainEvent(self):
-#        print('LoopFiltersUI_DAC1_and_DAC2::setIntegratorGainEvent(): TODO!')
-        
+    def getIntegratorSettings(self, bModeOff=False):
+        # returns ((hold1, flipsign1, lock_integrator1, gain1_in_bits), (hold2, flipsign2, lock_integrator2, gain2_in_bits)) from the UI,
+        # or the settings of the 'off' mode if bModeOff is True
         gain1_in_bits = int(self.qcombo_int1_gain.currentIndex()) - 32
         
         
 #        print(gain1_in_bits)
-        if self.qradio_mode_off.isChecked():
+        if bModeOff or self.qradio_mode_off.isChecked():
             # All off
             lock_integrator1 = 0
             lock_integrator2 = 0
@@ -195,9 +201,20 @@ class LoopFiltersUI_DAC1_and_DAC2(Qt.QWidget):
             hold2 = 1
 #        print('integrator 1, flipsign = %d, lock = %d, gain1 = %d' % (flipsign1, lock_integrator1, gain1_in_bits))
 #        print('integrator 2, flipsign = %d, lock = %d, gain1 = %d' % (flipsign2, lock_integrator2, gain2_in_bits))
+        return ((hold1, flipsign1, lock_integrator1, gain1_in_bits), (hold2, flipsign2, lock_integrator2, gain2_in_bits))
+
+    def writeIntegratorSettings(self, integrator_settings):
+        # integrator_settings is from getIntegratorSettings(). Doesn't touch the UI, like LoopFiltersUI.writeFilterSettings()
+        ((hold1, flipsign1, lock_integrator1, gain1_in_bits), (hold2, flipsign2, lock_integrator2, gain2_in_bits)) = integrator_settings
         self.sl.set_integrator_settings(1, hold1, flipsign1, lock_integrator1, gain1_in_bits)
         self.sl.set_integrator_settings(2, hold2, flipsign2, lock_integrator2, gain2_in_bits)
+
+    def setIntegratorGainEvent(self):
+#        print('LoopFiltersUI_DAC1_and_DAC2::setIntegratorGainEvent(): TODO!')
         
+        integrator_settings = self.getIntegratorSettings()
+        self.writeIntegratorSettings(integrator_settings)
+        ((hold1, flipsign1, lock_integrator1, gain1_in_bits), (hold2, flipsign2, lock_integrator2, gain2_in_bits)) = integrator_settings
     
         if lock_integrator1 and hold1:
             self.qlabel_int1_state.setText('Integrator 1 state: On, hold')
@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+# Pure-Python stand-in for monitor-tcp, the server which runs on the Red Pitaya.
+# It speaks the same binary protocol (register reads/writes, batches, logger buffer reads, file writes, shell commands, reboot,
+# the counter subscription and backlog, the deep captures and the waits for the logger),
+# and keeps the registers in memory instead of accessing the FPGA.
+# Logger captures are synthesized from the register values, in the same layout as the firmware:
+# ADC captures carry the DDC reference phasor and the magic bytes in their header (see read_adc_samples_from_DDR2()),
+# DDC captures hold the instantaneous frequency, and system identification runs fill the logger with VNA records.
+#
+# The latency (seconds added before each reply) and bandwidth (bytes/s for the replies) are configurable,
+# so that the cost of the GUI's timer ticks can be measured without hardware, for example:
+#   python MonitorTCP_simulator.py --port 5000 --latency 0.5e-3 --bandwidth 10e6
+# then connect the GUI to 127.0.0.1.
+# From a script or a test:
+#   sim = MonitorTCP_simulator(latency=1e-3)
+#   sim.start()
+#   dev.OpenTCPConnection('127.0.0.1', sim.PORT)
+
+from __future__ import print_function
+import socket
+import struct
+import threading
+import time
+import argparse
+import collections
+import logging
+
+import numpy as np
+
+from RP_PLL import RP_PLL_device, CounterSubscription
+from SuperLaserLand_JD_RP import SuperLaserLand_JD_RP
+import LoggerRecords
+
+class MonitorTCP_simulator():
+
+    MAGIC_BYTES_WRITE_REG       = RP_PLL_device.MAGIC_BYTES_WRITE_REG
+    MAGIC_BYTES_READ_REG        = RP_PLL_device.MAGIC_BYTES_READ_REG
+    MAGIC_BYTES_READ_BUFFER     = RP_PLL_device.MAGIC_BYTES_READ_BUFFER
+    MAGIC_BYTES_WRITE_FILE      = RP_PLL_device.MAGIC_BYTES_WRITE_FILE
+    MAGIC_BYTES_SHELL_COMMAND   = RP_PLL_device.MAGIC_BYTES_SHELL_COMMAND
+    MAGIC_BYTES_REBOOT_MONITOR  = RP_PLL_device.MAGIC_BYTES_REBOOT_MONITOR
+    MAGIC_BYTES_BATCH           = RP_PLL_device.MAGIC_BYTES_BATCH
+    MAGIC_BYTES_READ_BUFFER_CHUNK = RP_PLL_device.MAGIC_BYTES_READ_BUFFER_CHUNK
+    MAGIC_BYTES_SUBSCRIBE_COUNTERS = RP_PLL_device.MAGIC_BYTES_SUBSCRIBE_COUNTERS
+    MAGIC_BYTES_READ_COUNTER_BACKLOG = RP_PLL_device.MAGIC_BYTES_READ_COUNTER_BACKLOG
+    MAGIC_BYTES_DEEP_CAPTURE    = RP_PLL_device.MAGIC_BYTES_DEEP_CAPTURE
+    MAGIC_BYTES_WAIT_FOR_LOGGER = RP_PLL_device.MAGIC_BYTES_WAIT_FOR_LOGGER
+
+    FPGA_BASE_ADDR              = RP_PLL_device.FPGA_BASE_ADDR
+    FPGA_BASE_ADDR_XADC         = RP_PLL_device.FPGA_BASE_ADDR_XADC
+
+    MAX_SAMPLES_READ_BUFFER     = RP_PLL_device.MAX_SAMPLES_READ_BUFFER
+    MAX_BATCH_OPERATIONS        = RP_PLL_device.MAX_BATCH_OPERATIONS
+
+    # the firmware's memory map (bus addresses, multiply by 4 for the byte offset):
+    DPLL_WRAPPER_RAM_OFFSET     = (2 << 20)     # the dpll_wrapper RAM holds a copy of every register written on the dpll bus
+    DPLL_WRAPPER_RAM_DEFAULT    = 0xEFFFFFFF    # value of the addresses which were never written
+    BUS_ADDR_MUX_SELECTORS      = SuperLaserLand_JD_RP.BUS_ADDR_MUX_SELECTORS
+    BUS_ADDR_STATUS_FLAGS       = SuperLaserLand_JD_RP.BUS_ADDR_STATUS_FLAGS
+    # (lsbs, msbs) of the lock-in result of dither 0 and 1
+    BUS_ADDR_DITHER_LOCKIN_REAL = [(SuperLaserLand_JD_RP.BUS_ADDR_DITHER0_LOCKIN_REAL_LSB, SuperLaserLand_JD_RP.BUS_ADDR_DITHER0_LOCKIN_REAL_MSB),
+                                   (SuperLaserLand_JD_RP.BUS_ADDR_DITHER1_LOCKIN_REAL_LSB, SuperLaserLand_JD_RP.BUS_ADDR_DITHER1_LOCKIN_REAL_MSB)]
+    BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER = SuperLaserLand_JD_RP.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER
+    BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS  = SuperLaserLand_JD_RP.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS
+    BUS_ADDR_DAC0_CURRENT       = SuperLaserLand_JD_RP.BUS_ADDR_DAC0_CURRENT
+    BUS_ADDR_LOGGER_SAMPLES_WRITTEN = SuperLaserLand_JD_RP.BUS_ADDR_LOGGER_SAMPLES_WRITTEN
+    BUS_ADDR_TRIG_SYSTEM_IDENTIFICATION = SuperLaserLand_JD_RP.BUS_ADDR_TRIG_SYSTEM_IDENTIFICATION
+    BUS_ADDR_TRIG_WRITE         = SuperLaserLand_JD_RP.BUS_ADDR_TRIG_WRITE
+    # number_of_cycles_integration, then the other settings in the same order as setup_system_identification()
+    BUS_ADDR_VNA                = SuperLaserLand_JD_RP.BUS_ADDR_number_of_cycles_integration
+    BUS_ADDR_DAC_offset         = SuperLaserLand_JD_RP.BUS_ADDR_DAC_offset
+    BUS_ADDR_ref_freq0_lsbs     = SuperLaserLand_JD_RP.BUS_ADDR_ref_freq0_lsbs
+    BUS_ADDR_dither_period_divided_by_4_minus_one = SuperLaserLand_JD_RP.BUS_ADDR_dither_period_divided_by_4_minus_one
+    BUS_ADDR_dither_N_periods_minus_one = SuperLaserLand_JD_RP.BUS_ADDR_dither_N_periods_minus_one
+    BUS_ADDR_nominal_ref_freq1_lsbs = SuperLaserLand_JD_RP.BUS_ADDR_nominal_ref_freq1_lsbs
+    XADC_BASE_ADDR              = SuperLaserLand_JD_RP.xadc_base_addr
+
+    LOGGER_MUX                  = SuperLaserLand_JD_RP.LOGGER_MUX
+
+    LOGGER_MAGIC_BYTES = 0xA88F                 # from aux_data_mux.vhd: 1010_1000_1000_1111
+    N_delay_between_ref_exp_and_datastream = 4
+    MAX_BUFF_SIZE = 1024
+    COUNTER_POLL_PERIOD = 1e-3                  # monitor-tcp polls every 100 us, this is enough for the simulated update rates
+    LOGGER_POLL_PERIOD = 1e-4
+    STATUS_FLAG_LOGGER_IS_WRITING = (1 << 12)
+    COUNTER_BACKLOG_SIZE = (1 << 16) - 1024     # COUNTER_BACKLOG_SIZE - COUNTER_BACKLOG_GUARD in monitor-tcp.c
+
+    def __init__(self, HOST='127.0.0.1', PORT=0, latency=0., bandwidth=None, seed=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':MonitorTCP_simulator'
+
+        self.HOST = HOST
+        self.PORT = PORT            # 0 picks a free port, the actual one is in self.PORT after start()
+        self.latency = latency      # in seconds, added before each reply
+        self.bandwidth = bandwidth  # in bytes/s for the replies, None for unlimited
+
+        # signal model, can be changed at any time:
+        self.fs = 125e6
+        self.input_frequency = [25e6+1e3, 25e6-2e3]     # frequency of the signal on ADC0 and ADC1
+        self.input_amplitude = [0.5, 0.5]               # relative to the ADC full scale
+        self.input_noise = 1e-3                         # rms, relative to the ADC full scale
+        self.frequency_noise = 100.                     # rms of the DDC and counter frequency samples, in Hz
+        self.counter_update_rate = 1.                   # new zero-deadtime counter samples per second
+        self.N_CYCLES_GATE_TIME = 125e6                 # same scaling as SuperLaserLand_JD_RP.scaleCounterReadingsIntoHz()
+        self.bTriangularAveraging = True
+        self.vna_pole_frequency = 100e3                 # the VNA sees a first-order low-pass with a delay
+        self.vna_delay = 1e-6
+        self.dither_lockin_result = [-1e9, -1e9]        # mean lock-in result of dither 0 and 1, in summed DDC counts
+        self.dither_lockin_noise = 1e7                  # rms of the lock-in results
+        self.dither_lockin_glitch_probability = 0.      # fraction of the lock-in results which are off by 100 times the rms noise
+        self.unsupported_magic_bytes = set()            # emulates an older monitor-tcp, which doesn't know these requests
+        self.bLoggerProgressRegister = True             # False emulates an older bitstream, on which the logger progress reads 0
+
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+        self.registers = {}         # absolute address: value, for everything which is written
+        self.files = {}             # files written with write_file_on_remote(), filename: bytes
+        self.shell_commands = []    # the commands are recorded, not executed
+        self.logger_buffer = np.zeros(self.MAX_SAMPLES_READ_BUFFER, dtype=np.int16)
+        # the logger buffer is filled right away, but it is reported as being written for as long as on the device:
+        # (trigger time, number of samples to write, duration of the write)
+        self.logger_progress = (0., 0, 1.)
+        self.counter_latch = None
+        self.dither_lockin_latch = [(None, 0), (None, 0)]   # (integration number, result) of the last lock-in result read
+        self.counter_backlog = collections.deque(maxlen=self.COUNTER_BACKLOG_SIZE)
+        # same as in monitor-tcp.c: the backlog is only filled after the first request, and not during the shell commands
+        self.counter_backlog_requested = threading.Event()
+        self.counter_backlog_pause_count = 0
+
+        self.server_socket = None
+        self.connections = []
+        self.threads = []
+        self.bRunning = False
+        self.time_start = time.perf_counter()
+
+    #######################################################
+    # Server
+    #######################################################
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.HOST, self.PORT))
+        self.server_socket.listen(5)
+        self.PORT = self.server_socket.getsockname()[1]
+        self.bRunning = True
+        self.startThread(self.acceptConnections)
+        self.startThread(self.runCounterBacklog)
+
+    def stop(self):
+        self.bRunning = False
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)   # close() alone doesn't wake up accept() on Linux
+        except OSError:
+            pass
+        self.server_socket.close()
+        self.closeConnections()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def serve_forever(self):
+        self.start()
+        print('MonitorTCP_simulator: listening on %s:%d' % (self.HOST, self.PORT))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def startThread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def acceptConnections(self):
+        # one thread per connection, so that the control and bulk channels of RP_PLL_device are served independently
+        while self.bRunning:
+            try:
+                (conn, address) = self.server_socket.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.append(conn)
+            self.startThread(self.serveConnection, conn)
+
+    def closeConnections(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def serveConnection(self, conn):
+        magic_bytes_to_handler = {
+            self.MAGIC_BYTES_WRITE_REG:         self.handleWriteRegister,
+            self.MAGIC_BYTES_READ_REG:          self.handleReadRegister,
+            self.MAGIC_BYTES_READ_BUFFER:       self.handleReadBuffer,
+            self.MAGIC_BYTES_READ_BUFFER_CHUNK: self.handleReadBufferChunk,
+            self.MAGIC_BYTES_BATCH:             self.handleBatch,
+            self.MAGIC_BYTES_WRITE_FILE:        self.handleWriteFile,
+            self.MAGIC_BYTES_SHELL_COMMAND:     self.handleShellCommand,
+            self.MAGIC_BYTES_REBOOT_MONITOR:    self.handleReboot,
+            self.MAGIC_BYTES_SUBSCRIBE_COUNTERS: self.handleSubscribeCounters,
+            self.MAGIC_BYTES_READ_COUNTER_BACKLOG: self.handleReadCounterBacklog,
+            self.MAGIC_BYTES_DEEP_CAPTURE:      self.handleDeepCapture,
+            self.MAGIC_BYTES_WAIT_FOR_LOGGER:   self.handleWaitForLogger,
+        }
+        try:
+            while True:
+                data = self.recvall(conn, 4)
+                if data is None:
+                    return
+                magic_bytes = struct.unpack('=I', data)[0]
+                handler = magic_bytes_to_handler.get(magic_bytes)
+                if handler is None or magic_bytes in self.unsupported_magic_bytes:
+                    # same as monitor-tcp: the connection is dropped
+                    self.logger.warning('Red_Pitaya_GUI{}: magic bytes do not match. got: 0x{:x}'.format(self.logger_name, magic_bytes))
+                    return
+                data = self.recvall(conn, 8)
+                if data is None:
+                    return
+                (value1, value2) = struct.unpack('=II', data)
+                if handler(conn, value1, value2) == False:
+                    return
+        except OSError:
+            return
+        finally:
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+            conn.close()
+
+    def recvall(self, conn, count):
+        buf = bytearray(count)
+        view = memoryview(buf)
+        offset = 0
+        while offset < count:
+            nbytes = conn.recv_into(view[offset:], count-offset)
+            if nbytes == 0: return None
+            offset += nbytes
+        return buf
+
+    def sendReply(self, conn, data):
+        # emulates the round-trip time and the link's throughput
+        delay = self.latency
+        if self.bandwidth is not None:
+            delay += len(data)/self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        conn.sendall(data)
+
+    #######################################################
+    # Packet handlers
+    #######################################################
+
+    def handleWriteRegister(self, conn, absolute_addr, value):
+        self.write_register(absolute_addr, value)
+
+    def handleReadRegister(self, conn, absolute_addr, reserved):
+        self.sendReply(conn, struct.pack('=I', self.read_register(absolute_addr)))
+
+    def handleReadBuffer(self, conn, absolute_addr, number_of_points):
+        # monitor-tcp always reads the logger, whatever the address is
+        number_of_points = min(number_of_points, self.MAX_SAMPLES_READ_BUFFER)
+        with self.lock:
+            data = self.logger_buffer[:number_of_points].tobytes()
+        self.sendReply(conn, data)
+
+    def handleReadBufferChunk(self, conn, start_point, number_of_points):
+        start_point = min(start_point, self.MAX_SAMPLES_READ_BUFFER)
+        number_of_points = min(number_of_points, self.MAX_SAMPLES_READ_BUFFER - start_point)
+        with self.lock:
+            data = self.logger_buffer[start_point:start_point+number_of_points].tobytes()
+        self.sendReply(conn, data)
+
+    def handleBatch(self, conn, number_of_operations, reserved):
+        if number_of_operations > self.MAX_BATCH_OPERATIONS:
+            # monitor-tcp drops the connection, since the rest of the stream would be misinterpreted
+            self.logger.warning('Red_Pitaya_GUI{}: batch packet has too many operations: {}'.format(self.logger_name, number_of_operations))
+            return False
+        data = self.recvall(conn, 12*number_of_operations)
+        if data is None:
+            return False
+        entries = np.frombuffer(data, dtype=np.uint32).reshape(-1, 3)
+        read_values = []
+        # the batch is not atomic: in monitor-tcp the counter backlog thread keeps running while a connection executes it
+        for (operation, absolute_addr, value) in entries.tolist():
+            with self.lock:
+                if operation == 0:
+                    self.write_register(absolute_addr, value)
+                else:
+                    read_values.append(self.read_register(absolute_addr))
+        if read_values:
+            self.sendReply(conn, np.array(read_values, dtype=np.uint32).tobytes())
+
+    def handleWriteFile(self, conn, filename_length, file_size):
+        strFilename = self.recvall(conn, filename_length)
+        file_contents = None if strFilename is None else self.recvall(conn, file_size)
+        if file_contents is None:
+            # the client closed the connection
+            return False
+        self.files[bytes(strFilename).decode('ascii')] = bytes(file_contents)
+
+    def handleShellCommand(self, conn, command_length, reserved):
+        command = self.recvall(conn, command_length)
+        if command is None:
+            # the client closed the connection
+            return False
+        with self.lock:
+            self.counter_backlog_pause_count += 1
+        try:
+            self.shell_commands.append(bytes(command).decode('ascii'))
+        finally:
+            with self.lock:
+                self.counter_backlog_pause_count -= 1
+
+    def handleReboot(self, conn, reserved1, reserved2):
+        # monitor-tcp restarts itself, which drops all the connections. The FPGA keeps its state.
+        self.closeConnections()
+        return False
+
+    def handleSubscribeCounters(self, conn, records_per_push, max_latency_us):
+        # same as stream_counter_records() in monitor-tcp.c: the connection now only streams counter records, until the client closes it
+        records_per_push = max(1, min(records_per_push, CounterSubscription.MAX_RECORDS_PER_PUSH))
+        records = []
+        time_first_record = None
+        last_samples_number = None
+        conn.settimeout(0)
+        while self.bRunning:
+            new_records = self.read_counter_records(last_samples_number)
+            if new_records:
+                last_samples_number = new_records[-1][0]
+                records.extend(new_records)
+                if time_first_record is None:
+                    time_first_record = time.perf_counter()
+            if records and (len(records) >= records_per_push or time.perf_counter()-time_first_record >= max_latency_us*1e-6):
+                conn.settimeout(None)
+                self.sendReply(conn, self.pack_counter_records(records).tobytes())
+                conn.settimeout(0)
+                records = []
+                time_first_record = None
+            try:
+                if conn.recv(self.MAX_BUFF_SIZE) == b'':
+                    return False
+            except BlockingIOError:
+                pass
+            time.sleep(self.COUNTER_POLL_PERIOD)
+        return False
+
+    def handleReadCounterBacklog(self, conn, first_samples_number, max_records):
+        max_records = max(1, min(max_records, RP_PLL_device.MAX_BACKLOG_RECORDS_PER_READ))
+        self.counter_backlog_requested.set()
+        with self.lock:
+            # same as read_counter_backlog() in monitor-tcp.c: from first_samples_number, or from the oldest record
+            records = [record for record in self.counter_backlog if ((record[0] - first_samples_number) & 0xFFFFFFFF) < (1 << 31)]
+        records = records[:max_records]
+        self.sendReply(conn, struct.pack('=I', len(records)) + self.pack_counter_records(records).tobytes())
+
+    def handleDeepCapture(self, conn, number_of_points, decimation):
+        number_of_points = min(number_of_points, RP_PLL_device.MAX_POINTS_DEEP_CAPTURE)
+        decimation = max(1, min(decimation, 0xFFFF))
+        with self.lock:
+            samples = self.synthesize_deep_capture(number_of_points, decimation)
+        # the capture takes as long as on the device
+        time.sleep(number_of_points*decimation/self.fs)
+        self.sendReply(conn, struct.pack('=II', number_of_points, 0) + samples.tobytes())
+
+    def handleWaitForLogger(self, conn, number_of_samples, timeout_us):
+        # same as wait_for_logger() in monitor-tcp.c
+        time_end = time.perf_counter() + timeout_us*1e-6
+        while True:
+            samples_written = self.logger_samples_written()
+            if samples_written >= number_of_samples or time.perf_counter() >= time_end or not self.bRunning:
+                break
+            time.sleep(self.LOGGER_POLL_PERIOD)
+        self.sendReply(conn, struct.pack('=I', samples_written))
+
+    def runCounterBacklog(self):
+        # same as counter_backlog_thread_function() in monitor-tcp.c
+        last_samples_number = None
+        while self.bRunning:
+            if not self.counter_backlog_requested.wait(self.COUNTER_POLL_PERIOD):
+                continue
+            with self.lock:
+                bPaused = (self.counter_backlog_pause_count > 0)
+                new_records = [] if bPaused else self.read_counter_records(last_samples_number)
+                self.counter_backlog.extend(new_records)
+            if bPaused:
+                # the FPGA might be reprogrammed: starts over from the current sample
+                last_samples_number = None
+            elif new_records:
+                last_samples_number = new_records[-1][0]
+            time.sleep(self.COUNTER_POLL_PERIOD)
+
+    def read_counter_records(self, last_samples_number):
+        # records of the samples after last_samples_number (None: only the current one), each as
+        # [samples number, counter 0 lsbs, msbs, counter 1 lsbs, msbs, dac 0, 1, 2].
+        # monitor-tcp polls often enough to see every sample, but our threads can be late, so the samples which were missed are synthesized.
+        # Holding the lock keeps the latched values consistent here, monitor-tcp needs read_latched_counter_record() instead
+        with self.lock:
+            samples_number = self.read_status_register(self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER)
+            if samples_number == last_samples_number:
+                return []
+            dac_values = [self.read_status_register(self.BUS_ADDR_DAC0_CURRENT+k) for k in range(3)]
+            records = []
+            if last_samples_number is not None:
+                for missed_samples_number in range(last_samples_number+1, samples_number):
+                    records.append([missed_samples_number] + self.synthesize_counter_counts().view(np.uint32).tolist() + dac_values)
+            records.append([samples_number] + [self.read_status_register(bus_address) for bus_address in range(self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS, self.BUS_ADDR_DAC0_CURRENT)] + dac_values)
+            return records
+
+    def pack_counter_records(self, records):
+        data = np.array(records, dtype=np.int64).reshape(-1, 8)
+        packed = np.zeros(len(data), dtype=CounterSubscription.RECORD_DTYPE)
+        packed['samples_number'] = data[:, 0]
+        packed['counter0'] = (data[:, 2] << 32) | data[:, 1]
+        packed['counter1'] = (data[:, 4] << 32) | data[:, 3]
+        packed['dac0'] = data[:, 5]
+        packed['dac1'] = data[:, 6]
+        packed['dac2'] = data[:, 7] & 0xFFFFFFFF
+        return packed
+
+    #######################################################
+    # Register map
+    #######################################################
+
+    def dpll_offset(self, absolute_addr):
+        # byte offset on the dpll bus, or None if absolute_addr is somewhere else
+        offset = absolute_addr - self.FPGA_BASE_ADDR
+        if 0 <= offset < (1 << 20):
+            return offset
+        return None
+
+    def write_register(self, absolute_addr, value):
+        with self.lock:
+            self.registers[absolute_addr] = value
+            if absolute_addr == self.FPGA_BASE_ADDR + self.BUS_ADDR_TRIG_WRITE:
+                self.trigger_logger()
+            offset = self.dpll_offset(absolute_addr)
+            if offset is None:
+                return
+            self.registers[self.FPGA_BASE_ADDR + self.DPLL_WRAPPER_RAM_OFFSET + offset] = value
+            if offset == self.BUS_ADDR_TRIG_SYSTEM_IDENTIFICATION*4:
+                self.run_system_identification()
+
+    def read_register(self, absolute_addr):
+        with self.lock:
+            if absolute_addr >= self.FPGA_BASE_ADDR_XADC:
+                return self.read_xadc(absolute_addr - self.FPGA_BASE_ADDR_XADC - self.XADC_BASE_ADDR)
+            if (absolute_addr - self.FPGA_BASE_ADDR) >> 20 == self.DPLL_WRAPPER_RAM_OFFSET >> 20:
+                return self.registers.get(absolute_addr, self.DPLL_WRAPPER_RAM_DEFAULT)
+            offset = self.dpll_offset(absolute_addr)
+            if offset is not None:
+                # the dpll bus reads go to a separate set of status registers, the written values are only readable through the RAM
+                return self.read_status_register(offset//4) & 0xFFFFFFFF
+            return self.registers.get(absolute_addr, 0)
+
+    def read_dpll_register(self, bus_address, default=0):
+        # value written on the dpll bus, as seen by the firmware
+        return self.registers.get(self.FPGA_BASE_ADDR + bus_address*4, default)
+
+    def read_status_register(self, bus_address):
+        if bus_address == self.BUS_ADDR_STATUS_FLAGS:
+            # the logger only stops writing once it is full
+            if self.bLoggerProgressRegister and self.logger_samples_written() < self.MAX_SAMPLES_READ_BUFFER and self.logger_progress[1] > 0:
+                return self.STATUS_FLAG_LOGGER_IS_WRITING
+            return 0
+        if bus_address == self.BUS_ADDR_LOGGER_SAMPLES_WRITTEN:
+            return self.logger_samples_written()
+        if self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER <= bus_address < self.BUS_ADDR_DAC0_CURRENT:
+            return self.read_counter_register(bus_address)
+        for dither_number in range(2):
+            if bus_address in self.BUS_ADDR_DITHER_LOCKIN_REAL[dither_number]:
+                result = self.read_dither_lockin(dither_number)
+                if bus_address == self.BUS_ADDR_DITHER_LOCKIN_REAL[dither_number][0]:
+                    return result & 0xFFFFFFFF
+                return (result >> 32) & 0xFFFFFFFF
+        if self.BUS_ADDR_DAC0_CURRENT <= bus_address < self.BUS_ADDR_DAC0_CURRENT+3:
+            dac_number = bus_address - self.BUS_ADDR_DAC0_CURRENT
+            offset = self.read_dpll_register(self.BUS_ADDR_DAC_offset[dac_number]) & 0xFFFF
+            if dac_number < 2 and offset > ((1<<15)-1):
+                offset = offset - (1<<16)
+            return offset
+        return 0
+
+    def read_counter_register(self, bus_address):
+        # reading the samples number latches the counter values, as in registers_read.vhd
+        samples_number = int((time.perf_counter()-self.time_start)*self.counter_update_rate)
+        if bus_address == self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER or self.counter_latch is None:
+            if self.counter_latch is None or self.counter_latch[0] != samples_number:
+                self.counter_latch = (samples_number, self.synthesize_counter_counts().view(np.uint32))
+            if bus_address == self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER:
+                return samples_number
+        # counter 0 lsbs, counter 0 msbs, counter 1 lsbs, counter 1 msbs:
+        return int(self.counter_latch[1][bus_address - self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS])
+
+    def read_dither_lockin(self, dither_number):
+        # the lock-in result only changes at the end of each integration period
+        period_divided_by_4 = (self.read_dpll_register(self.BUS_ADDR_dither_period_divided_by_4_minus_one[dither_number], 25000-1) & 0xFFFFFFFF) + 1
+        N_periods = (self.read_dpll_register(self.BUS_ADDR_dither_N_periods_minus_one[dither_number], 100-1) & 0xFFFFFFFF) + 1
+        integration_time = 4*period_divided_by_4*N_periods/self.fs
+        integration_number = int((time.perf_counter()-self.time_start)/integration_time)
+        if self.dither_lockin_latch[dither_number][0] != integration_number:
+            noise = self.dither_lockin_noise*self.rng.standard_normal()
+            if self.rng.random() < self.dither_lockin_glitch_probability:
+                noise = 100*self.dither_lockin_noise
+            result = int(round(self.dither_lockin_result[dither_number] + noise))
+            self.dither_lockin_latch[dither_number] = (integration_number, result)
+        return self.dither_lockin_latch[dither_number][1]
+
+    def synthesize_counter_counts(self):
+        # raw values of the two counters for one gate time
+        if self.bTriangularAveraging:
+            conversion_gain = self.N_CYCLES_GATE_TIME * (self.N_CYCLES_GATE_TIME + 1)
+        else:
+            conversion_gain = self.N_CYCLES_GATE_TIME
+        frequencies = np.array(self.input_frequency) + self.frequency_noise*self.rng.standard_normal(2)
+        return np.round(frequencies * 2**10 / self.fs * conversion_gain).astype(np.int64)
+
+    def read_xadc(self, offset):
+        # plausible codes for the temperature and supply voltages (UG480, MSB-aligned)
+        if offset == 0x200:
+            return int((50.+273.15)*2.**16/503.975)
+        supplies = {0x204: 1.0, 0x208: 1.8, 0x218: 1.0}
+        if offset in supplies:
+            return int(supplies[offset]/3.*2.**16)
+        return 0
+
+    def get_ref_frequency(self, adc_number):
+        # DDC reference frequency, as a fraction of fs
+        lsbs_address = [self.BUS_ADDR_ref_freq0_lsbs, self.BUS_ADDR_nominal_ref_freq1_lsbs][adc_number]
+        if self.FPGA_BASE_ADDR + lsbs_address*4 not in self.registers:
+            return 25e6/100e6   # same default as SuperLaserLand_JD_RP.ddc0_frequency_in_int
+        frequency_in_int = (self.read_dpll_register(lsbs_address+1) & 0xFFFF) << 32 | self.read_dpll_register(lsbs_address)
+        if frequency_in_int > ((1<<47)-1):
+            frequency_in_int -= (1<<48)
+        return frequency_in_int/2.**48
+
+    #######################################################
+    # Logger contents
+    #######################################################
+
+    def get_sample_number(self):
+        # the samples are timestamped by the ADC clock, so that consecutive captures are phase-coherent
+        return int((time.perf_counter()-self.time_start)*self.fs)
+
+    def logger_samples_written(self):
+        # samples written since the last trigger, as in ram_data_logger.vhd
+        if not self.bLoggerProgressRegister:
+            return 0
+        (trigger_time, number_of_samples, duration) = self.logger_progress
+        return int(number_of_samples * min((time.perf_counter() - trigger_time)/duration, 1.))
+
+    def trigger_logger(self):
+        # the logger takes one sample per clock cycle
+        self.logger_progress = (time.perf_counter(), self.MAX_SAMPLES_READ_BUFFER, self.MAX_SAMPLES_READ_BUFFER/self.fs)
+        selector = self.read_dpll_register(self.BUS_ADDR_MUX_SELECTORS)
+        if selector in (self.LOGGER_MUX['ADC0'], self.LOGGER_MUX['ADC1']):
+            self.logger_buffer[:] = self.synthesize_adc_samples(selector, self.MAX_SAMPLES_READ_BUFFER)
+        else:
+            # VNA: filled by run_system_identification(), which is triggered right after this
+            self.logger_buffer[:] = self.synthesize_logger_data(selector, self.MAX_SAMPLES_READ_BUFFER)
+
+    def synthesize_logger_data(self, selector, N):
+        # what the logger multiplexer outputs, except for the ADC captures' header
+        if selector in (self.LOGGER_MUX['ADC0'], self.LOGGER_MUX['ADC1']):
+            return self.synthesize_adc_stream(selector, self.get_sample_number() + np.arange(N))
+        elif selector in (self.LOGGER_MUX['DDC0'], self.LOGGER_MUX['DDC1']):
+            return self.synthesize_ddc_samples(selector - self.LOGGER_MUX['DDC0'], N)
+        elif selector == self.LOGGER_MUX['COUNTER']:
+            return self.synthesize_counter_samples(N)
+        elif selector in (self.LOGGER_MUX['DAC0'], self.LOGGER_MUX['DAC1'], self.LOGGER_MUX['DAC2']):
+            dac_number = selector - self.LOGGER_MUX['DAC0']
+            offset = self.read_dpll_register(self.BUS_ADDR_DAC_offset[dac_number]) & 0xFFFF
+            return (offset + np.round(4*self.rng.standard_normal(N))).astype(np.int64).astype(np.uint16).view(np.int16)
+        else:
+            return np.zeros(N, dtype=np.int16)
+
+    def synthesize_adc_stream(self, adc_number, n):
+        # ADC samples at the sample numbers n
+        f_input = self.input_frequency[adc_number]/self.fs
+        adc = self.input_amplitude[adc_number]*np.cos(2*np.pi*f_input*n) + self.input_noise*self.rng.standard_normal(len(n))
+        return np.clip(np.round(adc*2**15), -2**15, 2**15-1).astype(np.int16)
+
+    def synthesize_adc_samples(self, adc_number, N):
+        # the first samples carry side information (see read_adc_samples_from_DDR2()):
+        # #6 and #7 are the DDC reference phasor, #8 the magic bytes, and the ADC samples start at #9.
+        header_length = 9
+        n0 = self.get_sample_number()
+        samples = np.zeros(N, dtype=np.int16)
+        samples[header_length:] = self.synthesize_adc_stream(adc_number, n0 + np.arange(N - header_length))
+        # the phasor is sampled N_delay_between_ref_exp_and_datastream samples before the first ADC sample:
+        ref_exp = 2**14 * np.exp(-1j*2*np.pi*self.get_ref_frequency(adc_number)*(n0 - self.N_delay_between_ref_exp_and_datastream))
+        samples[6] = int(round(ref_exp.real))
+        samples[7] = int(round(ref_exp.imag))
+        samples[8] = np.array(self.LOGGER_MAGIC_BYTES, dtype=np.uint16).view(np.int16)
+        return samples
+
+    def synthesize_deep_capture(self, N, decimation):
+        # same as deep_capture() in monitor-tcp.c: the logger data, one sample out of decimation, without any header
+        selector = self.read_dpll_register(self.BUS_ADDR_MUX_SELECTORS)
+        if selector in (self.LOGGER_MUX['ADC0'], self.LOGGER_MUX['ADC1']):
+            return self.synthesize_adc_stream(selector, self.get_sample_number() + decimation*np.arange(N))
+        return self.synthesize_logger_data(selector, N)
+
+    def synthesize_ddc_samples(self, adc_number, N):
+        # instantaneous frequency, scaled as in read_ddc_samples_from_DDR2()
+        frequency_error = self.input_frequency[adc_number] - self.get_ref_frequency(adc_number)*self.fs
+        frequency_error = frequency_error + self.frequency_noise*self.rng.standard_normal(N)
+        return np.clip(np.round(frequency_error/(self.fs/4)*2**10), -2**15, 2**15-1).astype(np.int16)
+
+    def synthesize_counter_samples(self, N):
+        # 32 bits counts of the ADC0 signal over 1 second gates, most significant 16 bits first
+        frequencies = self.input_frequency[0] + self.frequency_noise*self.rng.standard_normal(N//2)
+        counts = np.round(frequencies).astype(np.uint32)
+        samples = np.empty((N//2, 2), dtype=np.uint16)
+        samples[:, 0] = counts >> 16
+        samples[:, 1] = counts & 0xFFFF
+        return samples.reshape(-1).view(np.int16)
+
+    def vna_transfer_function(self, frequency_axis, input_select, output_select):
+        # what the VNA measures for each of its frequencies, override to simulate another system
+        return np.exp(-1j*2*np.pi*frequency_axis*self.vna_delay) / (1 + 1j*frequency_axis/self.vna_pole_frequency)
+
+    def run_system_identification(self):
+        # fills the logger with one record per frequency: int64 real part, int64 imaginary part, uint32 integration time
+        # (see read_VNA_samples_from_DDR2())
+        number_of_cycles_integration    = self.read_dpll_register(self.BUS_ADDR_VNA+0)
+        first_modulation_frequency      = self.read_dpll_register(self.BUS_ADDR_VNA+1) | (self.read_dpll_register(self.BUS_ADDR_VNA+2) & 0xFFFF) << 32
+        modulation_frequency_step       = self.read_dpll_register(self.BUS_ADDR_VNA+3) | (self.read_dpll_register(self.BUS_ADDR_VNA+4) & 0xFFFF) << 32
+        number_of_frequencies           = self.read_dpll_register(self.BUS_ADDR_VNA+5) & 0xFFFF
+        output_gain                     = self.read_dpll_register(self.BUS_ADDR_VNA+6)
+        input_and_output_mux_selector   = self.read_dpll_register(self.BUS_ADDR_VNA+7) & 0xFFFF
+
+        vna_record = LoggerRecords.VNA_RECORD_DTYPE
+        number_of_frequencies = min(number_of_frequencies, 2*self.MAX_SAMPLES_READ_BUFFER//vna_record.itemsize)
+        frequency_axis = (first_modulation_frequency + modulation_frequency_step*np.arange(number_of_frequencies, dtype=np.float64))/2.**48*self.fs
+        transfer_function = self.vna_transfer_function(frequency_axis, input_and_output_mux_selector & 0x3, input_and_output_mux_selector >> 2)
+
+        overall_gain = 2.**(15-1) * output_gain * number_of_cycles_integration
+        records = np.zeros(number_of_frequencies, dtype=vna_record)
+        records['real'] = np.round(transfer_function.real * overall_gain)
+        records['imag'] = np.round(transfer_function.imag * overall_gain)
+        records['integration_time'] = number_of_cycles_integration
+        samples = records.view(np.int16)
+        self.logger_buffer[:] = 0
+        self.logger_buffer[:len(samples)] = samples
+        # each frequency takes two integration periods (see get_system_identification_wait_time()),
+        # and the logger keeps writing after the last record since it is not full
+        self.logger_progress = (time.perf_counter(), len(samples), max(2*number_of_cycles_integration*number_of_frequencies/self.fs, 1e-6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates monitor-tcp, the server which runs on the Red Pitaya.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added before each reply')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes/s for the replies (default: unlimited)')
+    args = parser.parse_args()
+
+    MonitorTCP_simulator(args.host, args.port, args.latency, args.bandwidth).serve_forever()
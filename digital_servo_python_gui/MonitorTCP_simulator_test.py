@@ -0,0 +1,403 @@
+import socket
+import threading
+import time
+
+import numpy as np
+
+from MonitorTCP_simulator import MonitorTCP_simulator
+from RP_PLL import RP_PLL_device
+from SuperLaserLand_JD_RP import SuperLaserLand_JD_RP
+
+def connect_to_simulator(unsupported_magic_bytes=()):
+    sim = MonitorTCP_simulator(seed=0)
+    sim.unsupported_magic_bytes = set(unsupported_magic_bytes)
+    sim.start()
+    sl = SuperLaserLand_JD_RP()
+    sl.dev.OpenTCPConnection('127.0.0.1', sim.PORT)
+    return (sim, sl)
+
+def test_registers():
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.set_dac_offset(0, -123)
+        assert(sl.get_dac_offset(0) == -123)
+        # never written: default value of the dpll_wrapper RAM
+        assert(sl.read_many_RAM_dpll_wrapper([0x7000], bWarnOnDefaultValue=False)[0] == sim.DPLL_WRAPPER_RAM_DEFAULT)
+        (freq_counter_sample, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_dual_mode_counter(0)
+        assert(dac0_samples[0] == -123)
+        assert(sl.dev.supports(sl.dev.MAGIC_BYTES_BATCH))
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_monitor_tcp_without_batch():
+    # an older monitor-tcp, which would drop the connection on a batch request
+    (sim, sl) = connect_to_simulator(unsupported_magic_bytes=[RP_PLL_device.MAGIC_BYTES_BATCH])
+    try:
+        assert(not sl.dev.supports(sl.dev.MAGIC_BYTES_BATCH))
+        with sl.dev.transaction() as t:
+            t.write_Zynq_register_uint32(sl.BUS_ADDR_DAC_offset[0]*4, 456)
+            dac0 = t.read_Zynq_register_int32(sl.BUS_ADDR_DAC0_CURRENT*4)
+        assert(dac0.value == 456)
+        sl.set_dac_offset(0, -123)
+        (freq_counter_sample, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_dual_mode_counter(0)
+        assert(dac0_samples[0] == -123)
+        assert(sl.dev.valid_socket)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_adc_capture():
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.set_ddc0_ref_freq(25e6)
+        sl.setup_ADC0_write(2**15)
+        sl.trigger_write()
+        sl.wait_for_write()
+        # the trigger went on the control channel and the samples come on the bulk channel: a read makes sure the trigger was served
+        sl.dev.read_Zynq_register_uint32(sl.BUS_ADDR_STATUS_FLAGS*4)
+        (samples, ref_exp0) = sl.read_adc_samples_from_DDR2(between_chunks=lambda: None)
+        assert(len(samples) == 2**15-9)
+
+        # the reference phasor in the header has to demodulate the input to its offset from the reference frequency
+        complex_baseband = sl.frontend_DDC_processing(samples, ref_exp0, 0)
+        phase = np.unwrap(np.angle(complex_baseband))
+        frequency_offset = np.polyfit(np.arange(len(phase)), phase, 1)[0]/(2*np.pi)*sl.fs
+        assert(abs(frequency_offset - (sim.input_frequency[0]-25e6)) < 10)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_file_write(tmp_path):
+    (sim, sl) = connect_to_simulator()
+    try:
+        (tmp_path / 'local.txt').write_bytes(b'file contents')
+        sl.dev.write_file_on_remote(str(tmp_path / 'local.txt'), '/opt/remote.txt')
+        # file writes have no reply
+        time_start = time.perf_counter()
+        while '/opt/remote.txt' not in sim.files and time.perf_counter() - time_start < 5.:
+            time.sleep(1e-3)
+        assert(sim.files['/opt/remote.txt'] == b'file contents')
+
+        # the client went away in the middle of a file write: the connection is dropped, without an exception
+        (client, server) = socket.socketpair()
+        client.sendall(b'short')
+        client.close()
+        assert(sim.handleWriteFile(server, 10, 1000) == False)
+        server.close()
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_counter_subscription():
+    (sim, sl) = connect_to_simulator()
+    sim.counter_update_rate = 200.
+    try:
+        sl.set_dac_offset(1, 456)
+        # the write has no reply and get_dac_offset() is served from the shadow registers: reading the DAC from the device
+        # makes sure the write was served before we subscribe
+        assert(sl.dev.read_many_int32([sl.BUS_ADDR_DAC1_CURRENT*4])[0] == 456)
+        with sl.subscribe_dual_mode_counter(records_per_push=4, max_latency=0.02) as subscription:
+            time.sleep(0.2)
+            records = np.concatenate([next(subscription), subscription.read(timeout=0.1)])
+        # every sample comes through, even though we were not reading while they were produced
+        assert(len(records) >= 10)
+        assert(np.all(np.diff(records['samples_number'].astype(np.int64)) == 1))
+        (freq_counter_samples, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.scale_counter_records(records, 0)
+        assert(np.all(np.abs(freq_counter_samples - sim.input_frequency[0]) < 10*sim.frequency_noise))
+        assert(np.all(dac1_samples == 456))
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_counter_backlog():
+    (sim, sl) = connect_to_simulator()
+    sim.counter_update_rate = 200.
+    try:
+        # monitor-tcp only polls the counter once the backlog was asked for
+        time.sleep(0.05)
+        assert(len(sim.counter_backlog) == 0)
+        assert(len(sl.dev.read_counter_backlog(0)) == 0)
+        time.sleep(0.05)
+        (freq_counter_samples, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_counter_backlog(0, first_samples_number=0)
+        time.sleep(0.2)
+        records = sl.dev.read_counter_backlog(sl.last_zdtc_samples_number_counter[0] + 1)
+        # the samples produced while we were not reading are all there
+        assert(len(records) >= 10)
+        assert(np.all(np.diff(records['samples_number'].astype(np.int64)) == 1))
+        (freq_counter_samples, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_counter_backlog(0)
+        assert(len(freq_counter_samples) >= len(records))
+        assert(np.all(np.abs(freq_counter_samples - sim.input_frequency[0]) < 10*sim.frequency_noise))
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_deep_capture(tmp_path):
+    (sim, sl) = connect_to_simulator()
+    try:
+        # more samples than the logger can hold, written straight to a file
+        N = 4*sl.dev.MAX_SAMPLES_READ_BUFFER
+        samples = sl.deep_capture('ADC0', N, decimation=5, strFilename=str(tmp_path / 'capture.npy'))
+        assert(len(samples) == N)
+        # at 125 MHz/5, the input at 25 MHz + 1 kHz aliases to 1 kHz
+        spectrum = np.abs(np.fft.rfft(np.load(str(tmp_path / 'capture.npy')).astype(float)))
+        frequency = np.argmax(spectrum)/N * sl.fs/5
+        assert(abs(frequency - (sim.input_frequency[0] - 25e6)) < sl.fs/5/N)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_capture_long():
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.set_ddc0_ref_freq(25e6)
+        N = 3*sl.dev.MAX_SAMPLES_READ_BUFFER + 100
+        (samples, dead_times, (frequency_axis, psd), (mean, variance)) = sl.capture_long('ADC0', N, nperseg=2**12)
+        assert(len(samples) == N)
+        assert(np.isclose(mean, np.mean(samples)) and np.isclose(variance, np.var(samples)))
+        # four blocks, with the logger's header stripped from each of them
+        assert(len(dead_times) == 4-1 and np.all(dead_times >= 0))
+        assert(abs(frequency_axis[np.argmax(psd)] - sim.input_frequency[0]) < sl.fs/2**12)
+        # the same spectrum, without keeping the samples
+        (no_samples, dead_times, (frequency_axis, psd_only), (mean, variance)) = sl.capture_long('ADC0', N, out=False, nperseg=2**12)
+        assert(no_samples is None)
+        assert(abs(mean) < 0.1*np.sqrt(variance))
+        assert(np.argmax(psd_only) == np.argmax(psd))
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_wait_for_logger():
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.setup_ADC0_write(2**15)
+        sl.trigger_write()
+        future = sl.wait_for_write_async()
+        future.result(timeout=5)
+        assert(sl.read_logger_samples_written() >= 2**15)
+
+        # the wait ends when the VNA has written its last record, not after the worst-case duration
+        sl.setup_system_identification(0, 0, 1e3, 1e5, 20, 1e-4, 100)
+        sl.trigger_system_identification()
+        time_start = time.perf_counter()
+        sl.wait_for_system_identification()
+        assert(time.perf_counter() - time_start < 1. + sl.get_system_identification_wait_time())
+        (transfer_function_complex, frequency_axis) = sl.read_VNA_samples_from_DDR2()
+        assert(len(transfer_function_complex) == 20)
+        # the phase goes negative: the imaginary parts are decoded as signed values
+        expected = sim.vna_transfer_function(frequency_axis, 0, 0)
+        assert(np.all(np.abs(transfer_function_complex - expected) < 1e-3))
+
+        # an aborted wait completes right away
+        sl.setup_ADC0_write(2**15)
+        future = sl.wait_for_logger_async(2**20, timeout=10.)
+        sl.abort_logger_wait()
+        future.result(timeout=1)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_wait_for_logger_fallback():
+    # an older bitstream, whose logger progress register reads 0: the wait ends after the worst-case duration, not the timeout
+    (sim, sl) = connect_to_simulator()
+    try:
+        sim.bLoggerProgressRegister = False
+        sl.setup_ADC0_write(2**15)
+        sl.trigger_write()
+        future = sl.wait_for_logger_async(2**15, timeout=10., write_duration=0.1)
+        assert(future.result(timeout=5) == 2**15)
+        assert(sl.dev.bLoggerProgressRegister == False)
+        (samples, ref_exp0) = sl.read_adc_samples_from_DDR2()
+        assert(len(samples) == 2**15-9)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+    # an older monitor-tcp, which would drop the connection on a wait request
+    (sim, sl) = connect_to_simulator(unsupported_magic_bytes=[RP_PLL_device.MAGIC_BYTES_WAIT_FOR_LOGGER])
+    try:
+        assert(not sl.dev.supports(sl.dev.MAGIC_BYTES_WAIT_FOR_LOGGER))
+        sl.setup_ADC0_write(2**15)
+        sl.trigger_write()
+        time_start = time.perf_counter()
+        future = sl.wait_for_logger_async(2**15, timeout=10., write_duration=0.1)
+        assert(future.result(timeout=5) == 2**15)
+        assert(time.perf_counter() - time_start < 5.)
+        (samples, ref_exp0) = sl.read_adc_samples_from_DDR2()
+        assert(len(samples) == 2**15-9)
+        assert(sl.dev.valid_socket)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_capture_pipeline():
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.set_ddc0_ref_freq(25e6)
+        stream = sl.capture_pipeline.addStream('ADC0', 2**12)
+        frame = stream.takeFrame(timeout=5)
+        assert(len(frame.samples) == 2**12-9)
+        # the next frame is captured while we are processing this one
+        time.sleep(0.2)
+        next_frame = stream.takeFrame()
+        assert(next_frame is not None and next_frame.frame_number == frame.frame_number + 1)
+        assert(next_frame.trigger_time < time.perf_counter() - 0.1)
+        stream.close()
+
+        # a callback consumer, sharing the logger with a generator consumer
+        ddc_frames = []
+        ddc_stream = sl.capture_pipeline.addStream('DDC0', 2**12, bReadAsDDC=True, callback=ddc_frames.append)
+        stream = sl.capture_pipeline.addStream('ADC0', 2**12)
+        for frame in stream.frames(timeout=5):
+            if frame.frame_number >= 3:
+                break
+        stream.close()
+        ddc_stream.close()
+        assert(len(ddc_frames) >= 1)
+        # the DDC samples are already in Hz, each frame with its own array
+        assert(len(ddc_frames[0].samples) == 2**12 and ddc_frames[0].samples.dtype == float)
+        assert(ddc_frames[-1].samples is not ddc_frames[0].samples)
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_capture_pipeline_sharing():
+    (sim, sl) = connect_to_simulator()
+    try:
+        # two windows which refresh at the same rate and display the same data
+        period = 0.05
+        streams = [sl.capture_pipeline.addStream('ADC0', 2**12, owner='window %d' % k, max_age=0.8*period) for k in range(2)]
+        N_ticks = 10
+        for tick in range(N_ticks):
+            frames = [stream.takeFrame(timeout=1) for stream in streams]
+            assert(frames[0] is not None and frames[1] is not None)
+            time.sleep(period)
+        for stream in streams:
+            stream.close()
+        # about one capture per refresh period, each one delivered to both windows
+        (frames_captured, frames_delivered, device_busy_fraction) = sl.capture_pipeline.getStatistics()
+        assert(frames_captured <= N_ticks + 3)
+        assert(frames_delivered >= 2*N_ticks)
+        assert(sl.capture_pipeline.sources == {})
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_device_state_hub():
+    (sim, sl) = connect_to_simulator()
+    sim.counter_update_rate = 200.
+    try:
+        sl.set_dac_offset(0, -123)
+        subscriptions = [sl.state_hub.subscribe(owner='counter %d' % k) for k in range(2)]
+        # three windows asking for the device state at each refresh: only one read per refresh period
+        period = 0.05
+        N_ticks = 10
+        for tick in range(N_ticks):
+            for window in range(3):
+                snapshot = sl.state_hub.getSnapshot(max_age=0.8*period)
+                assert(len(sl.readLEDs(max_age=0.8*period)) == 6)
+            time.sleep(period)
+        (snapshots_read, snapshots_requested, backlog_reads) = sl.state_hub.getStatistics()
+        assert(snapshots_read == N_ticks)
+        assert(snapshots_requested == 6*N_ticks)
+        # the counter updates faster than we refresh: the missed samples come from the backlog
+        assert(backlog_reads > 0)
+        assert(snapshot.dac_currents[0] == -123)
+
+        # each subscription gets every counter sample, even those updated between two snapshots
+        for subscription in subscriptions:
+            records = subscription.takeCounterRecords()
+            assert(len(records) >= 0.5*N_ticks*period*sim.counter_update_rate)
+            assert(np.all(np.diff(records['samples_number'].astype(np.int64)) == 1))
+            assert(records['samples_number'][-1] == snapshot.samples_number)
+            assert(len(subscription.takeCounterRecords()) == 0)
+            subscription.close()
+        (freq_counter_samples, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.scale_counter_records(records, 1)
+        assert(np.all(np.abs(freq_counter_samples - sim.input_frequency[1]) < 10*sim.frequency_noise))
+        assert(sl.state_hub.subscriptions == [])
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_counter_relatched_during_read():
+    (sim, sl) = connect_to_simulator()
+    try:
+        # each latch gets its own counts, which makes it easy to tell the samples apart
+        latch_counts = iter(range(1000, 2000))
+        sim.synthesize_counter_counts = lambda: np.array([next(latch_counts)]*2, dtype=np.int64)
+        latched = {}
+        relatches = [0]
+        read_counter_register = sim.read_counter_register
+        (accept_thread, backlog_thread) = sim.threads[:2]
+        def racingReadCounterRegister(bus_address):
+            if bus_address == sl.BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS and relatches[0] > 0 and threading.current_thread() is not backlog_thread:
+                # another reader latches the next sample in the middle of ours
+                relatches[0] -= 1
+                sim.time_start -= 1./sim.counter_update_rate
+                read_counter_register(sl.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER)
+            value = read_counter_register(bus_address)
+            latched[sim.counter_latch[0]] = int(sim.counter_latch[1][0])
+            return value
+        sim.read_counter_register = racingReadCounterRegister
+
+        relatches[0] = 2
+        snapshot = sl.state_hub.getSnapshot()
+        assert(relatches[0] == 0)
+        record = snapshot.counter_record
+        assert(record['counter0'][0] == record['counter1'][0] == latched[snapshot.samples_number])
+
+        relatches[0] = 2
+        (freq_counter_sample, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_dual_mode_counter(1)
+        assert(relatches[0] == 0)
+        samples_number = sl.last_zdtc_samples_number_counter[1]
+        assert(freq_counter_sample == sl.scaleCounterReadingsIntoHz(np.array([latched[samples_number]], dtype=np.int64)))
+    finally:
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_dither_sampler():
+    (sim, sl) = connect_to_simulator()
+    sim.dither_lockin_glitch_probability = 0.1
+    try:
+        # 25000 samples per modulation period, 100 periods: one lock-in result every 20 ms
+        sl.setupDitherLockIn(0, 25000, 100, 1000, 0)
+        sl.setDitherLockInState(0, True)
+        assert(sl.dither_sampler.getVCOGainEstimate(0)[0] is None)
+        time.sleep(1.)
+        (VCO_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers) = sl.dither_sampler.getVCOGainEstimate(0)
+        # about one read per integration period, and the glitches are not in the statistics
+        assert(N_results > 20 and N_outliers > 0)
+        assert(sl.dither_sampler.reads < 1.5*(N_results + N_outliers) + 5)
+        expected_gain = sl.scaleDitherResultsToHzPerVolts(np.array((-sim.dither_lockin_result[0],)), 0)[0]
+        assert(confidence_interval < 0.01*abs(expected_gain))
+        assert(abs(VCO_gain_in_Hz_per_Volts - expected_gain) < 3*confidence_interval)
+
+        # the statistics start over with new settings
+        sl.setupDitherLockIn(0, 25000, 50, 1000, 0)
+        assert(sl.dither_sampler.getStatistics(0)[2] == 0)
+    finally:
+        sl.setDitherLockInState(0, False)
+        sl.dither_sampler.stop()
+        sl.dev.CloseTCPConnection()
+        sim.stop()
+
+def test_dither_sampler_disconnection(caplog):
+    (sim, sl) = connect_to_simulator()
+    try:
+        sl.dither_sampler.ERROR_RETRY_PERIOD = 0.01
+        sl.setupDitherLockIn(0, 25000, 100, 1000, 0)
+        sl.setDitherLockInState(0, True)
+        sl.dither_sampler.start()
+        thread = sl.dither_sampler.thread
+        sl.dev.CloseTCPConnection()
+        time.sleep(0.2)
+        # a single warning for the whole disconnection
+        assert(len([record for record in caplog.records if 'dither lock-ins' in record.getMessage()]) == 1)
+        # as on a socket error: the worker exits on its own
+        sl.dither_sampler.stop(bWait=False)
+        thread.join(timeout=1.)
+        assert(not thread.is_alive())
+        assert(sl.dither_sampler.thread is None)
+    finally:
+        sl.dither_sampler.stop()
+        sim.stop()
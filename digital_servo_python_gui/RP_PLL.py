@@ -5,11 +5,17 @@ import socket
 import struct
 import traceback    # for print_stack, for debugging purposes: traceback.print_stack()
 import time
+import contextlib
+import collections
+import threading
+import bisect
 
 import sys
 
 import numpy as np
 import logging
+
+import WireTrace
 #import matplotlib.pyplot as plt
 
 class CommsError(Exception):
@@ -30,6 +36,363 @@ class socket_placeholder():
         print("socket_placeholder::recv(): No active socket")
         return []
 
+class PendingRegisterRead():
+    # Placeholder for the result of a register read queued in a RegisterTransaction.
+    # value is filled in when the transaction is flushed.
+    def __init__(self, bSigned=False):
+        self.bSigned = bSigned
+        self.value = None
+
+class RegisterTransaction():
+    # Queues register reads/writes so that they can be sent to monitor-tcp as a single MAGIC_BYTES_BATCH packet.
+    # Use through RP_PLL_device.transaction():
+    #   with dev.transaction() as t:
+    #       n = t.read_Zynq_register_uint32(addr)
+    #       t.write_Zynq_register_uint32(addr2, value)
+    #   print(n.value)
+    OPERATION_WRITE = 0
+    OPERATION_READ  = 1
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.operations = []
+        self.pending_reads = []
+
+    def write_Zynq_register_32bits(self, absolute_addr, data_32bits):
+        self.dev.validate_address(absolute_addr)
+        self.operations.append((self.OPERATION_WRITE, absolute_addr, int(data_32bits) & 0xFFFFFFFF))
+
+    def read_Zynq_register_32bits(self, absolute_addr, bSigned=False):
+        self.dev.validate_address(absolute_addr)
+        pending_read = PendingRegisterRead(bSigned)
+        self.operations.append((self.OPERATION_READ, absolute_addr, 0))
+        self.pending_reads.append(pending_read)
+        return pending_read
+
+    def write_Zynq_register_uint32(self, address_uint32, data_uint32):
+        self.write_Zynq_register_32bits(self.dev.FPGA_BASE_ADDR+address_uint32, data_uint32)
+
+    def write_Zynq_register_int32(self, address_uint32, data_int32):
+        self.write_Zynq_register_32bits(self.dev.FPGA_BASE_ADDR+address_uint32, data_int32)
+
+    def read_Zynq_register_uint32(self, address_uint32):
+        return self.read_Zynq_register_32bits(self.dev.FPGA_BASE_ADDR+address_uint32, bSigned=False)
+
+    def read_Zynq_register_int32(self, address_uint32):
+        return self.read_Zynq_register_32bits(self.dev.FPGA_BASE_ADDR+address_uint32, bSigned=True)
+
+    def read_Zynq_AXI_register_uint32(self, address_uint32):
+        return self.read_Zynq_register_32bits(self.dev.FPGA_BASE_ADDR_XADC+address_uint32, bSigned=False)
+
+    def flush(self):
+        # send everything queued so far, and fill in the results of the reads
+        operations = self.operations
+        pending_reads = self.pending_reads
+        self.operations = []
+        self.pending_reads = []
+        if len(operations) == 0:
+            return
+
+        read_values = self.dev.send_batch(operations)
+        for (pending_read, value) in zip(pending_reads, read_values):
+            if pending_read.bSigned:
+                pending_read.value = int(np.int32(value))
+            else:
+                pending_read.value = int(value)
+
+class ShadowRegisters():
+    # Image of the values last written to the registers, one per address space, plus the writes which have been staged but not sent yet.
+    # Staged writes are coalesced (only the last value written to each address is kept),
+    # and the ones which would not change the register value are dropped when they are flushed.
+    # Only state registers should be staged: writes to trigger registers have an effect even if the value doesn't change.
+    # The staged writes are kept per thread, like the transactions: a thread only flushes the writes it staged itself,
+    # so that a transaction on another thread can't send them before the caller's flush_register_writes().
+    def __init__(self, dev):
+        self.dev = dev
+        self.lock = threading.Lock()
+        self.images = {}    # address space -> {absolute_addr: value}
+        self.staged_writes = {}     # thread ident -> OrderedDict(absolute_addr -> value)
+
+    def address_space(self, absolute_addr):
+        if absolute_addr >= self.dev.FPGA_BASE_ADDR_XADC:
+            return 'axi'
+        # registers of the dpll (read back through the dpll_wrapper RAM at 2<<20), then the logger, at 1<<20:
+        return {0: 'dpll', 1: 'logger', 2: 'dpll_wrapper_ram'}.get((absolute_addr - self.dev.FPGA_BASE_ADDR) >> 20, 'other')
+
+    def stage(self, absolute_addr, data_32bits):
+        with self.lock:
+            self.staged_writes.setdefault(threading.get_ident(), collections.OrderedDict())[absolute_addr] = int(data_32bits) & 0xFFFFFFFF
+
+    def unstage(self, absolute_addr):
+        # a direct write supersedes the writes staged to the same address by every thread, they would otherwise overwrite it later
+        with self.lock:
+            for staged_writes in self.staged_writes.values():
+                staged_writes.pop(absolute_addr, None)
+
+    def takeChangedWrites(self):
+        # returns the writes staged by the calling thread which change the value of their register, in the order they were staged
+        with self.lock:
+            staged_writes = self.staged_writes.pop(threading.get_ident(), {})
+            return [(absolute_addr, value) for (absolute_addr, value) in staged_writes.items()
+                    if self.images.get(self.address_space(absolute_addr), {}).get(absolute_addr) != value]
+
+    def lookup(self, absolute_addr):
+        # returns the value we know the register has, or None if we don't know it
+        with self.lock:
+            return self.images.get(self.address_space(absolute_addr), {}).get(absolute_addr)
+
+    def recordWrite(self, absolute_addr, data_32bits):
+        # called once the write has actually been sent
+        with self.lock:
+            self.images.setdefault(self.address_space(absolute_addr), {})[absolute_addr] = int(data_32bits) & 0xFFFFFFFF
+
+    def invalidate(self, address_space=None):
+        # to be called whenever the registers might have changed without us writing them (reset, reconnection, new firmware...)
+        with self.lock:
+            if address_space is None:
+                self.images = {}
+            else:
+                self.images.pop(address_space, None)
+
+class TransportOperation():
+    # one request/reply exchange with monitor-tcp, as seen by TransportStatistics
+    def __init__(self, operation, caller, origin, bytes_sent, bytes_received):
+        self.operation = operation
+        self.caller = caller
+        self.origin = origin
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.bFailed = False
+
+class TransportStatistics():
+    # Counts every exchange with monitor-tcp: latency histogram, bytes sent and received, and errors,
+    # per operation (the packet type) and per call site.
+    # Each exchange is attributed to two call sites:
+    # caller: the first function outside of this module, usually a SuperLaserLand_JD_RP method (read_dual_mode_counter, etc)
+    # origin: the first function outside of the driver modules, typically the window or widget method which triggered the traffic
+    # Use snapshot() for the raw counters, summary() to aggregate them, and startPeriodicDump() to log them regularly.
+    # magic bytes -> operation name, filled from the RP_PLL_device.MAGIC_BYTES_* constants below RP_PLL_device
+    OPERATION_NAMES = {}
+    # upper edges of the latency histogram bins, in seconds: 4 bins per decade from 10 us to 10 s, plus one bin for everything above
+    LATENCY_BIN_EDGES = [10**(k/4.) for k in range(-20, 5)]
+    # modules which are skipped when looking for the call sites
+    TRANSPORT_MODULES = {__name__, 'contextlib'}
+    DRIVER_MODULES = {'SuperLaserLand_JD_RP', 'SuperLaserLand2_JD2_PLL'}
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':RP_PLL'
+
+        self.lock = threading.Lock()
+        self.counters = {}      # (operation, caller, origin) -> dict of counters
+        self.time_start = time.perf_counter()
+        self.thread_state = threading.local()   # the operation in progress in each thread
+        self.dump_thread = None
+        self.dump_stop_event = threading.Event()
+
+    def findCallSites(self):
+        # uses the same trick as socket_placeholder to find out who called us, without the cost of traceback.extract_stack()
+        frame = sys._getframe(2)
+        caller = None
+        while frame is not None:
+            module = frame.f_globals.get('__name__')
+            if module not in self.TRANSPORT_MODULES:
+                name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+                if '.' not in name:
+                    # a plain function, or a Python version without co_qualname
+                    name = '{}.{}'.format(module, name)
+                if caller is None:
+                    caller = name
+                if module not in self.DRIVER_MODULES:
+                    return (caller, name)
+            frame = frame.f_back
+        return (caller, caller)
+
+    @contextlib.contextmanager
+    def measure(self, magic_bytes, bytes_sent, bytes_received=0):
+        # wraps one request/reply exchange
+        (caller, origin) = self.findCallSites()
+        operation = TransportOperation(self.OPERATION_NAMES.get(magic_bytes, hex(magic_bytes)), caller, origin, bytes_sent, bytes_received)
+        previous_operation = getattr(self.thread_state, 'operation', None)
+        self.thread_state.operation = operation
+        time_start = time.perf_counter()
+        try:
+            yield operation
+        except Exception:
+            operation.bFailed = True
+            raise
+        finally:
+            self.thread_state.operation = previous_operation
+            self.record(operation, time.perf_counter()-time_start)
+
+    def recordError(self):
+        # called on socket errors, which are not always raised to the caller (see RP_PLL_device.read())
+        operation = getattr(self.thread_state, 'operation', None)
+        if operation is not None:
+            operation.bFailed = True
+
+    def record(self, operation, latency):
+        key = (operation.operation, operation.caller, operation.origin)
+        with self.lock:
+            counters = self.counters.get(key)
+            if counters is None:
+                counters = {'count': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0, 'total_time': 0., 'max_time': 0.,
+                            'histogram': [0]*(len(self.LATENCY_BIN_EDGES)+1)}
+                self.counters[key] = counters
+            counters['count'] += 1
+            counters['errors'] += operation.bFailed
+            counters['bytes_sent'] += operation.bytes_sent
+            counters['bytes_received'] += operation.bytes_received
+            counters['total_time'] += latency
+            counters['max_time'] = max(counters['max_time'], latency)
+            counters['histogram'][bisect.bisect_left(self.LATENCY_BIN_EDGES, latency)] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.time_start = time.perf_counter()
+
+    def snapshot(self):
+        # returns a copy of the counters: {(operation, caller, origin): {'count', 'errors', 'bytes_sent', 'bytes_received', 'total_time', 'max_time', 'histogram'}}
+        # histogram[k] counts the exchanges which took less than LATENCY_BIN_EDGES[k] (and more than the previous edge)
+        with self.lock:
+            return {key: dict(counters, histogram=list(counters['histogram'])) for (key, counters) in self.counters.items()}
+
+    def summary(self, group_by='origin'):
+        # aggregates the snapshot by 'operation', 'caller' or 'origin', sorted by decreasing total time
+        index = ('operation', 'caller', 'origin').index(group_by)
+        totals = {}
+        for (key, counters) in self.snapshot().items():
+            total = totals.get(key[index])
+            if total is None:
+                totals[key[index]] = counters
+                continue
+            for name in ('count', 'errors', 'bytes_sent', 'bytes_received', 'total_time'):
+                total[name] += counters[name]
+            total['max_time'] = max(total['max_time'], counters['max_time'])
+            total['histogram'] = [a+b for (a, b) in zip(total['histogram'], counters['histogram'])]
+        return sorted(totals.items(), key=lambda item: item[1]['total_time'], reverse=True)
+
+    def formatSummary(self, group_by='origin'):
+        elapsed = time.perf_counter() - self.time_start
+        lines = ['Device traffic over the last {:.1f} s, by {}:'.format(elapsed, group_by)]
+        for (name, counters) in self.summary(group_by):
+            lines.append('{:>8d} ops, {:>4d} errors, {:>10d} B sent, {:>12d} B received, {:8.3f} s busy ({:5.1f} %), mean {:8.3f} ms, max {:8.3f} ms: {}'.format(
+                counters['count'], counters['errors'], counters['bytes_sent'], counters['bytes_received'], counters['total_time'],
+                100.*counters['total_time']/max(elapsed, 1e-9), 1e3*counters['total_time']/counters['count'], 1e3*counters['max_time'], name))
+        return '\n'.join(lines)
+
+    def startPeriodicDump(self, period=60., group_by='origin', bReset=True):
+        # logs formatSummary() every period seconds, from a background thread
+        self.stopPeriodicDump()
+        self.dump_stop_event.clear()
+        self.dump_thread = threading.Thread(target=self.runPeriodicDump, args=(period, group_by, bReset), daemon=True)
+        self.dump_thread.start()
+
+    def stopPeriodicDump(self):
+        if self.dump_thread is not None:
+            self.dump_stop_event.set()
+            self.dump_thread.join()
+            self.dump_thread = None
+
+    def runPeriodicDump(self, period, group_by, bReset):
+        while not self.dump_stop_event.wait(period):
+            self.logger.info('Red_Pitaya_GUI{}: {}'.format(self.logger_name, self.formatSummary(group_by)))
+            if bReset:
+                self.reset()
+
+class CounterSubscription():
+    # Samples of the zero-deadtime counter, pushed by monitor-tcp on a dedicated connection (MAGIC_BYTES_SUBSCRIBE_COUNTERS).
+    # monitor-tcp reads the counters and the DAC current values at every counter update and sends one record per update,
+    # so no sample is lost no matter how late we are in reading them, unlike polling read_dual_mode_counter() from a timer.
+    # Iterating waits for at least one record, then returns all the records received so far as a numpy structured array
+    # of dtype RECORD_DTYPE. read(timeout=0) never blocks and can return zero records.
+    # close() unsubscribes.
+    # The GUI doesn't use it: its windows get every counter sample from DeviceStateHub (see DeviceStateHub.py), which reads the
+    # device state once per refresh for all of them and fills the gaps from the backlog (see read_counter_backlog()), while a
+    # subscription takes a connection and a monitor-tcp thread per subscriber. It is meant for the scripts which record the counters
+    # without the GUI, or need the samples sooner than the display refresh period.
+    RECORD_DTYPE = np.dtype([('samples_number', '<u4'),
+                             ('counter0', '<i8'),
+                             ('counter1', '<i8'),
+                             ('dac0', '<i4'),
+                             ('dac1', '<i4'),
+                             ('dac2', '<u4')])    # packed, same as binary_counter_record_t in monitor-tcp.c
+    MAX_RECORDS_PER_PUSH = 256  # should be equal to MAX_RECORDS_PER_PUSH in monitor-tcp.c
+
+    def __init__(self, dev, records_per_push=1, max_latency=0.1):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':RP_PLL'
+
+        records_per_push = max(1, min(int(records_per_push), self.MAX_RECORDS_PER_PUSH))
+        self.receive_buffer = bytearray(self.MAX_RECORDS_PER_PUSH*self.RECORD_DTYPE.itemsize)
+        self.pending_bytes = bytearray()    # received bytes which don't make a complete record yet
+        self.sock = dev.createSocket(WireTrace.CHANNEL_TELEMETRY)
+        try:
+            self.sock.connect((dev.HOST, dev.PORT))
+            self.sock.sendall(struct.pack('=III', dev.MAGIC_BYTES_SUBSCRIBE_COUNTERS, records_per_push, int(max_latency*1e6)))
+        except OSError as e:
+            self.sock.close()
+            raise CommsLoggeableError(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sock is None:
+            raise StopIteration
+        return self.read(timeout=None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def receive(self, timeout):
+        # appends whatever arrives within timeout to pending_bytes. returns False if nothing arrived
+        self.sock.settimeout(timeout)
+        try:
+            nbytes = self.sock.recv_into(self.receive_buffer)
+        except (socket.timeout, BlockingIOError):
+            return False
+        except OSError as e:
+            self.close()
+            raise CommsLoggeableError(e)
+        if nbytes == 0:
+            self.close()
+            raise CommsLoggeableError('counter subscription closed by the remote host')
+        self.pending_bytes += memoryview(self.receive_buffer)[:nbytes]
+        return True
+
+    def read(self, timeout=0):
+        # returns the complete records received so far, waiting up to timeout seconds (None: forever) for the first one
+        if self.sock is None:
+            raise CommsError('counter subscription is closed')
+        record_size = self.RECORD_DTYPE.itemsize
+        if len(self.pending_bytes) < record_size:
+            if timeout == 0:
+                self.receive(0)
+            else:
+                deadline = None if timeout is None else time.perf_counter() + timeout
+                while len(self.pending_bytes) < record_size:
+                    remaining_time = None if deadline is None else deadline - time.perf_counter()
+                    if remaining_time is not None and remaining_time <= 0:
+                        break
+                    self.receive(remaining_time)
+        # drain everything else which has already arrived
+        while self.receive(0):
+            pass
+        number_of_records = len(self.pending_bytes) // record_size
+        records = np.frombuffer(bytes(self.pending_bytes[:number_of_records*record_size]), self.RECORD_DTYPE)
+        del self.pending_bytes[:number_of_records*record_size]
+        return records
+
 class RP_PLL_device():
 
     MAGIC_BYTES_WRITE_REG       = 0xABCD1233
@@ -39,11 +402,24 @@ class RP_PLL_device():
     MAGIC_BYTES_WRITE_FILE      = 0xABCD1237
     MAGIC_BYTES_SHELL_COMMAND   = 0xABCD1238
     MAGIC_BYTES_REBOOT_MONITOR  = 0xABCD1239
+    MAGIC_BYTES_BATCH           = 0xABCD123A
+    MAGIC_BYTES_READ_BUFFER_CHUNK = 0xABCD123B
+    MAGIC_BYTES_SUBSCRIBE_COUNTERS = 0xABCD123C
+    MAGIC_BYTES_READ_COUNTER_BACKLOG = 0xABCD123D
+    MAGIC_BYTES_DEEP_CAPTURE    = 0xABCD123E
+    MAGIC_BYTES_WAIT_FOR_LOGGER = 0xABCD123F
     
     FPGA_BASE_ADDR              = 0x40000000    # address of the main PS <-> PL memory map (GP 0 AXI master on PS)
     FPGA_BASE_ADDR_XADC         = 0x80000000    # address of the XADC PS <-> PL memory map (GP 1 AXI master on PS)
 
     MAX_SAMPLES_READ_BUFFER = 2**15 # should be equal to 2**ADDRESS_WIDTH from ram_data_logger.vhd
+    MAX_BATCH_OPERATIONS = 1024     # should be equal to MAX_BATCH_OPERATIONS in monitor-tcp.c
+    MAX_BACKLOG_RECORDS_PER_READ = 4096 # should be equal to MAX_BACKLOG_RECORDS_PER_READ in monitor-tcp.c
+    MAX_POINTS_DEEP_CAPTURE = 2**25     # should be equal to DEEP_CAPTURE_MAX_POINTS in monitor-tcp.c
+    DEEP_CAPTURE_FLAG_OVERFLOW = 1      # flags returned by deep_capture_into(), same as in monitor-tcp.c
+    DEEP_CAPTURE_FLAG_TIMEOUT  = 2
+    SOCKET_TIMEOUT = 2                  # in seconds
+    PROBE_TIMEOUT = 0.5                 # in seconds, see probeServer()
 
 
     def __init__(self, controller=None):
@@ -53,13 +429,49 @@ class RP_PLL_device():
         self.sock = socket_placeholder()
         self.controller = controller
         self.valid_socket = False
+        # held for the duration of each request/reply exchange, so that several threads can share the socket
+        # (see DeviceIOThread.py) without interleaving their packets or stealing each other's replies
+        self.io_lock = threading.RLock()
+        # transactions are per-thread: a transaction opened in one thread must not capture the writes made by another
+        self.transaction_state = threading.local()
+        self.shadow_registers = ShadowRegisters(self)
+        # latency, bytes and errors of every exchange with monitor-tcp, see TransportStatistics
+        self.statistics = TransportStatistics()
+
+        # Second connection to monitor-tcp, used for the large transfers (logger buffer reads, file writes)
+        # so that the register traffic on the control connection (self.sock) never waits behind them.
+        # monitor-tcp forks a process for each connection, so both are served in parallel.
+        # The file writes and the shell/reboot commands all go on this channel, which keeps them in order.
+        # When the bulk channel is not connected, everything goes through the control connection instead.
+        self.bulk_sock = None
+        self.valid_bulk_socket = False
+        self.bulk_io_lock = threading.RLock()
+
+        # record/replay of the traffic, see WireTrace.py
+        self.trace_recorder = None
+        self.trace_replay = None
+
+        # magic bytes: whether the monitor-tcp we are connected to knows this request, see probeServer()
+        self.server_capabilities = {}
+        # whether the bitstream has the logger progress register which MAGIC_BYTES_WAIT_FOR_LOGGER polls,
+        # None until we know (see probeServer() and SuperLaserLand_JD_RP.run_logger_wait())
+        self.bLoggerProgressRegister = None
 
         self.type_to_format_string = {False: '=III',
                                       True: '=IIi'}
 
+    @property
+    def current_transaction(self):
+        return getattr(self.transaction_state, 'transaction', None)
+
+    @current_transaction.setter
+    def current_transaction(self, transaction):
+        self.transaction_state.transaction = transaction
+
     def socketErrorEvent(self, e):
         # disconnect from socket, and start reconnection timer:
         print("RP_PLL::socketErrorEvent()")
+        self.statistics.recordError()
         if self.controller is not None:
             self.controller.socketErrorEvent(e)
         else:
@@ -67,78 +479,211 @@ class RP_PLL_device():
             self.CloseTCPConnection()
             raise CommsLoggeableError(e)
 
+    def bulkSocketErrorEvent(self, e):
+        # The bulk channel has its own reconnection: the transfer in progress is lost, but if the device is still there
+        # we can simply reconnect the bulk channel without disturbing the control connection.
+        print("RP_PLL::bulkSocketErrorEvent()")
+        self.statistics.recordError()
+        self.logger.warning('Red_Pitaya_GUI{}: socket error on the bulk channel: {}'.format(self.logger_name, repr(e)))
+        self.CloseBulkConnection()
+        if self.valid_socket:
+            self.OpenBulkConnection()
+        if not self.valid_bulk_socket:
+            # the device is unreachable: let the controller handle the reconnection of both channels
+            self.socketErrorEvent(e)
+        raise CommsLoggeableError(e)
+
     def CloseTCPConnection(self):
         print("RP_PLL_device::CloseTCPConnection()")
         self.sock = None # socket_placeholder()
         self.valid_socket = False
+        self.CloseBulkConnection()
 
-    def OpenTCPConnection(self, HOST, PORT=5000, valid_socket_for_general_comms=True):
+    def OpenTCPConnection(self, HOST, PORT=5000, valid_socket_for_general_comms=True, bOpenBulkChannel=True):
         print("RP_PLL_device::OpenTCPConnection(): HOST = '%s', PORT = %d" % (HOST, PORT))
         self.HOST = HOST
         self.PORT = PORT
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # this avoids a ~33 ms on Windows before our request packets are sent (!!)
-        # self.sock.setblocking(1)
-        self.sock.settimeout(2)
+        self.sock = self.createSocket(WireTrace.CHANNEL_CONTROL)
+        # we can't know what happened to the registers while we were disconnected
+        self.shadow_registers.invalidate()
         try:
             self.sock.connect((self.HOST, self.PORT))
             self.valid_socket = valid_socket_for_general_comms
         except Exception as e:
             logging.error(traceback.format_exc())
             self.valid_socket = False
+            return
+        self.probeServer()
+        if bOpenBulkChannel:
+            self.OpenBulkConnection()
+
+    def probeServer(self):
+        # An older monitor-tcp doesn't know the requests which were added since, and drops the connection when it receives
+        # their magic bytes. So each of them is tried once per connection, on a throw-away connection,
+        # and the callers fall back to the basic requests for the ones which are missing (see supports()).
+        # The probes only read harmless values: the XADC temperature, and the logger progress.
+        probes = [
+            (self.MAGIC_BYTES_BATCH, struct.pack('=III', self.MAGIC_BYTES_BATCH, 1, 0)
+                + struct.pack('=III', RegisterTransaction.OPERATION_READ, self.FPGA_BASE_ADDR_XADC+0x200, 0)),
+            (self.MAGIC_BYTES_WAIT_FOR_LOGGER, struct.pack('=III', self.MAGIC_BYTES_WAIT_FOR_LOGGER, 0, 0)),
+        ]
+        self.server_capabilities = {}
+        self.bLoggerProgressRegister = None
+        for (magic_bytes, packet_to_send) in probes:
+            reply = self.probeRequest(packet_to_send, 4)
+            if reply is None:
+                # we couldn't even connect, so we don't know: same as before the probes existed
+                continue
+            bSupported = (reply is not False)
+            self.server_capabilities[magic_bytes] = bSupported
+            if magic_bytes == self.MAGIC_BYTES_WAIT_FOR_LOGGER and bSupported and struct.unpack('=I', reply)[0] > 0:
+                # an older bitstream reads 0, but so does a newer one which hasn't been triggered since it was loaded
+                self.bLoggerProgressRegister = True
+            if not bSupported:
+                self.logger.warning('Red_Pitaya_GUI{}: monitor-tcp on {} does not support the {} request, using the older requests instead. Update monitor-tcp for better performance.'.format(
+                    self.logger_name, self.HOST, TransportStatistics.OPERATION_NAMES.get(magic_bytes, hex(magic_bytes))))
+
+    def probeRequest(self, packet_to_send, reply_length):
+        # returns the server's reply to packet_to_send (reply_length bytes), False if it didn't answer, or None if we couldn't connect
+        sock = self.createSocket(WireTrace.CHANNEL_PROBE)
+        try:
+            sock.connect((self.HOST, self.PORT))
+        except OSError:
+            sock.close()
+            return None
+        try:
+            sock.settimeout(self.PROBE_TIMEOUT)
+            sock.sendall(packet_to_send)
+            reply = bytearray(reply_length)
+            if self.recvall_into(reply, sock) is None:
+                return False
+            return bytes(reply)
+        except OSError:
+            # including the timeout, if the server ignored the request
+            return False
+        finally:
+            sock.close()
+
+    def supports(self, magic_bytes):
+        # the requests which were not probed (for example when the sockets are mocked) are assumed to be supported
+        return self.server_capabilities.get(magic_bytes, True)
+
+    def createSocket(self, channel=WireTrace.CHANNEL_CONTROL):
+        if self.trace_replay is not None:
+            return self.trace_replay.createSocket(channel)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # this avoids a ~33 ms on Windows before our request packets are sent (!!)
+        # sock.setblocking(1)
+        sock.settimeout(self.SOCKET_TIMEOUT)
+        if self.trace_recorder is not None:
+            sock = self.trace_recorder.wrapSocket(sock, channel)
+        return sock
+
+    #######################################################
+    # Record and replay of the traffic (see WireTrace.py)
+    #######################################################
+
+    def startRecording(self, strFilename):
+        # records everything sent and received on both channels to strFilename, until stopRecording()
+        self.stopRecording()
+        self.trace_recorder = WireTrace.TraceRecorder(strFilename)
+        # the connections which are already open are recorded from now on
+        with self.io_lock:
+            if self.valid_socket:
+                self.sock = self.trace_recorder.wrapSocket(self.sock, WireTrace.CHANNEL_CONTROL, bConnected=True)
+        with self.bulk_io_lock:
+            if self.valid_bulk_socket:
+                self.bulk_sock = self.trace_recorder.wrapSocket(self.bulk_sock, WireTrace.CHANNEL_BULK, bConnected=True)
+
+    def stopRecording(self):
+        if self.trace_recorder is None:
+            return
+        with self.io_lock:
+            if isinstance(self.sock, WireTrace.RecordingSocket):
+                self.sock = self.sock.sock
+        with self.bulk_io_lock:
+            if isinstance(self.bulk_sock, WireTrace.RecordingSocket):
+                self.bulk_sock = self.bulk_sock.sock
+        self.trace_recorder.close()
+        self.trace_recorder = None
+
+    def startReplay(self, strFilename, bRealTime=True):
+        # the next connections are served from the recording in strFilename instead of the network.
+        # bRealTime=False serves the replies as fast as possible
+        self.trace_replay = WireTrace.TraceReplay(strFilename, bRealTime)
+
+    def stopReplay(self):
+        self.trace_replay = None
+
+    def subscribe_counters(self, records_per_push=1, max_latency=0.1):
+        # opens a separate connection on which monitor-tcp pushes the counter samples, see CounterSubscription
+        return CounterSubscription(self, records_per_push, max_latency)
+
+    def OpenBulkConnection(self):
+        with self.bulk_io_lock:
+            self.bulk_sock = self.createSocket(WireTrace.CHANNEL_BULK)
+            try:
+                self.bulk_sock.connect((self.HOST, self.PORT))
+                self.valid_bulk_socket = True
+            except Exception as e:
+                # not fatal, the bulk transfers will go through the control connection
+                self.logger.warning('Red_Pitaya_GUI{}: could not open the bulk channel: {}'.format(self.logger_name, repr(e)))
+                self.bulk_sock = None
+                self.valid_bulk_socket = False
+
+    def CloseBulkConnection(self):
+        self.valid_bulk_socket = False
+        bulk_sock = self.bulk_sock
+        self.bulk_sock = None
+        if bulk_sock is not None:
+            bulk_sock.close()
 
     # from http://stupidpythonideas.blogspot.ca/2013/05/sockets-are-byte-streams-not-message.html
     def recvall(self, count):
-        buf = b''
-        
-        while count:
-            newbuf = self.sock.recv(count)
-            if not newbuf: return None
-            buf += newbuf
-            count -= len(newbuf)
-            
+        buf = bytearray(count)
+        if self.recvall_into(memoryview(buf)) is None:
+            return None
         return buf
 
+    # same as recvall(), but receives directly into a pre-allocated writable buffer (bytearray, memoryview, numpy array...)
+    # this avoids both the quadratic cost of growing a bytes object and the copy into the final array
+    def recvall_into(self, buffer, sock=None):
+        if sock is None:
+            sock = self.sock
+        view = memoryview(buffer).cast('B')
+        count = len(view)
+        offset = 0
+        while offset < count:
+            nbytes = sock.recv_into(view[offset:], count-offset)
+            if nbytes == 0: return None
+            offset += nbytes
+
+        return count
+
     # Function used to send a file write command:
     def write_file_on_remote(self, strFilenameLocal, strFilenameRemote):
         # open local file and load into memory:
         file_data = np.fromfile(strFilenameLocal, dtype=np.uint8)
-        try:
-            # send header
-            packet_to_send = struct.pack('=III', self.MAGIC_BYTES_WRITE_FILE, len(strFilenameRemote), len(file_data))
-            self.sock.sendall(packet_to_send)
-            # send filename
-            self.sock.sendall(strFilenameRemote.encode('ascii'))
-            # send actual file
-            self.sock.sendall(file_data.tobytes())
-        except OSError as e:
-            print("RP_PLL.py: write_file_on_remote(): exception while sending file!")
-            self.logger.warning('Red_Pitaya_GUI{}: write_file_on_remote(): exception while sending file!'.format(self.logger_name))
-            self.socketErrorEvent(e)
+        # header, filename, then the actual file
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_WRITE_FILE, len(strFilenameRemote), len(file_data))
+        packet_to_send = packet_to_send + strFilenameRemote.encode('ascii') + file_data.tobytes()
+        with self.statistics.measure(self.MAGIC_BYTES_WRITE_FILE, len(packet_to_send)):
+            self.send_bulk(packet_to_send)
 
     # Function used to send a shell command to the Red Pitaya:
     def send_shell_command(self, strCommand):
-        try:
-            # send header
-            packet_to_send = struct.pack('=III', self.MAGIC_BYTES_SHELL_COMMAND, len(strCommand), 0)
-            self.sock.sendall(packet_to_send)
-            # send command
-            self.sock.sendall(strCommand.encode('ascii'))
-        except OSError as e:
-            print("RP_PLL.py: send_shell_command(): exception while sending command!")
-            self.logger.warning('Red_Pitaya_GUI{}: send_shell_command(): exception while sending command!'.format(self.logger_name))
-            self.socketErrorEvent(e)
+        # on the bulk channel, so that the command runs after the files written before it
+        # header, then the command
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_SHELL_COMMAND, len(strCommand), 0) + strCommand.encode('ascii')
+        with self.statistics.measure(self.MAGIC_BYTES_SHELL_COMMAND, len(packet_to_send)):
+            self.send_bulk(packet_to_send)
 
     # Function used to reboot the monitor-tcp program
     def send_reboot_command(self):
-        try:
-            # send header
-            packet_to_send = struct.pack('=III', self.MAGIC_BYTES_REBOOT_MONITOR, 0, 0)
-            self.sock.sendall(packet_to_send)
-        except OSError as e:
-            print("RP_PLL.py: send_reboot_command(): exception while sending command!")
-            self.logger.warning('Red_Pitaya_GUI{}: send_reboot_command(): exception while sending command!'.format(self.logger_name))
-            self.socketErrorEvent(e)
+        # send header
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_REBOOT_MONITOR, 0, 0)
+        with self.statistics.measure(self.MAGIC_BYTES_REBOOT_MONITOR, len(packet_to_send)):
+            self.send_bulk(packet_to_send)
 
     def validate_address(self, addr):
         if addr % 4:
@@ -155,7 +700,8 @@ class RP_PLL_device():
             raise CommsError
 
         try:
-            self.sock.sendall(packet_to_send)
+            with self.io_lock:
+                self.sock.sendall(packet_to_send)
         except OSError as e:
             print("RP_PLL::send(): caught exception")
             logging.error(traceback.format_exc())
@@ -178,29 +724,273 @@ class RP_PLL_device():
             print("RP_PLL::read(): unhandled exception")
 
         if data_buffer is None:
+            self.statistics.recordError()
             return bytes(bytes_to_read)
         else:
             return data_buffer
 
+    def read_into(self, buffer):
+        if self.valid_socket == False:
+            raise CommsError
+
+        bytes_received = None
+        try:
+            bytes_received = self.recvall_into(buffer)
+        except OSError as e:
+            print("RP_PLL::read_into(): caught exception")
+            logging.error(traceback.format_exc())
+            self.socketErrorEvent(e)
+        except:
+            print("RP_PLL::read_into(): unhandled exception")
+
+        if bytes_received is None:
+            self.statistics.recordError()
+            # same behavior as read(): return all zeros on failure
+            memoryview(buffer).cast('B')[:] = bytes(memoryview(buffer).nbytes)
+
+    #######################################################
+    # Bulk channel. Fall back to the control connection when it is not available
+    #######################################################
+
+    def send_bulk(self, packet_to_send):
+        if not self.valid_bulk_socket:
+            return self.send(packet_to_send)
+
+        try:
+            with self.bulk_io_lock:
+                self.bulk_sock.sendall(packet_to_send)
+        except OSError as e:
+            print("RP_PLL::send_bulk(): caught exception")
+            logging.error(traceback.format_exc())
+            self.bulkSocketErrorEvent(e)
+
+    def read_bulk_into(self, buffer):
+        if not self.valid_bulk_socket:
+            return self.read_into(buffer)
+
+        bytes_received = None
+        try:
+            bytes_received = self.recvall_into(buffer, self.bulk_sock)
+        except OSError as e:
+            print("RP_PLL::read_bulk_into(): caught exception")
+            logging.error(traceback.format_exc())
+            self.bulkSocketErrorEvent(e)
+
+        if bytes_received is None:
+            # the connection was closed by the other end
+            self.bulkSocketErrorEvent(CommsError('bulk channel closed by the remote host'))
+
+    def bulk_lock(self):
+        # lock held for a whole request/reply exchange on the bulk channel
+        if self.valid_bulk_socket:
+            return self.bulk_io_lock
+        else:
+            return self.io_lock
+
     def write_Zynq_register_32bits(self, absolute_addr, data_32bits, bSigned=False):
+        # a direct write supersedes any staged write to the same address
+        self.shadow_registers.unstage(absolute_addr)
+        if self.current_transaction is not None:
+            # writes are queued until the end of the transaction
+            self.current_transaction.write_Zynq_register_32bits(absolute_addr, data_32bits)
+            return
         self.validate_address(absolute_addr)
         packet_to_send = struct.pack(self.type_to_format_string[bSigned], self.MAGIC_BYTES_WRITE_REG, absolute_addr, int(data_32bits) & 0xFFFFFFFF)
-        self.send(packet_to_send)
+        with self.statistics.measure(self.MAGIC_BYTES_WRITE_REG, len(packet_to_send)):
+            self.send(packet_to_send)
+        self.shadow_registers.recordWrite(absolute_addr, data_32bits)
+
+    def stage_Zynq_register_32bits(self, absolute_addr, data_32bits):
+        # the write is only sent at the next flush_staged_registers() (UpdateWireIns() or the end of a transaction),
+        # and only if it changes the value of the register
+        self.validate_address(absolute_addr)
+        self.shadow_registers.stage(absolute_addr, data_32bits)
+
+    def flush_staged_registers(self):
+        changed_writes = self.shadow_registers.takeChangedWrites()
+        if len(changed_writes) == 0:
+            return
+        with self.transaction():
+            for (absolute_addr, value) in changed_writes:
+                self.write_Zynq_register_32bits(absolute_addr, value)
 
     def read_Zynq_register_32bits(self, absolute_addr, bIsAXI=False):
+        if self.current_transaction is not None:
+            # a direct read needs its answer right away, so the writes queued before it have to go out first
+            self.current_transaction.flush()
         self.validate_address(absolute_addr)
         packet_to_send = struct.pack('=III', self.MAGIC_BYTES_READ_REG, absolute_addr, 0)  # last value is reserved
-        self.send(packet_to_send)
-        return self.read(4)
+        with self.io_lock, self.statistics.measure(self.MAGIC_BYTES_READ_REG, len(packet_to_send), 4):
+            self.send(packet_to_send)
+            return self.read(4)
+
+    def read_many_Zynq_registers_32bits(self, absolute_addresses):
+        # Pipelined reads: all the read requests are sent back-to-back, then all the replies are collected.
+        # monitor-tcp answers the requests in order, so this needs no change to the protocol,
+        # but costs a single round-trip instead of one per register.
+        if self.current_transaction is not None:
+            self.current_transaction.flush()
+        absolute_addresses = np.asarray(absolute_addresses, dtype=np.uint32).reshape(-1)
+        for absolute_addr in absolute_addresses:
+            self.validate_address(int(absolute_addr))
+
+        packets_to_send = np.zeros((len(absolute_addresses), 3), dtype=np.uint32)
+        packets_to_send[:, 0] = self.MAGIC_BYTES_READ_REG
+        packets_to_send[:, 1] = absolute_addresses
+        # last value is reserved
+        results = np.empty(len(absolute_addresses), dtype=np.uint32)
+        with self.io_lock, self.statistics.measure(self.MAGIC_BYTES_READ_REG, packets_to_send.nbytes, results.nbytes):
+            self.send(packets_to_send.tobytes())
+            results[:] = np.frombuffer(self.read(4*len(absolute_addresses)), dtype=np.uint32)
+        return results
 
     def read_Zynq_buffer_int16(self, number_of_points):
         if number_of_points > self.MAX_SAMPLES_READ_BUFFER:
             number_of_points = self.MAX_SAMPLES_READ_BUFFER
             print("number of points clamped to %d." % number_of_points)
 
+        data_buffer = np.empty(number_of_points, dtype=np.int16)
+        self.read_Zynq_buffer_int16_into(data_buffer)
+        return data_buffer.tobytes()
+
+    def read_Zynq_buffer_int16_into(self, data_buffer):
+        # Same as read_Zynq_buffer_int16(), but the samples are received directly into data_buffer (a contiguous int16 numpy array),
+        # without any intermediate copy. The number of points read is len(data_buffer), clamped to MAX_SAMPLES_READ_BUFFER.
+        # returns a view on the part of data_buffer which was filled
+        number_of_points = len(data_buffer)
+        if number_of_points > self.MAX_SAMPLES_READ_BUFFER:
+            number_of_points = self.MAX_SAMPLES_READ_BUFFER
+            print("number of points clamped to %d." % number_of_points)
+
         packet_to_send = struct.pack('=III', self.MAGIC_BYTES_READ_BUFFER, self.FPGA_BASE_ADDR, number_of_points)    # last value is reserved
-        self.send(packet_to_send)
-        return self.read(int(2*number_of_points))
+        with self.bulk_lock(), self.statistics.measure(self.MAGIC_BYTES_READ_BUFFER, len(packet_to_send), 2*number_of_points):
+            self.send_bulk(packet_to_send)
+            self.read_bulk_into(data_buffer[:number_of_points])
+        return data_buffer[:number_of_points]
+
+    def read_Zynq_buffer_int16_chunk_into(self, data_buffer, start_point):
+        # Reads len(data_buffer) points of the logger buffer, starting at start_point.
+        # A large buffer read can be split in several chunks this way, so that the socket is not held for the whole transfer
+        # returns a view on the part of data_buffer which was filled
+        start_point = min(start_point, self.MAX_SAMPLES_READ_BUFFER)
+        number_of_points = min(len(data_buffer), self.MAX_SAMPLES_READ_BUFFER - start_point)  # same clamping as monitor-tcp
+
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_READ_BUFFER_CHUNK, start_point, number_of_points)
+        with self.bulk_lock(), self.statistics.measure(self.MAGIC_BYTES_READ_BUFFER_CHUNK, len(packet_to_send), 2*number_of_points):
+            self.send_bulk(packet_to_send)
+            self.read_bulk_into(data_buffer[:number_of_points])
+        return data_buffer[:number_of_points]
+
+    def deep_capture_into(self, data_buffer, decimation=1, capture_duration=0.):
+        # Captures len(data_buffer) points of the data selected by the logger multiplexer into the device's RAM, through the fifo,
+        # then receives them directly into data_buffer (any contiguous int16 array, including a numpy memmap).
+        # capture_duration is how long the device takes to capture the data, so that we know how long to wait for the reply.
+        # returns (the part of data_buffer which was filled, flags), where flags is a combination of the DEEP_CAPTURE_FLAG_* values
+        if not (self.valid_socket or self.valid_bulk_socket):
+            raise CommsError
+        number_of_points = min(len(data_buffer), self.MAX_POINTS_DEEP_CAPTURE)
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_DEEP_CAPTURE, number_of_points, int(decimation))
+        reply_header = np.zeros(2, dtype=np.uint32)
+        with self.bulk_lock(), self.statistics.measure(self.MAGIC_BYTES_DEEP_CAPTURE, len(packet_to_send), reply_header.nbytes) as operation:
+            sock = self.bulk_sock if self.valid_bulk_socket else self.sock
+            # the reply comes only after the capture. monitor-tcp gives up after 1 second without data
+            sock.settimeout(self.SOCKET_TIMEOUT + 1. + capture_duration)
+            try:
+                self.send_bulk(packet_to_send)
+                self.read_bulk_into(reply_header)
+            finally:
+                sock.settimeout(self.SOCKET_TIMEOUT)
+            number_of_points = min(int(reply_header[0]), number_of_points)
+            self.read_bulk_into(data_buffer[:number_of_points])
+            operation.bytes_received += 2*number_of_points
+        return (data_buffer[:number_of_points], int(reply_header[1]))
+
+    def wait_for_logger(self, number_of_samples, timeout):
+        # Blocks until the logger has written number_of_samples samples since its last trigger, or for timeout seconds.
+        # monitor-tcp polls the logger and replies as soon as the samples are there. This goes on the bulk channel,
+        # so the register traffic is not held up: the caller has to make sure the trigger was served first, since it goes on the control channel.
+        # returns the number of samples written, which is smaller than number_of_samples on timeout.
+        # Check supports(MAGIC_BYTES_WAIT_FOR_LOGGER) and bLoggerProgressRegister first, see SuperLaserLand_JD_RP.run_logger_wait()
+        if not (self.valid_socket or self.valid_bulk_socket):
+            raise CommsError
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_WAIT_FOR_LOGGER, int(number_of_samples), int(max(timeout, 0.)*1e6))
+        samples_written = np.zeros(1, dtype=np.uint32)
+        with self.bulk_lock(), self.statistics.measure(self.MAGIC_BYTES_WAIT_FOR_LOGGER, len(packet_to_send), samples_written.nbytes):
+            sock = self.bulk_sock if self.valid_bulk_socket else self.sock
+            sock.settimeout(self.SOCKET_TIMEOUT + timeout)
+            try:
+                self.send_bulk(packet_to_send)
+                self.read_bulk_into(samples_written)
+            finally:
+                sock.settimeout(self.SOCKET_TIMEOUT)
+        return int(samples_written[0])
+
+    def read_counter_backlog(self, first_samples_number, max_records=MAX_BACKLOG_RECORDS_PER_READ):
+        # Counter samples buffered by monitor-tcp's counter backlog thread, from first_samples_number onwards
+        # (or from the oldest one still in the buffer), as a numpy structured array of dtype CounterSubscription.RECORD_DTYPE.
+        # Fewer than max_records are returned only when we have caught up with the device.
+        max_records = max(1, min(int(max_records), self.MAX_BACKLOG_RECORDS_PER_READ))
+        packet_to_send = struct.pack('=III', self.MAGIC_BYTES_READ_COUNTER_BACKLOG, int(first_samples_number) & 0xFFFFFFFF, max_records)
+        number_of_records = np.zeros(1, dtype=np.uint32)
+        with self.bulk_lock(), self.statistics.measure(self.MAGIC_BYTES_READ_COUNTER_BACKLOG, len(packet_to_send), number_of_records.nbytes) as operation:
+            self.send_bulk(packet_to_send)
+            self.read_bulk_into(number_of_records)
+            records = np.empty(min(int(number_of_records[0]), max_records), dtype=CounterSubscription.RECORD_DTYPE)
+            self.read_bulk_into(records)
+            operation.bytes_received += records.nbytes
+        return records
+
+    def send_batch(self, operations):
+        # operations is a list of (operation, absolute_addr, value) tuples, with operation one of RegisterTransaction.OPERATION_*
+        # returns the values of all the reads, in order, as a uint32 numpy array
+        read_values = []
+        bBatchSupported = self.supports(self.MAGIC_BYTES_BATCH)
+        for k in range(0, len(operations), self.MAX_BATCH_OPERATIONS):
+            chunk = np.array(operations[k:k+self.MAX_BATCH_OPERATIONS], dtype=np.uint32)
+            bReads = (chunk[:, 0] == RegisterTransaction.OPERATION_READ)
+            number_of_reads = int(np.count_nonzero(bReads))
+            if bBatchSupported:
+                magic_bytes = self.MAGIC_BYTES_BATCH
+                packet_to_send = struct.pack('=III', self.MAGIC_BYTES_BATCH, chunk.shape[0], 0) + chunk.tobytes()
+            else:
+                # an older monitor-tcp: the same operations as single requests, sent back-to-back like read_many_Zynq_registers_32bits(),
+                # they are still served in order, and still cost a single round-trip
+                magic_bytes = self.MAGIC_BYTES_READ_REG if number_of_reads > 0 else self.MAGIC_BYTES_WRITE_REG
+                packets = np.zeros((chunk.shape[0], 3), dtype=np.uint32)
+                packets[:, 0] = np.where(bReads, self.MAGIC_BYTES_READ_REG, self.MAGIC_BYTES_WRITE_REG)
+                packets[:, 1] = chunk[:, 1]
+                packets[:, 2] = np.where(bReads, 0, chunk[:, 2])
+                packet_to_send = packets.tobytes()
+            with self.io_lock, self.statistics.measure(magic_bytes, len(packet_to_send), 4*number_of_reads):
+                self.send(packet_to_send)
+                if number_of_reads > 0:
+                    read_values.append(np.frombuffer(self.read(4*number_of_reads), dtype=np.uint32))
+            for (operation, absolute_addr, value) in chunk[chunk[:, 0] == RegisterTransaction.OPERATION_WRITE].tolist():
+                self.shadow_registers.recordWrite(absolute_addr, value)
+
+        if len(read_values) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.concatenate(read_values)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Queues all the register accesses made inside the 'with' block and sends them as a single packet when the block exits.
+        # Writes made through the usual functions (write_Zynq_register_uint32(), etc) are queued automatically,
+        # and the staged writes (SetWireInValue(), stage_Zynq_register_uint32(), etc) are added at the end.
+        # Reads need to go through the RegisterTransaction object to be queued.
+        # Nested transactions simply join the outer one.
+        if self.current_transaction is not None:
+            yield self.current_transaction
+            return
+
+        self.current_transaction = RegisterTransaction(self)
+        try:
+            yield self.current_transaction
+            self.flush_staged_registers()
+            transaction = self.current_transaction
+        finally:
+            self.current_transaction = None
+        transaction.flush()
 
     #######################################################
     # Functions used to access Zynq registers, but which do not interact directly with the socket,
@@ -216,6 +1006,15 @@ class RP_PLL_device():
     def write_Zynq_AXI_register_uint32(self, address_uint32, data_uint32):
         self.write_Zynq_register_32bits(self.FPGA_BASE_ADDR_XADC+address_uint32, data_uint32, bSigned=False)
 
+    def stage_Zynq_register_uint32(self, address_uint32, data_uint32):
+        self.stage_Zynq_register_32bits(self.FPGA_BASE_ADDR+address_uint32, data_uint32)
+
+    def stage_Zynq_register_int32(self, address_uint32, data_int32):
+        self.stage_Zynq_register_32bits(self.FPGA_BASE_ADDR+address_uint32, data_int32)
+
+    def stage_Zynq_AXI_register_uint32(self, address_uint32, data_uint32):
+        self.stage_Zynq_register_32bits(self.FPGA_BASE_ADDR_XADC+address_uint32, data_uint32)
+
     def read_Zynq_register_uint32(self, address_uint32):
         data_buffer = self.read_Zynq_register_32bits(self.FPGA_BASE_ADDR+address_uint32)
         register_value_as_tuple = struct.unpack('I', data_buffer)
@@ -231,6 +1030,15 @@ class RP_PLL_device():
         register_value_as_tuple = struct.unpack('I', data_buffer)
         return register_value_as_tuple[0]
 
+    def read_many_uint32(self, addresses_uint32):
+        return self.read_many_Zynq_registers_32bits(self.FPGA_BASE_ADDR+np.asarray(addresses_uint32, dtype=np.uint32))
+
+    def read_many_int32(self, addresses_uint32):
+        return self.read_many_uint32(addresses_uint32).view(np.int32)
+
+    def read_many_AXI_uint32(self, addresses_uint32):
+        return self.read_many_Zynq_registers_32bits(self.FPGA_BASE_ADDR_XADC+np.asarray(addresses_uint32, dtype=np.uint32))
+
     def read_Zynq_register_uint64(self, address_uint32_lsb, address_uint32_msb):
         print("read_Zynq_register_uint64()")
         results_lsb = self.read_Zynq_register_uint32(address_uint32_lsb)
@@ -265,24 +1073,16 @@ class RP_PLL_device():
     #   self.write_Zynq_register_uint32((endpoint+value)*4+value*4, 0)
 
     def SetWireInValue(self, endpoint, value_16bits):
-        # this only needs to update the internal state
-        # for this, there would need to be two versions of the internal state, so that we can diff them and commit only the addresses that have changed
-        # but its much simpler for now to just commit the change directly
+        # this only updates the internal state (see ShadowRegisters): the changes are committed by UpdateWireIns()
         # the multiply by 4 is because right now the zynq code doesn't work unless reading on a 32-bits boundary, so we map the addresses to different values
-        if value_16bits < 0:
-            # write as a signed value
-            self.write_Zynq_register_int32(endpoint*4, value_16bits)
-        else:
-            # write as an unsigned value
-            self.write_Zynq_register_uint32(endpoint*4, value_16bits)
+        self.stage_Zynq_register_uint32(endpoint*4, value_16bits)
 
 
     def UpdateWireIns(self):
         # commit changes to the fpga
         # Wire ins are from the PC to the FPGA
-        # for now we don't do anything since every SetWireInValue() call actually commits the changes to the fpga...
-        #print('UpdateWireIns(): TODO')
-        return
+        # only the addresses which have changed since the last commit are actually written
+        self.flush_staged_registers()
 
     def GetWireOutValue(self, endpoint):
         # print('GetWireOutValue(): TODO')
@@ -308,6 +1108,11 @@ class RP_PLL_device():
 
 
 
+# 'write_reg' for MAGIC_BYTES_WRITE_REG, etc
+TransportStatistics.OPERATION_NAMES.update((value, name[len('MAGIC_BYTES_'):].lower())
+    for (name, value) in vars(RP_PLL_device).items() if name.startswith('MAGIC_BYTES_'))
+
+
 def main():
     rp = RP_PLL_device()
     rp.OpenTCPConnection("192.168.1.100")
@@ -2,6 +2,7 @@ from PyQt5 import QtGui, Qt, QtCore, QtWidgets
 import sys
 import os
 import time
+import threading
 import struct
 import numpy as np
 import pytest
@@ -65,6 +66,8 @@ class MonitorTCP_mock():
             RP_PLL.RP_PLL_device.MAGIC_BYTES_WRITE_REG: self.write_reg_handler,
             RP_PLL.RP_PLL_device.MAGIC_BYTES_READ_REG: self.read_reg_handler,
             RP_PLL.RP_PLL_device.MAGIC_BYTES_READ_BUFFER: self.read_buf_handler,
+            RP_PLL.RP_PLL_device.MAGIC_BYTES_BATCH: self.batch_handler,
+            RP_PLL.RP_PLL_device.MAGIC_BYTES_READ_BUFFER_CHUNK: self.read_buf_chunk_handler,
         }
 
     def parse_buffer(self, data_buffer):
@@ -132,7 +135,7 @@ class MonitorTCP_mock():
         except KeyError:
             data = self.invalid_read
 
-        bytes_to_send = struct.pack('=i', data)  # signed or unsigned doesn't matter here
+        bytes_to_send = struct.pack('=I', data & 0xFFFFFFFF)  # signed or unsigned doesn't matter here
 
 
         return (bytes_to_send, bytes_consumed)
@@ -148,12 +151,51 @@ class MonitorTCP_mock():
 
         return (self.memory_buffer, bytes_consumed)
 
+    def read_buf_chunk_handler(self, data_buffer):
+        words_consumed = 3
+        bytes_per_word = 4
+        bytes_per_sample = 2
+        bytes_consumed = words_consumed*bytes_per_word
+
+        # Do we have all the required information yet to handle the request?
+        if len(data_buffer) < bytes_consumed:
+            return (None, 0)
+        (magic_bytes, start_point, number_of_points) = struct.unpack('=III', data_buffer[:bytes_consumed])
+
+        return (self.memory_buffer[start_point*bytes_per_sample:(start_point+number_of_points)*bytes_per_sample], bytes_consumed)
+
+    def batch_handler(self, data_buffer):
+        bytes_per_word = 4
+        header_bytes = 3*bytes_per_word
+
+        # Do we have all the required information yet to handle the request?
+        if len(data_buffer) < header_bytes:
+            return (None, 0)
+        (magic_bytes, number_of_operations, reserved) = struct.unpack('=III', data_buffer[:header_bytes])
+        bytes_consumed = header_bytes + number_of_operations*3*bytes_per_word
+        if len(data_buffer) < bytes_consumed:
+            return (None, 0)
+
+        # execute each operation using the single register handlers, and concatenate the replies
+        bytes_to_send = bytearray()
+        for k in range(number_of_operations):
+            (operation, addr, data) = struct.unpack('=III', data_buffer[header_bytes+k*header_bytes:header_bytes+(k+1)*header_bytes])
+            if operation == RP_PLL.RegisterTransaction.OPERATION_WRITE:
+                self.write_reg_handler(struct.pack('=III', RP_PLL.RP_PLL_device.MAGIC_BYTES_WRITE_REG, addr, data))
+            else:
+                (reply, _) = self.read_reg_handler(struct.pack('=III', RP_PLL.RP_PLL_device.MAGIC_BYTES_READ_REG, addr, 0))
+                bytes_to_send += reply
+
+        if len(bytes_to_send) == 0:
+            return (None, bytes_consumed)
+        return (bytes_to_send, bytes_consumed)
+
     # Removes data from the start of a bytearray and returns it
     def remove_from_queue(self, data_array, bytes_to_remove):
         if len(data_array) < bytes_to_remove:
             raise Exception("Not enough bytes in buffer.")
         data = data_array[:bytes_to_remove]
-        data_array[:] = bytearray()
+        data_array[:bytes_to_remove] = bytearray()
         return data
 
     # Add data to the end of a bytearray:
@@ -165,15 +207,24 @@ class MonitorTCP_mock():
     def send_mock(self, packet_to_send):
         packet_to_send = bytearray(packet_to_send) # need bytearray since it is mutable, as opposed to bytes()
         print("packet_to_send=%s, type=%s" % (repr(packet_to_send), type(packet_to_send)))
-        data_to_send_back = self.parse_buffer(packet_to_send)
-        len2 = lambda x: 0 if x is None else len(x)
-        print("send_mock(), before: size=%d, to add: %d" % (len2(self.data_to_send_back), len2(data_to_send_back)))
-        self.add_to_queue(self.data_to_send_back, data_to_send_back)
-        print("send_mock(), after: size=%d" % len2(self.data_to_send_back))
+        # there can be more than one request in the packet (pipelined reads), so parse until everything is consumed
+        while len(packet_to_send) > 0:
+            len_before = len(packet_to_send)
+            data_to_send_back = self.parse_buffer(packet_to_send)
+            len2 = lambda x: 0 if x is None else len(x)
+            print("send_mock(), before: size=%d, to add: %d" % (len2(self.data_to_send_back), len2(data_to_send_back)))
+            self.add_to_queue(self.data_to_send_back, data_to_send_back)
+            print("send_mock(), after: size=%d" % len2(self.data_to_send_back))
+            if len(packet_to_send) == len_before:
+                break
 
     def read_mock(self, bytes_to_read):
         return self.remove_from_queue(self.data_to_send_back, bytes_to_read)
 
+    def read_into_mock(self, buffer):
+        view = memoryview(buffer).cast('B')
+        view[:] = self.remove_from_queue(self.data_to_send_back, len(view))
+
         
 class ServerThread(QtCore.QThread):
     statusUpdate = QtCore.pyqtSignal(str)
@@ -301,6 +352,206 @@ def test_monitorTCP_mock():
     # actual test
     check_readreg(dev)
 
+def test_transaction():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    dev.send = monitor_tcp.send_mock
+    dev.read = monitor_tcp.read_mock
+
+    with dev.transaction() as t:
+        dev.write_Zynq_register_uint32(address_uint32=100*4, data_uint32=10)
+        t.write_Zynq_register_int32(address_uint32=101*4, data_int32=-5)
+        reg0 = t.read_Zynq_register_uint32(address_uint32=100*4)
+        reg1 = t.read_Zynq_register_int32(address_uint32=101*4)
+        # nothing is sent until the end of the transaction
+        assert reg0.value is None
+        assert len(monitor_tcp.regs) == 0
+
+    assert reg0.value == 10
+    assert reg1.value == -5
+    assert dev.current_transaction is None
+
+def test_read_many():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    dev.send = monitor_tcp.send_mock
+    dev.read = monitor_tcp.read_mock
+
+    for k in range(5):
+        dev.write_Zynq_register_uint32(address_uint32=(100+k)*4, data_uint32=10*k)
+    values = dev.read_many_uint32([(100+k)*4 for k in range(5)] + [2334234+2])
+    assert values.dtype == np.uint32
+    assert list(values[:5]) == [10*k for k in range(5)]
+    assert dev.read_many_int32([2334234+2])[0] == MonitorTCP_mock.invalid_read
+
+def test_read_buffer_into():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    monitor_tcp.memory_buffer = bytearray(np.arange(RP_PLL.RP_PLL_device.MAX_SAMPLES_READ_BUFFER, dtype=np.int16).tobytes())
+    dev.send = monitor_tcp.send_mock
+    dev.read_into = monitor_tcp.read_into_mock
+
+    data_buffer = np.zeros(RP_PLL.RP_PLL_device.MAX_SAMPLES_READ_BUFFER, dtype=np.int16)
+    samples = dev.read_Zynq_buffer_int16_into(data_buffer)
+    # the samples must have been received in place
+    assert np.shares_memory(samples, data_buffer)
+    assert np.array_equal(samples, np.arange(RP_PLL.RP_PLL_device.MAX_SAMPLES_READ_BUFFER, dtype=np.int16))
+
+def test_staged_writes():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    packets_sent = []
+    def send_mock(packet_to_send):
+        packets_sent.append(packet_to_send)
+        monitor_tcp.send_mock(packet_to_send)
+    dev.send = send_mock
+    dev.read = monitor_tcp.read_mock
+
+    for k in range(10):
+        dev.SetWireInValue(100, k)
+    dev.SetWireInValue(101, 5)
+    assert len(packets_sent) == 0
+    dev.UpdateWireIns()
+    # only the last value written to each address is sent, in a single packet
+    assert len(packets_sent) == 1
+    assert dev.read_Zynq_register_uint32(address_uint32=100*4) == 9
+    assert dev.read_Zynq_register_uint32(address_uint32=101*4) == 5
+
+    # writes which don't change the register value are skipped
+    del packets_sent[:]
+    dev.SetWireInValue(100, 9)
+    dev.SetWireInValue(101, 6)
+    with dev.transaction():
+        dev.stage_Zynq_register_uint32(102*4, 7)
+    dev.UpdateWireIns()
+    assert len(packets_sent) == 1
+    assert struct.unpack('=III', packets_sent[0][:12])[1] == 2
+    # until the shadow copy is invalidated
+    dev.shadow_registers.invalidate()
+    dev.SetWireInValue(100, 9)
+    dev.UpdateWireIns()
+    assert len(packets_sent) == 2
+
+def test_staged_writes_per_thread():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    packets_sent = []
+    def send_mock(packet_to_send):
+        packets_sent.append(packet_to_send)
+        monitor_tcp.send_mock(packet_to_send)
+    dev.send = send_mock
+    dev.read = monitor_tcp.read_mock
+
+    # a transaction on another thread doesn't take the writes we staged
+    dev.SetWireInValue(100, 3)
+    def other_thread():
+        with dev.transaction():
+            dev.stage_Zynq_register_uint32(101*4, 4)
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    thread.join()
+    assert len(packets_sent) == 1
+    assert struct.unpack('=III', packets_sent[0][:12])[1] == 1
+    dev.UpdateWireIns()
+    assert len(packets_sent) == 2
+    assert dev.read_Zynq_register_uint32(address_uint32=100*4) == 3
+
+    # but a direct write from any thread supersedes our staged write
+    del packets_sent[:]
+    dev.SetWireInValue(100, 5)
+    thread = threading.Thread(target=dev.write_Zynq_register_uint32, args=(100*4, 6))
+    thread.start()
+    thread.join()
+    dev.UpdateWireIns()
+    assert len(packets_sent) == 1
+    assert dev.read_Zynq_register_uint32(address_uint32=100*4) == 6
+
+def test_RAM_dpll_wrapper_cache():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    packets_sent = []
+    def send_mock(packet_to_send):
+        packets_sent.append(packet_to_send)
+        monitor_tcp.send_mock(packet_to_send)
+    dev.send = send_mock
+    dev.read = monitor_tcp.read_mock
+
+    sl = SL()
+    sl.dev = dev
+    sl.set_dac_offset(0, -100)
+    del packets_sent[:]
+    # our own writes keep the cache up to date, so there is no need to read them back
+    assert sl.read_RAM_dpll_wrapper_signed(SL.BUS_ADDR_DAC_offset[0]) == -100
+    assert len(packets_sent) == 0
+
+    # the other registers are read all at once, then served from the cache
+    monitor_tcp.regs[int((RP_PLL.RP_PLL_device.FPGA_BASE_ADDR + (2 << 20) + SL.BUS_ADDR_DAC_offset[1]*4)/4)] = 5
+    assert sl.read_many_RAM_dpll_wrapper(SL.BUS_ADDR_DAC_offset) == [(-100) & 0xFFFFFFFF, 5, MonitorTCP_mock.invalid_read & 0xFFFFFFFF]
+    assert len(packets_sent) == 1
+    assert sl.read_RAM_dpll_wrapper(SL.BUS_ADDR_DAC_offset[1]) == 5
+    assert len(packets_sent) == 1
+
+    sl.resetFrontend()
+    del packets_sent[:]
+    sl.read_RAM_dpll_wrapper(SL.BUS_ADDR_DAC_offset[1])
+    assert len(packets_sent) == 1
+
+def test_read_buffer_chunks():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    monitor_tcp.memory_buffer = bytearray(np.arange(RP_PLL.RP_PLL_device.MAX_SAMPLES_READ_BUFFER, dtype=np.int16).tobytes())
+    dev.send = monitor_tcp.send_mock
+    dev.read = monitor_tcp.read_mock
+    dev.read_into = monitor_tcp.read_into_mock
+
+    sl = SL()
+    sl.dev = dev
+    sl.Num_samples_read = 10000
+    calls = []
+    def between_chunks():
+        # other requests can use the socket between two chunks
+        dev.write_Zynq_register_uint32(address_uint32=100*4, data_uint32=len(calls))
+        calls.append(dev.read_Zynq_register_uint32(address_uint32=100*4))
+
+    samples = sl.read_raw_bytes_from_DDR2(between_chunks=between_chunks).view(np.int16)
+    assert np.array_equal(samples, np.arange(10000, dtype=np.int16))
+    assert calls == list(range(10000 // SL.DDR2_READ_CHUNK_SIZE))
+
+def test_statistics():
+    dev = RP_PLL.RP_PLL_device()
+    # connect mocks
+    monitor_tcp = MonitorTCP_mock()
+    dev.send = monitor_tcp.send_mock
+    dev.read = monitor_tcp.read_mock
+
+    sl = SL()
+    sl.dev = dev
+    def displayWidget():
+        sl.set_dac_offset(0, -100)
+        sl.read_dual_mode_counter(0)
+    displayWidget()
+
+    snapshot = dev.statistics.snapshot()
+    ((operation, caller, origin), counters) = [item for item in snapshot.items() if item[0][0] == 'write_reg'][0]
+    assert caller.endswith('send_bus_cmd_32bits')
+    assert origin.endswith('displayWidget')
+    assert counters['count'] == 1
+    assert counters['bytes_sent'] == 12
+    assert sum(counters['histogram']) == 1
+    (origin, counters) = dev.statistics.summary('origin')[0]
+    assert origin.endswith('displayWidget')
+    assert counters['count'] == 2
+    # the counter batch reads the samples number twice, see read_dual_mode_counter()
+    assert counters['bytes_received'] == 9*4
+    assert counters['errors'] == 0
+
 @pytest.mark.skip(reason="can only run one test at a time currently")
 def test1():
     app = start_qt()
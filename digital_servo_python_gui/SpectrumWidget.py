@@ -39,6 +39,11 @@ class SpectrumWidget(QtGui.QWidget):
         self.bDisplayTiming  = False
         self.filtered_baseband_snr = 0.
 
+        self.timerFlushDACOffset = QtCore.QTimer(self)
+        self.timerFlushDACOffset.setSingleShot(True)
+        self.timerFlushDACOffset.setInterval(20)
+        self.timerFlushDACOffset.timeout.connect(self.flushDACOffset)
+
         self.initUI()
         pass
 
@@ -137,6 +142,14 @@ class SpectrumWidget(QtGui.QWidget):
                 
                 self.qlabel_dac_offset_value[k] = Qt.QLabel('0 V')
                 self.qlabel_dac_offset_value[k].setAlignment(Qt.Qt.AlignHCenter)
+
+        # The DAC outputs are normally read from their current value registers, a logger capture is only made in waveform mode:
+        self.qchk_dac_waveform = Qt.QCheckBox('DAC waveform')
+        self.qchk_dac_waveform.setToolTip('Average of a short logger capture of the DAC outputs, instead of their current value.\nThe ADC and DDC displays get less captures in this mode.')
+        self.qlabel_dac_averaging = Qt.QLabel('DAC avg:')
+        self.qedit_dac_averaging = Qt.QLineEdit('1')
+        self.qedit_dac_averaging.setMaximumWidth(40)
+        self.qedit_dac_averaging.setToolTip('Number of refreshes over which the DAC current values are averaged')
             
         
         # Create widgets to set the number of points for the graphs:
@@ -246,6 +259,10 @@ class SpectrumWidget(QtGui.QWidget):
                 
                 N_dac_controls = N_dac_controls + 2
                 
+        if N_dac_controls > 0:
+            grid.addWidget(self.qchk_dac_waveform,      5, 2, 1, 2)
+            grid.addWidget(self.qlabel_dac_averaging,   5, 4)
+            grid.addWidget(self.qedit_dac_averaging,    5, 5)
                 
         grid.setRowStretch(1, 1)
 
@@ -567,7 +584,7 @@ class SpectrumWidget(QtGui.QWidget):
                 # 0 corresponds to the DAC lowest limit and 1e6 to the DAC highest limit:
 #                print 'k = %d, self.sl.DACs_limit_low[k] = %d, self.sl.DACs_limit_high[k] = %d' % (k, self.sl.DACs_limit_low[k], self.sl.DACs_limit_high[k])
                 counts_offset = int(self.sl.DACs_limit_low[k] + float(self.sl.DACs_limit_high[k] - self.sl.DACs_limit_low[k]) * float(self.q_dac_offset[k].value())/1e6) #counts_offset is 16 bits signed
-                self.sl.set_dac_offset(k, counts_offset)
+                self.sl.set_dac_offset(k, counts_offset, bDeferred=True)
                 
                 VCO_gain_in_Hz_per_Volts = self.parent.getVCOGainFromUI(k)
                     
@@ -576,6 +593,15 @@ class SpectrumWidget(QtGui.QWidget):
                 current_output_in_hz = current_output_in_volts * VCO_gain_in_Hz_per_Volts
                 self.qlabel_dac_offset_value[k].setText('{:.4f} V\n{:.0f} MHz'.format(current_output_in_volts, current_output_in_hz/1e6))
 
+        # the slider generates an event for every step: the writes are coalesced and sent at most every 20 ms,
+        # and only if the value has actually changed
+        if not self.timerFlushDACOffset.isActive():
+            self.timerFlushDACOffset.start()
+
+    @logCommsErrorsAndBreakoutOfFunction()
+    def flushDACOffset(self):
+        self.sl.flush_register_writes()
+
     @logCommsErrorsAndBreakoutOfFunction()
     def getDACoffset(self):
         for k in range(3):
@@ -134,48 +134,60 @@ class Loop_filters_module(object):
             print('D_gain = %e, in integer: D_gain = %d = 2^%.2f' % (self.gain_d, gain_d_int, np.log2(abs(gain_d_int)+0.1)))
             print('DF_gain = %e, in integer: DF_gain = %d = 2^%.2f' % (self.coef_d, coef_d_int, np.log2(abs(coef_d_int)+0.1)))
         
-        # Send P gain
-        # int_bits15_to_0 = gain_p_int & 0xFFFF
-        # int_bits31_to_16 = (gain_p_int & 0xFFFF0000) >> 16
-        # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_p, int_bits15_to_0, int_bits31_to_16)
-        sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_p, gain_p_int)
+        # all the settings are sent to the fpga in a single packet.
+        # the gains are deferred so that only the ones which have changed are sent (the slider events call this very often),
+        # but the lock setting is always sent.
+        with sl.dev.transaction():
+            # Send P gain
+            # int_bits15_to_0 = gain_p_int & 0xFFFF
+            # int_bits31_to_16 = (gain_p_int & 0xFFFF0000) >> 16
+            # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_p, int_bits15_to_0, int_bits31_to_16)
+            sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_p, gain_p_int, bDeferred=True)
 #        print('int_bits15_to_0 = %d, int_bits31_to_16 = %d' % (int_bits15_to_0, int_bits31_to_16))
         
-        # Send I gain
-        # int_bits15_to_0 = gain_i_int & 0xFFFF
-        # int_bits31_to_16 = (gain_i_int & 0xFFFF0000) >> 16
-        # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_i, int_bits15_to_0, int_bits31_to_16)
-        sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_i, gain_i_int)
-        #print('address = %x' % (self.bus_base_address + self.BUS_OFFSET_gain_i))
-        
-        # Send II gain
-        # int_bits15_to_0 = gain_ii_int & 0xFFFF
-        # int_bits31_to_16 = (gain_ii_int & 0xFFFF0000) >> 16
-        # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_ii, int_bits15_to_0, int_bits31_to_16)
-        sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_ii, gain_ii_int)
+            # Send I gain
+            # int_bits15_to_0 = gain_i_int & 0xFFFF
+            # int_bits31_to_16 = (gain_i_int & 0xFFFF0000) >> 16
+            # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_i, int_bits15_to_0, int_bits31_to_16)
+            sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_i, gain_i_int, bDeferred=True)
+            #print('address = %x' % (self.bus_base_address + self.BUS_OFFSET_gain_i))
+        
+            # Send II gain
+            # int_bits15_to_0 = gain_ii_int & 0xFFFF
+            # int_bits31_to_16 = (gain_ii_int & 0xFFFF0000) >> 16
+            # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_ii, int_bits15_to_0, int_bits31_to_16)
+            sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_ii, gain_ii_int, bDeferred=True)
             
-        # Send D gain
-        # int_bits15_to_0 = gain_d_int & 0xFFFF
-        # int_bits31_to_16 = (gain_d_int & 0xFFFF0000) >> 16
-        # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_d, int_bits15_to_0, int_bits31_to_16)
-        sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_d, gain_d_int)
+            # Send D gain
+            # int_bits15_to_0 = gain_d_int & 0xFFFF
+            # int_bits31_to_16 = (gain_d_int & 0xFFFF0000) >> 16
+            # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_gain_d, int_bits15_to_0, int_bits31_to_16)
+            sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_gain_d, gain_d_int, bDeferred=True)
             
-        # Send DF gain
-        # int_bits15_to_0 = coef_d_int & 0xFFFF
-        # int_bits31_to_16 = (coef_d_int & 0xFFFF0000) >> 16
-        # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_coef_d_filt, int_bits15_to_0, int_bits31_to_16)
-        sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_coef_d_filt, coef_d_int)
-        
-        # Send lock/unlock setting
-        sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_settings, bLock, 0)
+            # Send DF gain
+            # int_bits15_to_0 = coef_d_int & 0xFFFF
+            # int_bits31_to_16 = (coef_d_int & 0xFFFF0000) >> 16
+            # sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_coef_d_filt, int_bits15_to_0, int_bits31_to_16)
+            sl.send_bus_cmd_32bits(self.bus_base_address + self.BUS_OFFSET_coef_d_filt, coef_d_int, bDeferred=True)
+        
+            # the gains must be written before the lock setting
+            sl.flush_register_writes()
+
+            # Send lock/unlock setting
+            sl.send_bus_cmd(self.bus_base_address + self.BUS_OFFSET_settings, bLock, 0)
 
     def get_pll_settings(self, sl):
-        gain_p_raw  = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_gain_p)
-        gain_i_raw  = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_gain_i)
-        gain_ii_raw = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_gain_ii)
-        gain_d_raw  = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_gain_d)
-        coef_d_raw  = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_coef_d_filt)
-        bLock       = sl.read_RAM_dpll_wrapper_signed(self.bus_base_address + self.BUS_OFFSET_settings)
+        (gain_p_raw,
+         gain_i_raw,
+         gain_ii_raw,
+         gain_d_raw,
+         coef_d_raw,
+         bLock) = sl.read_many_RAM_dpll_wrapper_signed((self.bus_base_address + self.BUS_OFFSET_gain_p,
+                                                        self.bus_base_address + self.BUS_OFFSET_gain_i,
+                                                        self.bus_base_address + self.BUS_OFFSET_gain_ii,
+                                                        self.bus_base_address + self.BUS_OFFSET_gain_d,
+                                                        self.bus_base_address + self.BUS_OFFSET_coef_d_filt,
+                                                        self.bus_base_address + self.BUS_OFFSET_settings))
 
         self.gain_p  = gain_p_raw/2.**self.N_DIVIDE_P
         self.gain_i  = gain_i_raw/2.**self.N_DIVIDE_I
@@ -10,7 +10,7 @@ from __future__ import print_function
 # import ok       # used to talk to the FPGA board
 import time     # used for time.sleep()
 import numpy as np
-from scipy.signal import lfilter
+from scipy.signal import welch
 
 import sys
 
@@ -18,9 +18,17 @@ import os, errno    # for makesurepathexists()
 
 import traceback
 import weakref
+import threading
+import concurrent.futures
 
 from SuperLaserLand2_JD2_PLL import PLL0_module, PLL1_module, PLL2_module
 import RP_PLL
+from CapturePipeline import CapturePipeline
+from LoggerArbiter import LoggerArbiter
+from DeviceStateHub import DeviceStateHub
+from DitherSampler import DitherSampler
+import LoggerRecords
+from DDCKernels import DDCKernelCache, ddc_filter_taps, fir_filter
 
 import logging
 
@@ -29,7 +37,6 @@ class SuperLaserLand_JD_RP:
 	############################################################
 	# System parameters:
 	fs = 125e6  # adc sampling rate
-	bDDR2InUse = False  # Each function that uses the DDR2 logger module should make sure that this isn't set before changing any setting
 	bCommunicationLogging = False   # Turn On/Off logging of the USB communication with the FPGA box
 	bVerbose = False
 	
@@ -130,6 +137,8 @@ class SuperLaserLand_JD_RP:
 	BUS_ADDR_DAC0_CURRENT                               = 0x00035
 	BUS_ADDR_DAC1_CURRENT                               = 0x00036
 	BUS_ADDR_DAC2_CURRENT                               = 0x00037
+	# number of samples written by the logger since its last trigger (bit 12 of the status flags is set while it is writing)
+	BUS_ADDR_LOGGER_SAMPLES_WRITTEN                     = 0x0003B
 	
 	# Address to change the amplitude and the offset of the VCO
 	BUS_ADDR_vco_amplitude                              = (6 << 20) + 0x00000
@@ -290,6 +299,10 @@ class SuperLaserLand_JD_RP:
 	SELECT_DAC2          = 8
 	SELECT_CRASH_MONITOR = 2**4
 	SELECT_IN10          = 2**4 + 2**3
+	# Number of samples read at a time by read_raw_bytes_from_DDR2() when the read is split in chunks
+	DDR2_READ_CHUNK_SIZE = 4096
+	# The waits for the logger are split in requests of at most this many seconds, so that they can be aborted
+	LOGGER_WAIT_SLICE = 0.2
 	LOGGER_MUX = {
 		'ADC0':          0,
 		'ADC1':          1,
@@ -329,9 +342,32 @@ class SuperLaserLand_JD_RP:
 			self.controller = None
 
 		self.dev = RP_PLL.RP_PLL_device(self.controller)
+		# all the addresses read through read_RAM_dpll_wrapper(), see warm_up_RAM_dpll_wrapper_cache()
+		self.RAM_dpll_wrapper_addresses = set()
+		# the waits for the logger run on this thread, see wait_for_logger_async()
+		self.logger_wait_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.logger_wait_aborted = threading.Event()
+		# Each function that uses the DDR2 logger module must hold a lease from the arbiter, see LoggerArbiter.py
+		self.logger_arbiter = LoggerArbiter()
+		# continuous captures for the live displays, see CapturePipeline.py
+		self.capture_pipeline = CapturePipeline(self)
+		# status, counters and DAC currents, read once for all the windows, see DeviceStateHub.py
+		self.state_hub = DeviceStateHub(self)
+		# running statistics of the dither lock-ins, see DitherSampler.py
+		self.dither_sampler = DitherSampler(self)
+		# reference phasors and filter taps of frontend_DDC_processing(), see DDCKernels.py
+		self.ddc_kernels = DDCKernelCache()
+		# worker thread which performs the device accesses of the GUI, set by DeviceIOThread (see DeviceIOThread.py).
+		# None when running without the GUI: the requests are then executed directly by the calling thread
+		self.device_io = None
 
 	
 		
+	@property
+	def bDDR2InUse(self):
+		# kept for compatibility, see logger_arbiter
+		return self.logger_arbiter.isBusy()
+
 	def openDevice(self, bConfigure=True, strSerial='', strFirmware='superlaserland.bit'):
 		if self.bVerbose == True:
 			print('OpenDevice')
@@ -354,6 +390,8 @@ class SuperLaserLand_JD_RP:
 		print('Resetting FPGA (resetFrontend)...')
 		# self.dev.ActivateTriggerIn(self.ENDPOINT_CMD_TRIG, self.TRIG_RESET_FRONTEND)
 		self.dev.write_Zynq_register_uint32(self.BUS_ADDR_TRIG_RESET_FRONTEND*4, 0)
+		# the values we remember having written to the dpll registers may not be valid anymore
+		self.dev.shadow_registers.invalidate('dpll')
 		
 		# self.dev.ActivateTriggerIn(self.ENDPOINT_CMD_TRIG, self.TRIG_RESET)
 
@@ -396,17 +434,25 @@ class SuperLaserLand_JD_RP:
 		self.dev.write_Zynq_register_uint32(int(bus_address)*4, (int(data2)<<16) + int(data1))
 
 		
-	def send_bus_cmd_32bits(self, bus_address, data_32bits):
+	def send_bus_cmd_32bits(self, bus_address, data_32bits, bDeferred=False):
 		if self.bVerbose == True:
 			print('send_bus_cmd_32bits')
 		#print(sys._getframe().f_back.f_code.co_name)
-		self.dev.write_Zynq_register_uint32(int(bus_address)*4, int(data_32bits))
+		if bDeferred:
+			# only sent by flush_register_writes() or at the end of the current transaction, and only if the value has changed
+			self.dev.stage_Zynq_register_uint32(int(bus_address)*4, int(data_32bits))
+		else:
+			self.dev.write_Zynq_register_uint32(int(bus_address)*4, int(data_32bits))
 			
 		# data_lsbs = int(data_32bits) & 0xFFFF
 		# data_msbs = (int(data_32bits) & 0xFFFF0000) >> 16
 #        print('lsbs = %d, msbs = %d' % (data_lsbs, data_msbs))
 		# self.send_bus_cmd(bus_address, data_lsbs, data_msbs)
 		
+	def flush_register_writes(self):
+		# sends the writes deferred with bDeferred=True
+		self.dev.UpdateWireIns()
+
 	def send_bus_cmd_16bits(self, bus_address, data_16bits):
 		if self.bVerbose == True:
 			print('send_bus_cmd_16bits')
@@ -603,9 +649,15 @@ class SuperLaserLand_JD_RP:
 		if self.bVerbose == True:
 			print('wait_for_write')
 			
-		# Wait, seems necessary because setting the DDR2Logger to 'read' mode overrides the 'write' mode
+		# returns as soon as the samples are in the logger, see wait_for_write_async()
+		self.wait_for_write_async().result()
+
+	def wait_for_write_async(self):
+		# non-blocking version of wait_for_write(), to be called after trigger_write().
+		# returns a concurrent.futures.Future whose result is the number of samples written
+		# (the timeout is a few times the time the logger takes to write Num_samples_write samples)
 		write_delay = 1.1*1024*(int(self.Num_samples_write/1024) + 1)/(self.fs/(2*self.clk_divider))
-		time.sleep(write_delay)
+		return self.wait_for_logger_async(self.Num_samples_write, 1. + 2*write_delay, write_delay)
 		
 	def get_system_identification_wait_time(self):
 		if self.bVerbose == True:
@@ -618,29 +670,99 @@ class SuperLaserLand_JD_RP:
 			print('wait_for_system_identification')
 			
 #        print(1.1*2*self.number_of_cycles_integration*self.number_of_frequencies/self.fs)
-		time.sleep(self.get_system_identification_wait_time())
-		
-		
+		self.wait_for_system_identification_async().result()
+
+	def wait_for_system_identification_async(self):
+		# non-blocking version of wait_for_system_identification(), to be called after trigger_system_identification().
+		# the future is done as soon as the VNA has written its last record, see wait_for_logger_async()
+		return self.wait_for_logger_async(self.Num_samples_write, 1. + 2*self.get_system_identification_wait_time(), self.get_system_identification_wait_time())
+
+	def read_logger_samples_written(self):
+		# cheap progress poll, for example to update a progress bar during a system identification
+		return self.dev.read_Zynq_register_uint32(self.BUS_ADDR_LOGGER_SAMPLES_WRITTEN*4)
+
+	def wait_for_logger_async(self, number_of_samples, timeout, write_duration=None):
+		# returns a concurrent.futures.Future which completes as soon as the logger has written number_of_samples samples
+		# since its last trigger. Its result is the number of samples written, which is smaller after timeout seconds
+		# or after abort_logger_wait(). The wait itself is done by monitor-tcp, see RP_PLL_device.wait_for_logger().
+		# write_duration is the longest the logger can take (timeout if None): with an older monitor-tcp or bitstream,
+		# which can't tell us when the logger is done, we simply wait for that long, see run_logger_wait()
+		if write_duration is None:
+			write_duration = timeout
+		self.logger_wait_aborted.clear()
+		return self.logger_wait_executor.submit(self.run_logger_wait, int(number_of_samples), timeout, write_duration)
+
+	def abort_logger_wait(self):
+		# makes the pending wait_for_logger_async() complete within LOGGER_WAIT_SLICE, for example when a system identification is cancelled
+		self.logger_wait_aborted.set()
+
+	def run_logger_wait(self, number_of_samples, timeout, write_duration):
+		# the trigger went on the control channel and the wait goes on the bulk channel: a read makes sure the trigger was served
+		self.dev.read_Zynq_register_uint32(self.BUS_ADDR_STATUS_FLAGS*4)
+		time_start = time.perf_counter()
+		if not self.dev.supports(self.dev.MAGIC_BYTES_WAIT_FOR_LOGGER) or self.dev.bLoggerProgressRegister == False:
+			return self.run_timed_logger_wait(number_of_samples, time_start + write_duration)
+		time_end = time_start + timeout
+		while True:
+			samples_written = self.dev.wait_for_logger(number_of_samples, min(self.LOGGER_WAIT_SLICE, max(time_end - time.perf_counter(), 0.)))
+			if samples_written > 0:
+				self.dev.bLoggerProgressRegister = True
+			elif self.dev.bLoggerProgressRegister is None and time.perf_counter() >= time_start + write_duration:
+				# an older bitstream reads 0 from the logger progress register, even after the logger should be done
+				self.logger.warning('Red_Pitaya_GUI{}: the logger progress register reads 0, the bitstream is probably older than the GUI. Waiting for the worst-case duration of the captures instead.'.format(self.logger_name))
+				self.dev.bLoggerProgressRegister = False
+				# we have already waited for as long as the logger can take
+				return number_of_samples
+			if samples_written >= number_of_samples or self.logger_wait_aborted.is_set():
+				return samples_written
+			if time.perf_counter() >= time_end:
+				self.logger.warning('Red_Pitaya_GUI{}: timeout while waiting for the logger, {} samples written out of {}'.format(self.logger_name, samples_written, number_of_samples))
+				return samples_written
+
+	def run_timed_logger_wait(self, number_of_samples, time_end):
+		# same as the waits before the logger could report its progress: we can only assume it is done after the worst-case duration.
+		# Waits in slices, so that abort_logger_wait() still works. returns number_of_samples, or 0 if aborted
+		while not self.logger_wait_aborted.is_set():
+			remaining_time = time_end - time.perf_counter()
+			if remaining_time <= 0:
+				return number_of_samples
+			self.logger_wait_aborted.wait(min(self.LOGGER_WAIT_SLICE, remaining_time))
+		return 0
 
-	def read_raw_bytes_from_DDR2(self):
+	def read_raw_bytes_from_DDR2(self, data_buffer=None, between_chunks=None):
 		if self.bVerbose == True:
 			print('read_raw_bytes_from_DDR2')
 
 		if self.bCommunicationLogging == True:
 			self.log_file.write('read_raw_bytes_from_DDR2()\n')
 
-		bytes_per_sample = 2
-		Num_bytes_read = self.Num_samples_read*bytes_per_sample
-
-		data_buffer = self.dev.read_Zynq_buffer_int16(self.Num_samples_read)
+		# the samples are received directly into a numpy array, so the functions below can decode them using views only.
+		# a new array is allocated for each read by default since callers usually hold on to the views we return,
+		# but a pre-allocated int16 array can be passed in data_buffer to avoid the allocation.
+		if data_buffer is None or len(data_buffer) < self.Num_samples_read:
+			data_buffer = np.empty(self.Num_samples_read, dtype=np.int16)
 
-		if Num_bytes_read != len(data_buffer):
-			print('Error: did not receive the expected number of bytes. expected: %d, Received: %d' % (Num_bytes_read, len(data_buffer)))
-
-		# convert to numpy array
-		data_buffer = np.fromstring(data_buffer, dtype=np.uint8)
-
-		return data_buffer
+		if between_chunks is None:
+			data_buffer = self.dev.read_Zynq_buffer_int16_into(data_buffer[:self.Num_samples_read])
+		else:
+			# read the buffer in chunks of DDR2_READ_CHUNK_SIZE samples, calling between_chunks() after each chunk.
+			# the socket is free during that call, so more urgent requests can go through,
+			# and between_chunks() can abort the read by raising an exception.
+			data_buffer = data_buffer[:min(self.Num_samples_read, self.dev.MAX_SAMPLES_READ_BUFFER)]
+			N_samples_received = 0
+			while N_samples_received < len(data_buffer):
+				chunk = self.dev.read_Zynq_buffer_int16_chunk_into(data_buffer[N_samples_received:N_samples_received+self.DDR2_READ_CHUNK_SIZE], N_samples_received)
+				if len(chunk) == 0:
+					break
+				N_samples_received += len(chunk)
+				if N_samples_received < len(data_buffer):
+					between_chunks()
+			data_buffer = data_buffer[:N_samples_received]
+
+		if self.Num_samples_read != len(data_buffer):
+			print('Error: did not receive the expected number of samples. expected: %d, Received: %d' % (self.Num_samples_read, len(data_buffer)))
+
+		return data_buffer.view(np.uint8)
 
 		
 	def extractBit(self, value, N_bit):
@@ -650,46 +772,23 @@ class SuperLaserLand_JD_RP:
 		single_bit = (value & (1 << N_bit)) >> N_bit
 		return single_bit
 		
-	def readStatusFlags(self):
+	def readStatusFlags(self, max_age=0.):
 		if self.bVerbose == True:
 			print('readStatusFlags')
 			
-		# We first need to check if the fifo has enough samples to send us:        
-
-		# status_flags = self.dev.GetWireOutValue(self.ENDPOINT_STATUS_FLAGS_OUT) # get value from dev object into our script
-		status_flags = self.dev.read_Zynq_register_uint32(self.BUS_ADDR_STATUS_FLAGS*4) # get value from dev object into our script
-#        print(status_flags)
-		output0_has_data        = (self.extractBit(status_flags, 0) == 0)
-		output1_has_data        = (self.extractBit(status_flags, 1) == 0)
-		PipeA1FifoEmpty         = self.extractBit(status_flags, 2)
-		crash_monitor_has_data  = self.extractBit(status_flags, 3)
+		# the status flags are read along with the rest of the device state, a snapshot read less than max_age seconds ago is reused
+		snapshot = self.state_hub.getSnapshot(max_age)
 		
-#        output0_has_data = ((status_flags & (1 << 0)) >> 0 == 0)
-#        output1_has_data = ((status_flags & (1 << 1)) >> 1 == 0)
-#        PipeA1FifoEmpty  = ((status_flags & (1 << 2)) >> 2 == 1)
-#        PipeA1FifoEmpty  = ((status_flags & (1 << 2)) >> 2 == 1)
+		return snapshot.statusFlags()
 		
-		return (output0_has_data, output1_has_data, PipeA1FifoEmpty, crash_monitor_has_data)
-		
-	def readLEDs(self):
+	def readLEDs(self, max_age=0.):
 		if self.bVerbose == True:
 			print('readLEDs')
 			
-		# We first need to check if the fifo has enough samples to send us:        
-		# status_flags = self.dev.GetWireOutValue(self.ENDPOINT_STATUS_FLAGS_OUT) # get value from dev object into our script
-		status_flags = self.dev.read_Zynq_register_uint32(self.BUS_ADDR_STATUS_FLAGS*4) # get value from dev object into our script
-		# print(status_flags)
+		# The windows all read the LEDs at each refresh: a snapshot read less than max_age seconds ago by another window is reused
+		snapshot = self.state_hub.getSnapshot(max_age)
 
-		LED_G0        = self.extractBit(status_flags, 4)
-		LED_R0        = self.extractBit(status_flags, 5)
-		
-		LED_G1        = self.extractBit(status_flags, 6)
-		LED_R1        = self.extractBit(status_flags, 7)
-		
-		LED_G2        = self.extractBit(status_flags, 8)
-		LED_R2        = self.extractBit(status_flags, 9)
-		
-		return (LED_G0, LED_R0, LED_G1, LED_R1, LED_G2, LED_R2)
+		return snapshot.leds()
 		
 	def readResidualsStreamingStatus(self):
 		if self.bVerbose == True:
@@ -760,6 +859,126 @@ class SuperLaserLand_JD_RP:
 		
 		self.setResidualsStreamingSettings(data_delay, trigger_delay, boxcar_filter_size, rst_residuals_streaming)
 
+	def deep_capture(self, selector, N, out=None, decimation=1, strFilename=None):
+		# Captures N samples of the logger multiplexer output (selector is a key of LOGGER_MUX, or its value) in the device's RAM,
+		# beyond the MAX_SAMPLES_READ_BUFFER limit of the logger. The fifo which carries the data is limited to ~1e7 samples/s,
+		# so one sample out of decimation is kept. The ADC captures don't have the header of read_adc_samples_from_DDR2().
+		# The raw int16 samples are received directly into out (a preallocated int16 array), or into a memory-mapped file
+		# if strFilename is given, so that captures larger than the host's memory are possible.
+		# returns the part of the array which was filled, with the same scaling as the logger samples.
+		if self.bVerbose == True:
+			print('deep_capture')
+		if selector in self.LOGGER_MUX:
+			selector = self.LOGGER_MUX[selector]
+		N = min(int(N), self.dev.MAX_POINTS_DEEP_CAPTURE)
+		if out is None:
+			if strFilename is None:
+				out = np.empty(N, dtype=np.int16)
+			else:
+				out = np.lib.format.open_memmap(strFilename, mode='w+', dtype=np.int16, shape=(N,))
+
+		self.last_selector = selector
+		self.dev.SetWireInValue(self.BUS_ADDR_MUX_SELECTORS, self.last_selector)
+		self.dev.UpdateWireIns()
+		(samples, flags) = self.dev.deep_capture_into(out[:N], decimation, capture_duration=N*decimation/self.fs)
+
+		if len(samples) != N:
+			self.logger.warning('Red_Pitaya_GUI{}: deep capture stopped after {} samples out of {}'.format(self.logger_name, len(samples), N))
+		if flags & self.dev.DEEP_CAPTURE_FLAG_OVERFLOW:
+			self.logger.warning('Red_Pitaya_GUI{}: deep capture fifo overflow, some samples are missing. Use a higher decimation.'.format(self.logger_name))
+		if isinstance(out, np.memmap):
+			out.flush()
+		return samples
+
+	def capture_long(self, selector, N_total, out=None, nperseg=None, between_blocks=None):
+		# Captures N_total samples of the logger multiplexer output (selector is a key of LOGGER_MUX, or its value)
+		# beyond the MAX_SAMPLES_READ_BUFFER limit of the logger, without any firmware support (see deep_capture() for gapless captures):
+		# the logger is triggered and read repeatedly, and the blocks are copied one after the other into out,
+		# a preallocated array (int16, or uint16 for DAC2) which can be a memory-mapped file. out is allocated here if None.
+		# The ADC captures don't have the header of read_adc_samples_from_DDR2().
+		# The blocks are not contiguous since the logger doesn't record while we read it. Its stream has no sample counter,
+		# so the dead time between two blocks is estimated with the host's clock: time between the two triggers minus the duration of a block.
+		# If nperseg is given, the Welch-averaged one-sided PSD of the samples (in counts^2/Hz) is accumulated block by block,
+		# with segments which never straddle two blocks. With out=False, the samples are not kept at all, only the statistics and the spectrum.
+		# between_blocks() is called after each block, it can abort the capture by raising an exception.
+		# returns (samples, dead_times, spectrum, stats): samples is the part of out which was filled (None if out is False),
+		# dead_times[k] is the gap in seconds between blocks k and k+1, spectrum is (frequency_axis, psd), or None without nperseg,
+		# and stats is (mean, variance) of all the samples in counts, accumulated block by block, or None if no sample was received.
+		if self.bVerbose == True:
+			print('capture_long')
+		if selector in self.LOGGER_MUX:
+			selector = self.LOGGER_MUX[selector]
+		N_total = int(N_total)
+		if selector in (self.LOGGER_MUX['ADC0'], self.LOGGER_MUX['ADC1']):
+			header_length = 9   # see read_adc_samples_from_DDR2()
+		else:
+			header_length = 0
+		if out is None:
+			out = np.empty(N_total, dtype=(np.uint16 if selector == self.LOGGER_MUX['DAC2'] else np.int16))
+		elif out is not False:
+			N_total = min(N_total, len(out))
+
+		# a single receive buffer for all the blocks
+		block_buffer = np.empty(self.dev.MAX_SAMPLES_READ_BUFFER, dtype=np.int16)
+		trigger_times = []
+		block_durations = []
+		psd_sum = 0.
+		N_segments_total = 0
+		frequency_axis = None
+		samples_mean = 0.
+		samples_M2 = 0.	# sum of the squared deviations from the mean
+		N_samples_received = 0
+		while N_samples_received < N_total:
+			# the last block is read whole, even if we only need a few samples of it
+			N_block = min(max(N_total - N_samples_received + header_length, 64), self.dev.MAX_SAMPLES_READ_BUFFER)
+			self.setup_write(selector, N_block)
+			trigger_times.append(time.perf_counter())
+			self.trigger_write()
+			self.wait_for_write()
+			(samples, ref_exp) = self.read_adc_samples_from_DDR2(data_buffer=block_buffer)
+			block_durations.append(N_block/self.fs)
+			if len(samples) == 0:
+				self.logger.warning('Red_Pitaya_GUI{}: long capture stopped after {} samples out of {}'.format(self.logger_name, N_samples_received, N_total))
+				break
+			samples = samples[:N_total - N_samples_received]
+
+			if out is not False:
+				out[N_samples_received:N_samples_received+len(samples)] = samples
+			block = samples.astype(np.float64)
+			# combines the block's mean and variance with those of the previous blocks (Chan et al.'s pairwise update)
+			block_mean = np.mean(block)
+			delta = block_mean - samples_mean
+			N_combined = N_samples_received + len(block)
+			samples_mean += delta*len(block)/N_combined
+			samples_M2 += np.sum((block - block_mean)**2) + delta**2*N_samples_received*len(block)/N_combined
+			if nperseg is not None and len(samples) >= nperseg:
+				# each block is weighted by its number of segments (50% overlap), as if welch() had been called on all the segments at once
+				(frequency_axis, psd) = welch(block, fs=self.fs, nperseg=nperseg)
+				N_segments = 1 + (len(samples) - nperseg)//(nperseg - nperseg//2)
+				psd_sum = psd_sum + N_segments*psd
+				N_segments_total += N_segments
+			N_samples_received += len(samples)
+
+			if between_blocks is not None and N_samples_received < N_total:
+				between_blocks()
+
+		dead_times = np.maximum(np.diff(trigger_times) - np.array(block_durations[:-1]), 0.)
+		if out is False:
+			samples = None
+		else:
+			samples = out[:N_samples_received]
+			if isinstance(out, np.memmap):
+				out.flush()
+		if N_segments_total > 0:
+			spectrum = (frequency_axis, psd_sum/N_segments_total)
+		else:
+			spectrum = None
+		if N_samples_received > 0:
+			stats = (samples_mean, samples_M2/N_samples_received)
+		else:
+			stats = None
+		return (samples, dead_times, spectrum, stats)
+
 	def read_raw_bytes_from_pipe(self, PipeAddress, Num_bytes_read):
 		if self.bVerbose == True:
 			print('read_raw_bytes_from_pipe')
@@ -836,14 +1055,14 @@ class SuperLaserLand_JD_RP:
 		return buffer_all
 			
 			
-	def read_adc_samples_from_DDR2(self):
+	def read_adc_samples_from_DDR2(self, between_chunks=None, data_buffer=None):
 		if self.bVerbose == True:
 			print('read_adc_samples_from_DDR2')
 			
 		if self.bCommunicationLogging == True:
 			self.log_file.write('read_adc_samples_from_DDR2()\n')
 
-		data_buffer = self.read_raw_bytes_from_DDR2()
+		data_buffer = self.read_raw_bytes_from_DDR2(data_buffer=data_buffer, between_chunks=between_chunks)
 		if self.last_selector == self.LOGGER_MUX['DAC2']:
 			# DAC 2 samples are unsigned 16-bits
 			samples_out = np.frombuffer(data_buffer, dtype=np.uint16)
@@ -918,13 +1137,13 @@ class SuperLaserLand_JD_RP:
 		
 		return (samples_out, ref_exp)
 			
-	def read_ddc_samples_from_DDR2(self):
+	def read_ddc_samples_from_DDR2(self, between_chunks=None, data_buffer=None):
 		if self.bVerbose == True:
 			print('read_ddc_samples_from_DDR2')
 			
 		if self.bCommunicationLogging == True:
 			self.log_file.write('read_ddc_samples_from_DDR2()\n')
-		data_buffer = self.read_raw_bytes_from_DDR2()
+		data_buffer = self.read_raw_bytes_from_DDR2(data_buffer=data_buffer, between_chunks=between_chunks)
 		samples_out = np.frombuffer(data_buffer, dtype=np.int16)
 			
 		
@@ -947,14 +1166,8 @@ class SuperLaserLand_JD_RP:
 		if self.bCommunicationLogging == True:
 			self.log_file.write('read_counter_samples_from_DDR2()\n')
 		data_buffer = self.read_raw_bytes_from_DDR2()
-			
-		bytes_per_sample = 2
-		data_buffer_reshaped = np.reshape(data_buffer, (-1, bytes_per_sample))
-		convert_4bytes_unsigned = np.array((2**(2*8), 2**(3*8), 2**(0*8), 2**(1*8)))
-		convert_2bytes_signed = np.array((2**(0*8), 2**(1*8)), dtype=np.int16)
-		samples_out         = np.dot(data_buffer_reshaped[:, :].astype(np.int16), convert_2bytes_signed)
-		
-		
+		# little-endian int16 samples, viewed in place (see LoggerRecords.py)
+		samples_out = LoggerRecords.decode_counter_samples(data_buffer)
 		
 		return samples_out
 		
@@ -966,86 +1179,23 @@ class SuperLaserLand_JD_RP:
 			self.log_file.write('read_VNA_samples_from_DDR2()\n')
 		data_buffer = self.read_raw_bytes_from_DDR2()
 		
-		# Interpret the samples as coming form the system identification VNA:
-		# In this format, the DDR contains:
-		# INTEGRATOR_REALPART_BITS15_TO_0
-		# INTEGRATOR_REALPART_BITS31_TO_16
-		# INTEGRATOR_REALPART_BITS47_TO_32
-		# INTEGRATOR_REALPART_BITS63_TO_48
-		# INTEGRATOR_IMAGPART_BITS15_TO_0
-		# INTEGRATOR_IMAGPART_BITS31_TO_16
-		# INTEGRATOR_IMAGPART_BITS47_TO_32
-		# INTEGRATOR_IMAGPART_BITS63_TO_48
-		# INTEGRATION_TIME_BITS15_TO_0
-		# INTEGRATION_TIME_BITS31_TO_16
-		# Thus each tested frequency will produce 2*64+32 bits (16 bytes).
-		bytes_per_frequency_vna = int((2*64+32)/8);
-		#repr_vna_all = np.reshape(rep, (-1, bytes_per_frequency_vna))    # note that this gives number_of_frequencies samples
-		print('self.number_of_frequencies = %d' % (self.number_of_frequencies))
-		print('bytes_per_frequency_vna = %d' % (bytes_per_frequency_vna))
-		print('len = %d' % (len(data_buffer)))
-		if len(data_buffer) < (self.number_of_frequencies)*bytes_per_frequency_vna:
+		# Interpret the samples as coming form the system identification VNA: one record of 20 bytes per tested frequency,
+		# viewed in place as a structured array (see LoggerRecords.py for the layout).
+		vna_records = LoggerRecords.decode_vna_records(data_buffer)
+		if len(vna_records) < self.number_of_frequencies:
 			# we don't have enough bytes for the whole array. only use the number of frequencies that will fit:
-			actual_number_of_frequencies = int(np.floor(len(data_buffer)/bytes_per_frequency_vna))
-			self.number_of_frequencies = actual_number_of_frequencies
-			
-		vna_raw_data = np.reshape(data_buffer[0:(self.number_of_frequencies)*bytes_per_frequency_vna], (self.number_of_frequencies, bytes_per_frequency_vna))    # note that this gives number_of_frequencies samples
-		print(vna_raw_data)
-		
-		vna_real = vna_raw_data[:, 0:8]
-		vna_imag = vna_raw_data[:, 8:16]
-		vna_integration_time = vna_raw_data[:, 16:20]
-		
-#        print('Real')
-#        print(vna_real)
-#        print('Imag')
-#        print(vna_imag)
-#        print('Integration time')
-#        print(vna_integration_time)
-		
-		# collapse the 8 bytes into 64-bits signed values:
-		# I am not sure whether this does the correct job with negative or very large values:
-		convert_8bytes_signed = np.array(range(8), dtype=np.int64)
-		convert_8bytes_signed = 2**(8*convert_8bytes_signed)
-		integrator_real         = np.dot(vna_real[:, :].astype(np.int64), convert_8bytes_signed)
-		integrator_imag         = np.dot(vna_imag[:, :].astype(np.int64), convert_8bytes_signed)
-		
-		convert_4bytes_unsigned = np.array(range(4), dtype=np.uint32)
-		convert_4bytes_unsigned = 2**(8*convert_4bytes_unsigned)
-		integration_time         = np.dot(vna_integration_time[:, :].astype(np.uint32), convert_4bytes_unsigned)
-		
-#        print(integration_time)
-#        print(convert_4bytes_unsigned)
-		
-#        print(vna_raw_data)
-
-		
-		# The frequency axis can be constructed from knowledge of 
-		# fs
-		# first_modulation_frequency
-		# modulation_frequency_step
-		# number_of_frequencies
-		frequency_axis = (self.first_modulation_frequency + self.modulation_frequency_step * np.array(range(self.number_of_frequencies), dtype=np.uint64)).astype(np.float64)/2**48*self.fs
-		
-		# While the overall gain is:
-		# That is, a pure loop-back system from the output of the VNA to the input will
-		#  give a modulus equal to overall_gain.
-		overall_gain = np.array(2.**(15-1) * self.output_gain * float((self.number_of_cycles_integration)), dtype=np.float) # the additionnal divide by two is because cos(x) = 1/2*exp(jx)+1/2*exp(-jx)
-		overall_gain = 2.**(15-1) * self.output_gain * integration_time.astype(np.float) # the additionnal divide by two is because cos(x) = 1/2*exp(jx)+1/2*exp(-jx)
-#        print(self.number_of_cycles_integration)
-#        overall_gain = 1
-#        print('TODO: Remove this line! overallgain = 1')
-		transfer_function_real = (integrator_real.astype(np.float)) / (overall_gain)
-		transfer_function_imag = (integrator_imag.astype(np.float)) / (overall_gain)
-		transfer_function_complex = transfer_function_real + 1j * transfer_function_imag
-#        phi = np.angle(transfer_function_real + 1j*transfer_function_imag)
-#        group_delay = ((-np.diff(phi)+np.pi) % (2*np.pi))-np.pi
-#        group_delay = group_delay / np.diff(frequency_axis)/2.0/np.pi
+			print('read_VNA_samples_from_DDR2(): only %d of the %d frequencies were received' % (len(vna_records), self.number_of_frequencies))
+			self.number_of_frequencies = len(vna_records)
+		vna_records = vna_records[:self.number_of_frequencies]
 
+		# The frequency axis can be constructed from knowledge of fs, first_modulation_frequency, modulation_frequency_step
+		# and number_of_frequencies, and the transfer function is normalized by the integration time of each frequency
+		(transfer_function_complex, frequency_axis) = LoggerRecords.vna_transfer_function(vna_records, self.output_gain,
+			self.first_modulation_frequency, self.modulation_frequency_step, self.fs)
 
 		return (transfer_function_complex, frequency_axis)
 	
-	def set_dac_offset(self, dac_number, offset):
+	def set_dac_offset(self, dac_number, offset, bDeferred=False):
 		if self.bVerbose == True:
 			print('set_dac_offset')
 			
@@ -1053,7 +1203,7 @@ class SuperLaserLand_JD_RP:
 			self.log_file.write('set_dac_offset()\n')
 		#print('set_dac_offset(): dac #%d, offset = %d' % (dac_number, offset))
 		self.DACs_offset[dac_number] = offset
-		self.send_bus_cmd_32bits(self.BUS_ADDR_DAC_offset[dac_number], offset)
+		self.send_bus_cmd_32bits(self.BUS_ADDR_DAC_offset[dac_number], offset, bDeferred)
 
 	def get_dac_offset(self, dac_number):
 		if self.bVerbose == True:
@@ -1166,6 +1316,7 @@ class SuperLaserLand_JD_RP:
 		if self.bCommunicationLogging == True:
 			self.log_file.write('set_ddc0_ref_freq()\n')
 		
+		self.ddc_kernels.invalidate(frequency_in_int=self.ddc0_frequency_in_int)
 		self.ddc0_frequency_in_int = int(round(2**48 * frequency_in_hz/self.fs))
 		self.ddc0_frequency_in_int = self.ddc0_frequency_in_int % (1 << 48) # modulo 2**48
 		self.ddc0_frequency_in_hz = self.ddc0_frequency_in_int/2.**48 * self.fs
@@ -1208,6 +1359,7 @@ class SuperLaserLand_JD_RP:
 		if self.bCommunicationLogging == True:
 			self.log_file.write('set_ddc1_ref_freq()\n')
 
+		self.ddc_kernels.invalidate(frequency_in_int=self.ddc1_frequency_in_int)
 		self.ddc1_frequency_in_int = int(round(2**48 * frequency_in_hz/self.fs))
 		self.ddc1_frequency_in_int = self.ddc1_frequency_in_int % (1 << 48) # modulo 2**48
 		self.ddc1_frequency_in_hz = self.ddc1_frequency_in_int/2.**48 * self.fs
@@ -1382,11 +1534,15 @@ class SuperLaserLand_JD_RP:
 
 
 	def get_Dither_Settings(self, dac_number):
-		self.modulation_period_divided_by_4_minus_one[dac_number] 	= self.read_RAM_dpll_wrapper(self.BUS_ADDR_dither_period_divided_by_4_minus_one[dac_number])
-		self.N_periods_integration_minus_one[dac_number] 			= self.read_RAM_dpll_wrapper(self.BUS_ADDR_dither_N_periods_minus_one[dac_number])
-		self.dither_amplitude[dac_number] 							= self.read_RAM_dpll_wrapper(self.BUS_ADDR_dither_amplitude[dac_number])
-		self.dither_enable[dac_number] 								= self.read_RAM_dpll_wrapper(self.BUS_ADDR_dither_enable[dac_number])
-		self.dither_mode_auto[dac_number] 							= self.read_RAM_dpll_wrapper(self.BUS_ADDR_dither_mode_auto[dac_number])
+		(self.modulation_period_divided_by_4_minus_one[dac_number],
+		 self.N_periods_integration_minus_one[dac_number],
+		 self.dither_amplitude[dac_number],
+		 self.dither_enable[dac_number],
+		 self.dither_mode_auto[dac_number]) = self.read_many_RAM_dpll_wrapper((self.BUS_ADDR_dither_period_divided_by_4_minus_one[dac_number],
+		                                                                     self.BUS_ADDR_dither_N_periods_minus_one[dac_number],
+		                                                                     self.BUS_ADDR_dither_amplitude[dac_number],
+		                                                                     self.BUS_ADDR_dither_enable[dac_number],
+		                                                                     self.BUS_ADDR_dither_mode_auto[dac_number]))
 
 		modulation_period = int((self.modulation_period_divided_by_4_minus_one[dac_number]+1)*4)
 		N_periods = int(self.N_periods_integration_minus_one[dac_number]+1)
@@ -1412,17 +1568,8 @@ class SuperLaserLand_JD_RP:
 			return samples
 		
 		# print 'ditherRead------------'
-		for k in range(N_samples):
-
-			# results_lsb = self.dev.read_Zynq_register_uint32(BASE_ADDR_REAL_LSB*4)
-			# results_msb = self.dev.read_Zynq_register_uint32(BASE_ADDR_REAL_MSB*4)
-			# # print 'results_lsb = %d' % results_lsb
-			# # print 'results_msb = %d' % results_msb
-
-			# results = np.array((results_lsb, results_msb), np.dtype(np.uint32))
-			# results = np.frombuffer(results, np.dtype(np.int64) )
-			samples[k] = self.dev.read_Zynq_register_int64(BASE_ADDR_REAL_LSB*4, BASE_ADDR_REAL_MSB*4)
-
+		# all the reads in a single batch. Consecutive reads usually return the same result, see DitherSampler.py for the statistics over many integrations
+		samples[:] = self.dev.read_many_uint32([BASE_ADDR_REAL_LSB*4, BASE_ADDR_REAL_MSB*4]*N_samples).view(np.int64)
 			
 		return samples
 		
@@ -1508,44 +1655,28 @@ class SuperLaserLand_JD_RP:
 		return (hold, flip_sign, lock, gain_in_bits)
 
 
-	def frontend_DDC_processing(self, samples, ref_exp0, input_number):
+	def frontend_DDC_processing(self, samples, ref_exp0, input_number, dtype=np.complex128, decimation=1):
+		# complex baseband of the samples of ADC0 or ADC1, as filtered by the DDC of the firmware.
+		# dtype=np.complex64 halves the memory traffic, for long captures. With decimation > 1, only one baseband sample out of decimation
+		# is computed (and returned): its sample rate is then fs/decimation.
 		if self.bVerbose == True:
 			print('frontend_DDC_processing, len(samples) = %d, samples[0] = %d' % (len(samples), samples[0]))
 			
 		# The signal is from ADC0 or ADC1
 		if input_number == 0:
-			f_reference = float(self.ddc0_frequency_in_int) / 2**48
+			frequency_in_int = self.ddc0_frequency_in_int
+			filter_select = self.ddc0_filter_select
 		elif input_number == 1:
-			f_reference = float(self.ddc1_frequency_in_int) / 2**48
-		
+			frequency_in_int = self.ddc1_frequency_in_int
+			filter_select = self.ddc1_filter_select
 		
-		ref_exp = (ref_exp0)/np.abs(ref_exp0) * np.exp(-1j*2*np.pi*f_reference*np.array(range(len(samples))))
+		# the reference phasor and the filter only depend on the settings: they come from the cache, see DDCKernels.py
+		(ref_exp, lpf, N_filter) = self.ddc_kernels.getKernels(frequency_in_int, len(samples), filter_select, dtype)
+		samples = np.asarray(samples, dtype=ref_exp.real.dtype)
 		complex_baseband = (samples-np.mean(samples)) * ref_exp
+		complex_baseband *= ref_exp0/np.abs(ref_exp0)
 		
-		# There are two versions of the firmware in use: one uses a 20points boxcar filter,
-		# the other one uses a wider bandwidth filter, consisting of a cascade of a 2-pts boxcar, another 2-pts boxcar, and finally a 4-points boxcar.
-		if input_number == 0:
-			filter_select = self.ddc0_filter_select
-			angle_select  = self.ddc0_angle_select
-		else:
-			filter_select = self.ddc1_filter_select
-			angle_select  = self.ddc1_angle_select
-			
-		
-		if filter_select == 0:
-			N_filter = 16
-			lpf = np.convolve(np.ones(2, dtype=float)/2., np.ones(2, dtype=float)/2.)
-			lpf = np.convolve(np.ones(4, dtype=float)/4., lpf)
-			
-		elif filter_select == 1:
-			N_filter = 20
-			lpf = np.convolve(np.ones(4, dtype=float)/4., np.ones(16, dtype=float)/16.)
-		elif filter_select == 2:
-			N_filter = 16+2
-			lpf = np.array([4533, 11833, 14589, 7610, -2628, -5400, -350, 3293, 1086, -1867, -1080, 956, 800, -462, -650, 338])/(2.**15-1)
-			lpf = np.convolve(np.ones(2, dtype=float)/2., lpf)
-#            print(lpf)
-		complex_baseband = lfilter(lpf, 1, complex_baseband)[N_filter:]
+		complex_baseband = fir_filter(complex_baseband, lpf, N_filter, decimation)
 		return complex_baseband
 		
 
@@ -1590,8 +1721,7 @@ class SuperLaserLand_JD_RP:
 			spc_filter = 20*np.log10(np.abs(spc_filter) + 1e-7)
 		elif filter_select == 2:
 			# minimum-phase fir filter:
-			lpf = np.array([4533, 11833, 14589, 7610, -2628, -5400, -350, 3293, 1086, -1867, -1080, 956, 800, -462, -650, 338])/(2.**15-1)
-			lpf = np.convolve(np.ones(2, dtype=float)/2., lpf)
+			(lpf, N_filter) = ddc_filter_taps(filter_select)
 			spc_ref = np.fft.fft(lpf, 2*len(frequency_axis))
 			freq_axis_ref = np.linspace(0*self.fs, 1*self.fs, 2*len(frequency_axis))
 			spc_filter = np.interp(abs(frequency_axis-abs(f_reference)), freq_axis_ref, np.abs(spc_ref))
@@ -1682,7 +1812,25 @@ class SuperLaserLand_JD_RP:
 	def read_dual_mode_counter(self, output_number):
 		# fetch data
 		# reading at this address samples all frequency counter data at the same time (see registers_read.vhd for details)
-		zdtc_samples_number_counter = self.dev.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4)
+		# all the registers are read in a single batch, so this costs only one round-trip.
+		# the samples number register must stay first in the batch since reading it is what latches the other values
+		# anyone else reading the samples number latches them again (monitor-tcp's counter backlog thread polls it continuously),
+		# so we read it again at the end of the batch, and start over if a newer sample was latched in the middle of our reads
+		while True:
+			with self.dev.transaction() as t:
+				zdtc_samples_number_counter = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4)
+				counter0_lsbs = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS*4)
+				counter0_msbs = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_MSBS*4)
+				counter1_lsbs = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS*4)
+				counter1_msbs = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_COUNTER1_MSBS*4)
+				dac0_samples = t.read_Zynq_register_int32(self.BUS_ADDR_DAC0_CURRENT*4)
+				dac1_samples = t.read_Zynq_register_int32(self.BUS_ADDR_DAC1_CURRENT*4)
+				dac2_samples = t.read_Zynq_register_uint32(self.BUS_ADDR_DAC2_CURRENT*4) #this doesn't seems to work
+				zdtc_samples_number_check = t.read_Zynq_register_uint32(self.BUS_ADDR_ZERO_DEADTIME_SAMPLES_NUMBER*4)
+			if zdtc_samples_number_check.value == zdtc_samples_number_counter.value:
+				break
+		zdtc_samples_number_counter = zdtc_samples_number_counter.value
+
 		increments = zdtc_samples_number_counter - self.last_zdtc_samples_number_counter[output_number]
 		if increments != 0:
 
@@ -1694,8 +1842,9 @@ class SuperLaserLand_JD_RP:
 
 
 			# we have new unread samples
-			freq_counter0_sample = self.dev.read_Zynq_register_int64(self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_LSBS*4, self.BUS_ADDR_ZERO_DEADTIME_COUNTER0_MSBS*4)
-			freq_counter1_sample = self.dev.read_Zynq_register_int64(self.BUS_ADDR_ZERO_DEADTIME_COUNTER1_LSBS*4, self.BUS_ADDR_ZERO_DEADTIME_COUNTER1_MSBS*4)
+			# convert to 64 bits using numpy's casts
+			freq_counter0_sample = np.frombuffer(np.array((counter0_lsbs.value, counter0_msbs.value), np.dtype(np.uint32)), np.dtype(np.int64))
+			freq_counter1_sample = np.frombuffer(np.array((counter1_lsbs.value, counter1_msbs.value), np.dtype(np.uint32)), np.dtype(np.int64))
 			# print("zdtc_samples_number_counter = %d, was %d, read new values" % (zdtc_samples_number_counter, self.last_zdtc_samples_number_counter[output_number]))
 			if increments>1 and self.last_zdtc_samples_number_counter[output_number] != 0:
 				print("Warning, %d counter sample(s) dropped on counter #%d" % (zdtc_samples_number_counter-self.last_zdtc_samples_number_counter[output_number]-1, output_number))
@@ -1709,9 +1858,9 @@ class SuperLaserLand_JD_RP:
 
 
 
-		dac0_samples = self.dev.read_Zynq_register_int32(self.BUS_ADDR_DAC0_CURRENT*4)
-		dac1_samples = self.dev.read_Zynq_register_int32(self.BUS_ADDR_DAC1_CURRENT*4)
-		dac2_samples = self.dev.read_Zynq_register_uint32(self.BUS_ADDR_DAC2_CURRENT*4) #this doesn't seems to work
+		dac0_samples = dac0_samples.value
+		dac1_samples = dac1_samples.value
+		dac2_samples = dac2_samples.value
 		if dac2_samples>0xFFFF0000: #greather than 16 bits
 			dac2_samples = dac2_samples-0xFFFF0000
 		# convert to numpy format:
@@ -1731,6 +1880,52 @@ class SuperLaserLand_JD_RP:
 			return (freq_counter0_sample, time_axis, dac0_samples, dac1_samples, dac2_samples)
 		elif output_number == 1:
 			return (freq_counter1_sample, time_axis, dac0_samples, dac1_samples, dac2_samples)
+
+	def subscribe_dual_mode_counter(self, records_per_push=1, max_latency=0.1):
+		# the device pushes every counter sample on a separate connection, so none is dropped when we read late (see RP_PLL.CounterSubscription).
+		# each batch of records can be converted with scale_counter_records().
+		# For scripts: the windows get their samples through state_hub instead, see the comments of RP_PLL.CounterSubscription
+		return self.dev.subscribe_counters(records_per_push, max_latency)
+
+	def read_counter_backlog(self, output_number, first_samples_number=None):
+		# every counter sample since the last one read for this output (or since first_samples_number), from the buffer which monitor-tcp
+		# fills in the background, so nothing is lost when we read late. same outputs as scale_counter_records()
+		if first_samples_number is None:
+			first_samples_number = self.last_zdtc_samples_number_counter[output_number] + 1
+		batches = []
+		while True:
+			records = self.dev.read_counter_backlog(first_samples_number)
+			batches.append(records)
+			if len(records) < self.dev.MAX_BACKLOG_RECORDS_PER_READ:
+				break
+			first_samples_number = int(records['samples_number'][-1]) + 1
+		return self.scale_counter_records(np.concatenate(batches), output_number)
+
+	def scale_counter_records(self, records, output_number):
+		# same outputs as read_dual_mode_counter(), but with all the samples of a batch from subscribe_dual_mode_counter() or read_counter_backlog()
+		time_axis = None
+		if len(records) == 0:
+			return (None, time_axis, np.array(()), np.array(()), np.array(()))
+
+		samples_number = records['samples_number'].astype(np.int64)
+		previous_samples_number = np.concatenate(((self.last_zdtc_samples_number_counter[output_number],), samples_number[:-1]))
+		increments = samples_number - previous_samples_number
+		if self.last_zdtc_samples_number_counter[output_number] == 0:
+			increments[0] = 1
+		samples_dropped = np.sum(increments[increments > 1] - 1)
+		if samples_dropped > 0:
+			self.logger.warning('Red_Pitaya_GUI{}: {} counter sample(s) dropped on counter #{}'.format(self.logger_name, samples_dropped, output_number))
+		self.last_zdtc_samples_number_counter[output_number] = int(samples_number[-1])
+
+		if output_number == 0:
+			freq_counter_samples = self.scaleCounterReadingsIntoHz(records['counter0'])
+		else:
+			freq_counter_samples = self.scaleCounterReadingsIntoHz(records['counter1'])
+		dac0_samples = records['dac0'].astype(np.int64)
+		dac1_samples = records['dac1'].astype(np.int64)
+		dac2_samples = records['dac2'].astype(np.int64)
+		dac2_samples[dac2_samples > 0xFFFF0000] -= 0xFFFF0000	# greater than 16 bits, same as in read_dual_mode_counter()
+		return (freq_counter_samples, time_axis, dac0_samples, dac1_samples, dac2_samples)
 		
 	def set_ddc_filter(self, adc_number, filter_select, angle_select = 0):
 		if self.bVerbose == True:
@@ -1738,9 +1933,13 @@ class SuperLaserLand_JD_RP:
 			
 		
 		if adc_number == 0:
+			if filter_select != self.ddc0_filter_select:
+				self.ddc_kernels.invalidate(filter_select=self.ddc0_filter_select)
 			self.ddc0_filter_select = filter_select
 			self.ddc0_angle_select = angle_select
 		elif adc_number == 1:
+			if filter_select != self.ddc1_filter_select:
+				self.ddc_kernels.invalidate(filter_select=self.ddc1_filter_select)
 			self.ddc1_filter_select = filter_select
 			self.ddc1_angle_select = angle_select
 			
@@ -1865,21 +2064,68 @@ class SuperLaserLand_JD_RP:
 			self.output_vco = [0, 1, 0]
 		return mux_value
 
+	# The dpll_wrapper RAM holds a copy of the last value written to each register, so these values only change when we write them.
+	# They are cached in the shadow copy of the registers kept by self.dev (see RP_PLL.ShadowRegisters), which our own writes keep up to date,
+	# and only the registers which are not in the cache are actually read, all in a single round-trip.
+	# The cache is invalidated by resetFrontend() and when reconnecting.
 	def read_RAM_dpll_wrapper(self,addr):
-		bus_address = (2 << 20) + addr*4
-		value = self.dev.read_Zynq_register_uint32(bus_address)
-		if value == 4026531839:
-			print('Warning! You received the default value when asking for data at address {}.'.format(hex(int(addr))))
-			self.logger.warning('Red_Pitaya_GUI{}: Warning! You received the default value when asking for data at address {}"'.format(self.logger_name, hex(int(addr))))
-		return value
+		return self.read_many_RAM_dpll_wrapper((addr,))[0]
 
 	def read_RAM_dpll_wrapper_signed(self,addr):
-		bus_address = (2 << 20) + addr*4
-		value = self.dev.read_Zynq_register_int32(bus_address)
-		if value == 4026531839 - 2**32:
-			print('Warning! You received the default value when asking for data at address {}.'.format(hex(int(addr))))
-			self.logger.warning('Red_Pitaya_GUI{}: Warning! You received the default value when asking for data at address {}"'.format(self.logger_name, hex(int(addr))))
-		return value
+		return self.read_many_RAM_dpll_wrapper_signed((addr,))[0]
+
+	def read_many_RAM_dpll_wrapper(self, addr_list, bWarnOnDefaultValue=True):
+		self.RAM_dpll_wrapper_addresses.update(int(addr) for addr in addr_list)
+		values = [self.dev.shadow_registers.lookup(self.dev.FPGA_BASE_ADDR + int(addr)*4) for addr in addr_list]
+		addr_to_read = [addr for (addr, value) in zip(addr_list, values) if value is None]
+		if len(addr_to_read) == 0:
+			return values
+
+		bus_addresses = [(2 << 20) + addr*4 for addr in addr_to_read]
+		read_values = iter(self.dev.read_many_uint32(bus_addresses).tolist())
+		for k in range(len(values)):
+			if values[k] is not None:
+				continue
+			values[k] = next(read_values)
+			if values[k] == 4026531839:
+				# default value: this register has never been written
+				if bWarnOnDefaultValue:
+					print('Warning! You received the default value when asking for data at address {}.'.format(hex(int(addr_list[k]))))
+					self.logger.warning('Red_Pitaya_GUI{}: Warning! You received the default value when asking for data at address {}"'.format(self.logger_name, hex(int(addr_list[k]))))
+			else:
+				self.dev.shadow_registers.recordWrite(self.dev.FPGA_BASE_ADDR + int(addr_list[k])*4, values[k])
+		return values
+
+	def read_many_RAM_dpll_wrapper_signed(self, addr_list):
+		return [value - (1 << 32) if value >= (1 << 31) else value for value in self.read_many_RAM_dpll_wrapper(addr_list)]
+
+	def warm_up_RAM_dpll_wrapper_cache(self):
+		# Reads all the configuration registers in a single round-trip, so that the getValues() of all the windows are then served from the cache.
+		# This covers every register read through read_RAM_dpll_wrapper() so far, plus the ones the windows read at startup
+		addr_list = set(self.RAM_dpll_wrapper_addresses)
+		addr_list.update(self.BUS_ADDR_DAC_offset)
+		addr_list.update(self.BUS_ADDR_dac_limits)
+		addr_list.update(self.BUS_ADDR_openLoopGain)
+		for dac_number in range(3):
+			addr_list.update((self.BUS_ADDR_dither_enable[dac_number],
+							  self.BUS_ADDR_dither_period_divided_by_4_minus_one[dac_number],
+							  self.BUS_ADDR_dither_N_periods_minus_one[dac_number],
+							  self.BUS_ADDR_dither_amplitude[dac_number],
+							  self.BUS_ADDR_dither_mode_auto[dac_number]))
+		addr_list.update((self.BUS_ADDR_ref_freq0_lsbs,
+						  self.BUS_ADDR_ref_freq0_msbs,
+						  self.BUS_ADDR_nominal_ref_freq1_lsbs,
+						  self.BUS_ADDR_nominal_ref_freq1_msbs,
+						  self.BUS_ADDR_ddc_filter_select,
+						  self.BUS_ADDR_ddc_angle_select,
+						  self.BUS_ADDR_integrator1_settings,
+						  self.BUS_ADDR_integrator2_settings,
+						  self.BUS_ADDR_triangular_averaging,
+						  self.BUS_ADDR_mux_pll2))
+		for pll in getattr(self, 'pll', ()):
+			addr_list.update(pll.bus_base_address + offset for offset in range(pll.BUS_OFFSET_coef_d_filt+1))
+		# the registers which have never been written are simply not cached
+		self.read_many_RAM_dpll_wrapper(sorted(addr_list), bWarnOnDefaultValue=False)
 
 
 
@@ -2028,22 +2274,17 @@ class SuperLaserLand_JD_RP:
 		time_start = time.perf_counter()
 		# average 10 readings because otherwise they are quite noisy:
 		# this reading loop takes just 2 ms for 10 readings at the moment so there is no real cost
-		N_average = 10.
-		reg_avg = 0.
-		for k in range(int(N_average)):
-			reg = self.dev.read_Zynq_AXI_register_uint32(self.xadc_base_addr+0x200)
-			reg_avg += float(reg)
-			
-		reg_avg = float(reg_avg)/N_average
+		# the 10 reads are pipelined so they cost a single round-trip
+		N_average = 10
+		regs = self.dev.read_many_AXI_uint32([self.xadc_base_addr+0x200]*N_average)
+		reg_avg = np.mean(regs.astype(float))
 		# print("elapsed = %f" % (time.perf_counter()-time_start))
 		ZynqTempInDegC = xadc_temperature_code_to_degC(  reg_avg  )
 		return ZynqTempInDegC
 		
 	def getExtClockFreq(self):
 		# see "digital_clock_freq_counter.vhd" for the meaning of each of these registers.
-		read_all_regs = lambda : (self.dev.read_Zynq_AXI_register_uint32(self.clk_freq_reg1),
-		                          self.dev.read_Zynq_AXI_register_uint32(self.clk_freq_reg2),
-		                          self.dev.read_Zynq_AXI_register_uint32(self.clk_freq_reg3))
+		read_all_regs = lambda : tuple(self.dev.read_many_AXI_uint32((self.clk_freq_reg1, self.clk_freq_reg2, self.clk_freq_reg3)).tolist())
 		data_index = lambda x: (x >> 24)
 		iAttempts = 0;
 		bSuccess = False
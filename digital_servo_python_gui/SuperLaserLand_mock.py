@@ -1,9 +1,26 @@
+import time
 import numpy as np
 
 from SuperLaserLand_JD_RP import SuperLaserLand_JD_RP
+from DeviceStateHub import DeviceStateHub, DeviceStateSnapshot
 
 import RP_PLL
 
+# The device state (counters and DAC currents) comes from the mock's attributes instead of the registers.
+class DeviceStateHub_mock(DeviceStateHub):
+
+	def readSnapshot(self):
+		if self.sl.bIntroduceCommsException['read_dac_currents']:
+			raise RP_PLL.CommsError('test exception')
+
+		self.snapshots_read += 1
+		counter_record = np.zeros(1, dtype=RP_PLL.CounterSubscription.RECORD_DTYPE)
+		counter_record['samples_number'] = self.snapshots_read
+		counter_record['dac0'] = self.sl.dac_currents[0]
+		counter_record['dac1'] = self.sl.dac_currents[1]
+		counter_record['dac2'] = self.sl.dac_currents[2]
+		return DeviceStateSnapshot(self.snapshots_read, time.perf_counter(), 0, counter_record, counter_record)
+
 # This is a subclass of SuperLaserLand_JD_RP, and we simply override
 # the methods that would not work without a physical setup attached.
 class SuperLaserLand_mock(SuperLaserLand_JD_RP):
@@ -16,8 +33,12 @@ class SuperLaserLand_mock(SuperLaserLand_JD_RP):
 		'read_ddc_samples_from_DDR2': False,
 		'trigger_write': False,
 		'setDitherLockInState': False,
-		'set_dac_offset': False}
+		'set_dac_offset': False,
+		'read_dac_currents': False}
 		self.random_seed = 0
+		# current values of the DAC outputs, in counts: about 0.1 V, 0.2 V and 1 V
+		self.dac_currents = [3277, 6553, 19859]
+		self.state_hub = DeviceStateHub_mock(self)
 
 		pass
 
@@ -33,7 +54,7 @@ class SuperLaserLand_mock(SuperLaserLand_JD_RP):
 		if self.bIntroduceCommsException['setup_write']:
 			raise RP_PLL.CommsError('test exception')
 
-	def read_adc_samples_from_DDR2(self):
+	def read_adc_samples_from_DDR2(self, between_chunks=None, data_buffer=None):
 		if self.bIntroduceCommsException['read_adc_samples_from_DDR2']:
 			raise RP_PLL.CommsError('test exception')
 
@@ -55,7 +76,7 @@ class SuperLaserLand_mock(SuperLaserLand_JD_RP):
 		return (samples_out, ref_exp0)
 
 
-	def read_ddc_samples_from_DDR2(self):
+	def read_ddc_samples_from_DDR2(self, between_chunks=None, data_buffer=None):
 		if self.bIntroduceCommsException['read_ddc_samples_from_DDR2']:
 			raise RP_PLL.CommsError('test exception')
 
@@ -89,10 +110,13 @@ class SuperLaserLand_mock(SuperLaserLand_JD_RP):
 	def wait_for_write(self):
 		pass
 
-	def set_dac_offset(self, dac_number, offset):
+	def set_dac_offset(self, dac_number, offset, bDeferred=False):
 		if self.bIntroduceCommsException['set_dac_offset']:
 			raise RP_PLL.CommsError('test exception')
 		pass
 
+	def flush_register_writes(self):
+		pass
+
 	def set_integrator_settings(self, integrator_number, hold, flip_sign, lock, gain_in_bits):
 		pass
\ No newline at end of file
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# Record and replay of the traffic between RP_PLL_device and monitor-tcp.
+#
+# Recording: dev.startRecording('session.rptrace') wraps the sockets of all channels (control, bulk, telemetry and probe),
+# and every packet sent, every block of bytes received, and every connection/disconnection/error is written to the trace
+# along with a monotonic timestamp.
+# Replay: dev.startReplay('session.rptrace') before dev.OpenTCPConnection(): the sockets are then replaced by objects
+# which serve the recorded replies, without any network. With bRealTime=True, each reply is delayed by the same amount
+# as during the recording (measured from the previous event on the same channel), so the device's latency is reproduced
+# while our own processing runs at its current speed. With bRealTime=False, everything is served as fast as possible.
+#
+# File format: the 8-bytes FILE_MAGIC, then one record per event:
+# float64 timestamp (seconds since the start of the recording), uint8 channel, uint8 event type, uint32 payload length, payload.
+# read_trace() iterates over the records, for offline analysis.
+
+from __future__ import print_function
+import socket
+import struct
+import threading
+import collections
+import builtins
+import time
+import logging
+
+FILE_MAGIC = b'RPTRACE1'
+RECORD_HEADER = struct.Struct('<dBBI')
+
+CHANNEL_CONTROL = 0
+CHANNEL_BULK    = 1
+CHANNEL_TELEMETRY = 2   # counter subscriptions (see CounterSubscription in RP_PLL.py)
+CHANNEL_PROBE   = 3     # the connections which check which requests the server supports (see RP_PLL_device.probeServer())
+
+EVENT_SEND              = 0     # payload: the bytes sent
+EVENT_RECV              = 1     # payload: the bytes received
+EVENT_CONNECT           = 2
+EVENT_CONNECT_FAILED    = 3     # payload: name of the exception
+EVENT_CLOSE             = 4
+EVENT_ERROR             = 5     # socket error during a send or receive, payload: name of the exception
+
+def read_trace(strFilename):
+    # yields (timestamp, channel, event, payload) for each record in the file
+    with open(strFilename, 'rb') as f:
+        data = f.read()
+    if data[:len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError('{} is not a trace file'.format(strFilename))
+    view = memoryview(data)
+    offset = len(FILE_MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        (timestamp, channel, event, length) = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        yield (timestamp, channel, event, view[offset:offset+length])
+        offset += length
+
+def exception_from_name(strName):
+    # re-creates the socket error which happened during the recording
+    exception_class = getattr(socket, strName, None) or getattr(builtins, strName, None)
+    if isinstance(exception_class, type) and issubclass(exception_class, OSError):
+        return exception_class('replayed ' + strName)
+    return OSError('replayed ' + strName)
+
+class TraceRecorder():
+    def __init__(self, strFilename):
+        self.file = open(strFilename, 'wb')
+        self.file.write(FILE_MAGIC)
+        self.lock = threading.Lock()    # the two channels are usually used from different threads
+        self.time_start = time.perf_counter()
+
+    def record(self, channel, event, payload=b''):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD_HEADER.pack(time.perf_counter()-self.time_start, channel, event, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+    def wrapSocket(self, sock, channel, bConnected=False):
+        if bConnected:
+            # recording starts on a connection which is already open
+            self.record(channel, EVENT_CONNECT)
+        return RecordingSocket(sock, self, channel)
+
+class RecordingSocket():
+    # forwards everything to the real socket, and records the traffic
+    def __init__(self, sock, recorder, channel):
+        self.sock = sock
+        self.recorder = recorder
+        self.channel = channel
+
+    def connect(self, address):
+        try:
+            self.sock.connect(address)
+        except OSError as e:
+            self.recorder.record(self.channel, EVENT_CONNECT_FAILED, type(e).__name__.encode('ascii'))
+            raise
+        self.recorder.record(self.channel, EVENT_CONNECT)
+
+    def sendall(self, data):
+        self.recorder.record(self.channel, EVENT_SEND, data)
+        try:
+            self.sock.sendall(data)
+        except OSError as e:
+            self.recorder.record(self.channel, EVENT_ERROR, type(e).__name__.encode('ascii'))
+            raise
+
+    def recv_into(self, buffer, nbytes=0):
+        try:
+            nbytes = self.sock.recv_into(buffer, nbytes)
+        except OSError as e:
+            self.recorder.record(self.channel, EVENT_ERROR, type(e).__name__.encode('ascii'))
+            raise
+        self.recorder.record(self.channel, EVENT_RECV, bytes(memoryview(buffer)[:nbytes]))
+        return nbytes
+
+    def close(self):
+        self.recorder.record(self.channel, EVENT_CLOSE)
+        self.sock.close()
+
+    def __getattr__(self, name):
+        # setsockopt(), settimeout(), etc
+        return getattr(self.sock, name)
+
+class TraceReplay():
+    def __init__(self, strFilename, bRealTime=True):
+        self.logger = logging.getLogger(__name__)
+        self.logger_name = ':WireTrace'
+        self.bRealTime = bRealTime
+        # the events of each channel are replayed independently, in their recorded order
+        self.events = collections.defaultdict(collections.deque)
+        for (timestamp, channel, event, payload) in read_trace(strFilename):
+            self.events[channel].append((timestamp, event, payload))
+        # (recorded time, replay time) of the last event served on each channel, used to reproduce the delays
+        self.last_event_times = {}
+        self.bDiverged = False
+
+    def createSocket(self, channel):
+        return ReplaySocket(self, channel)
+
+    def warnDivergence(self, strMessage):
+        # our requests don't match the recording anymore: the replies we serve from now on are probably meaningless
+        if not self.bDiverged:
+            self.bDiverged = True
+            self.logger.warning('Red_Pitaya_GUI{}: replay diverged from the recording: {}'.format(self.logger_name, strMessage))
+
+    def waitForEvent(self, channel, timestamp):
+        # in real-time mode, wait as long after the previous event on this channel as during the recording
+        last_event_times = self.last_event_times.get(channel)
+        if self.bRealTime and last_event_times is not None:
+            (last_timestamp, last_replay_time) = last_event_times
+            delay = last_replay_time + (timestamp - last_timestamp) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.last_event_times[channel] = (timestamp, time.perf_counter())
+
+    def peek(self, channel):
+        events = self.events[channel]
+        if len(events) == 0:
+            return (None, None, None)
+        return events[0]
+
+    def pop(self, channel):
+        (timestamp, event, payload) = self.events[channel].popleft()
+        self.waitForEvent(channel, timestamp)
+        return (event, payload)
+
+    def skipToConnection(self, channel):
+        # drops the rest of the previous connection on this channel
+        events = self.events[channel]
+        while events and events[0][1] not in (EVENT_CONNECT, EVENT_CONNECT_FAILED):
+            events.popleft()
+
+class ReplaySocket():
+    # stands in for a socket connected to monitor-tcp, serves the recorded replies
+    def __init__(self, replay, channel):
+        self.replay = replay
+        self.channel = channel
+        self.pending_bytes = memoryview(b'')    # part of a received block which has not been read yet
+
+    def connect(self, address):
+        self.replay.skipToConnection(self.channel)
+        (timestamp, event, payload) = self.replay.peek(self.channel)
+        if event is None:
+            raise ConnectionRefusedError('end of the recording')
+        (event, payload) = self.replay.pop(self.channel)
+        if event == EVENT_CONNECT_FAILED:
+            raise exception_from_name(bytes(payload).decode('ascii'))
+
+    def sendall(self, data):
+        (timestamp, event, payload) = self.replay.peek(self.channel)
+        while event == EVENT_RECV:
+            # the recording received more than we have read
+            self.replay.warnDivergence('unread reply on channel {}'.format(self.channel))
+            self.replay.pop(self.channel)
+            (timestamp, event, payload) = self.replay.peek(self.channel)
+        if event != EVENT_SEND:
+            if event == EVENT_ERROR:
+                self.replay.pop(self.channel)
+                raise exception_from_name(bytes(payload).decode('ascii'))
+            raise BrokenPipeError('end of the recorded connection')
+        self.replay.pop(self.channel)
+        if bytes(payload) != bytes(data):
+            self.replay.warnDivergence('different request on channel {}'.format(self.channel))
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        if nbytes == 0:
+            nbytes = len(view)
+        if len(self.pending_bytes) == 0:
+            (timestamp, event, payload) = self.replay.peek(self.channel)
+            if event == EVENT_ERROR:
+                self.replay.pop(self.channel)
+                raise exception_from_name(bytes(payload).decode('ascii'))
+            if event != EVENT_RECV:
+                # we are waiting for a reply which was not recorded: same as a closed connection
+                self.replay.warnDivergence('missing reply on channel {}'.format(self.channel))
+                return 0
+            (event, self.pending_bytes) = self.replay.pop(self.channel)
+        nbytes = min(nbytes, len(self.pending_bytes))
+        view[:nbytes] = self.pending_bytes[:nbytes]
+        self.pending_bytes = self.pending_bytes[nbytes:]
+        return nbytes
+
+    def close(self):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
@@ -0,0 +1,56 @@
+import numpy as np
+
+from MonitorTCP_simulator import MonitorTCP_simulator
+from SuperLaserLand_JD_RP import SuperLaserLand_JD_RP
+
+def run_session(sl):
+    # a few typical exchanges, returns everything we got from the device
+    sl.set_dac_offset(0, -123)
+    sl.setup_ADC0_write(2**12)
+    sl.trigger_write()
+    sl.wait_for_write()
+    sl.dev.read_Zynq_register_uint32(sl.BUS_ADDR_STATUS_FLAGS*4)
+    (samples, ref_exp0) = sl.read_adc_samples_from_DDR2(between_chunks=lambda: None)
+    (freq_counter_sample, time_axis, dac0_samples, dac1_samples, dac2_samples) = sl.read_dual_mode_counter(0)
+    return (samples.copy(), ref_exp0, dac0_samples[0], sl.readZynqTemperature())
+
+def test_record_and_replay(tmp_path):
+    strFilename = str(tmp_path / 'session.rptrace')
+
+    sim = MonitorTCP_simulator(seed=0)
+    sim.start()
+    sl = SuperLaserLand_JD_RP()
+    sl.dev.startRecording(strFilename)
+    sl.dev.OpenTCPConnection('127.0.0.1', sim.PORT)
+    recorded = run_session(sl)
+    sl.dev.stopRecording()
+    sl.dev.CloseTCPConnection()
+    sim.stop()
+
+    # no network this time: the simulator is gone and the host doesn't exist
+    for bRealTime in (True, False):
+        sl = SuperLaserLand_JD_RP()
+        sl.dev.startReplay(strFilename, bRealTime)
+        sl.dev.OpenTCPConnection('replay', 5000)
+        replayed = run_session(sl)
+        assert np.array_equal(replayed[0], recorded[0])
+        assert replayed[1:] == recorded[1:]
+        assert not sl.dev.trace_replay.bDiverged
+
+def test_replay_connection_failure(tmp_path):
+    strFilename = str(tmp_path / 'failure.rptrace')
+
+    sim = MonitorTCP_simulator()
+    sim.start()
+    PORT = sim.PORT
+    sim.stop()
+    sl = SuperLaserLand_JD_RP()
+    sl.dev.startRecording(strFilename)
+    sl.dev.OpenTCPConnection('127.0.0.1', PORT)
+    sl.dev.stopRecording()
+    assert not sl.dev.valid_socket
+
+    sl = SuperLaserLand_JD_RP()
+    sl.dev.startReplay(strFilename)
+    sl.dev.OpenTCPConnection('replay', 5000)
+    assert not sl.dev.valid_socket
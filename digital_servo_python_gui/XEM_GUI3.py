@@ -15,6 +15,7 @@ import ctypes # for the icons
 
 
 from SuperLaserLand_JD_RP import SuperLaserLand_JD_RP
+from DeviceIOThread import DeviceIOThread
 from XEM_GUI_MainWindow import XEM_GUI_MainWindow
 from FreqErrorWindowWithTempControlV2 import FreqErrorWindowWithTempControlV2
 from initialConfiguration_RP import initialConfiguration
@@ -41,6 +42,8 @@ SYSLOG_IP = '127.0.0.1' #To log on this computer
 # SYSLOG_IP = '10.248.174.184'
 SYSLOG_PORT = 514
 logging.basicConfig(level=logging.INFO)
+TRANSPORT_STATISTICS_PERIOD = 0 # in seconds. set to log which windows generate the device traffic (see RP_PLL.TransportStatistics), 0 to disable
+WIRE_TRACE_FILENAME = None # set to a filename to record all the traffic with the device, which can then be replayed offline (see WireTrace.py)
 
 #sys._excepthook = sys.excepthook
 #def exception_hook(exctype, value, traceback):
@@ -61,6 +64,12 @@ class controller(object):
 
 		# Create the object that handles the communication with the FPGA board:
 		self.sl = SuperLaserLand_JD_RP(self)
+		# Worker thread for device accesses that should not block the GUI thread:
+		self.device_io = DeviceIOThread(self.sl, self)
+		if TRANSPORT_STATISTICS_PERIOD > 0:
+			self.sl.dev.statistics.startPeriodicDump(TRANSPORT_STATISTICS_PERIOD)
+		if WIRE_TRACE_FILENAME is not None:
+			self.sl.dev.startRecording(WIRE_TRACE_FILENAME)
 		self.updateDeviceData()
 
 		self.sp = SLLSystemParameters()
@@ -401,6 +410,9 @@ class controller(object):
 
 		self.loadDefaultValueFromConfigFile(strSelectedSerial, False) #read xml file to update some values. False means not updating the FPGA
 
+		# read all the settings in a single round-trip, the windows then get them from the cache
+		self.sl.warm_up_RAM_dpll_wrapper_cache()
+
 		target_windows = [
 			self.xem_gui_mainwindow2,
 			self.xem_gui_mainwindow,
@@ -452,6 +464,8 @@ class controller(object):
 			self.timerReconnect = None
 
 		self.sl.dev.CloseTCPConnection()
+		# without waiting: we can be called on a socket error, by a thread which holds the device's lock
+		self.sl.dither_sampler.stop(bWait=False)
 
 		try:
 			self.xem_gui_mainwindow2.killTimers()
@@ -9,6 +9,7 @@ from PyQt5 import QtGui, Qt
 #import PyQt5.Qwt5 as Qwt
 import numpy as np
 import math
+import collections
 from scipy.signal import lfilter
 from scipy.signal import decimate
 from scipy.signal import detrend
@@ -38,7 +39,9 @@ import traceback
 import pyqtgraph as pg
 
 import RP_PLL # for CommsError
+from LoggerArbiter import LoggerBusyError, PRIORITY_NORMAL, PRIORITY_DISPLAY
 from SocketErrorLogger import logCommsErrorsAndBreakoutOfFunction
+from DeviceIOThread import FunctionCallRequest, InterruptibleCallRequest, submit_request
 
 import logging
 
@@ -112,6 +115,8 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 	display_phase = 0 # used to refresh the phase noise plot only once every N refresh cycles
 	VCO_detected_gain_in_Hz_per_Volts = [1, 1, 1]
 	bFirstTimeLockCheckBoxClicked = True
+	CAPTURE_FRAME_TIMEOUT = 1.  # in seconds, longest wait for a frame of the capture pipeline
+	SHARED_DATA_AGE_FRACTION = 0.8  # see getSharedDataMaxAge()
 		
 #    def __init__(self):
 #        super(XEM_GUI_MainWindow, self).__init__()
@@ -138,6 +143,16 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 
 		self.timerIDDither = None
 		self.timerID = 0
+		# streams of sl.capture_pipeline used while the display refreshes continuously, see getPipelinedADCdata()
+		self.capture_streams = {}
+		# our last read of the device state through the I/O thread, see timerEvent()
+		self.state_read = None
+		# same for the long DDC captures, see displayDDC()
+		self.long_ddc_read = None
+		self.refresh_period = 0.    # in seconds, while the display refreshes continuously
+		# last DAC current values read from the registers, see averageDACCurrent()
+		self.dac_current_history = [collections.deque(maxlen=1) for k in range(3)]
+		self.dac_current_snapshot_number = [None]*3
 
 		# For the crash monitor
 		self.crash_number = 0
@@ -380,6 +395,7 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 #            print('Timer delay = %d ms' % timer_delay)
 			if self.timerID != 0:
 				self.killTimer(self.timerID)
+			self.refresh_period = 1e-3*timer_delay
 			self.timerID = self.startTimer(int(round(timer_delay)))
 			self.timerEvent(0)  # run the event handler once right away, makes the checkbox feel more responsive
 #            print('Starting timer')
@@ -390,6 +406,7 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 				self.killTimer(self.timerID)
 				self.timerID = 0
 #                print('Stopping timer')
+			self.closeCaptureStreams()
 			
 	def exportData(self):
 		# First need to create a unique file name template (with good probability)
@@ -445,10 +462,6 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 		
 		start_time = time.perf_counter()
 		print('Grabbing and exporting data')
-		# Check if another function is currently using the DDR2 logger:
-		if self.sl.bDDR2InUse:
-			print('grabAndExportData(): DDR2 logger in use, cannot get data from adc')
-			return
 			
 		# Ask which input to use:
 		currentSelector, ok = QtGui.QInputDialog.getItem(self, 'Raw data export', 
@@ -459,12 +472,16 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 			
 		# Ask how many points:
 		N_points_str, ok = QtGui.QInputDialog.getText(self, 'Raw data export', 
-			'Enter the number of points desired [1, 32768]:', Qt.QLineEdit.Normal, '32768')
+			'Enter the number of points desired [1, 1e6]\n(more than 32768 points are captured in several blocks, with dead time between them):', Qt.QLineEdit.Normal, '32768')
 		if not ok:
 			return
 			
-		# Block access to the DDR2 Logger to any other function until we are done:
-		self.sl.bDDR2InUse = True
+		# Wait for our turn on the DDR2 logger, and block access to any other function until we are done:
+		try:
+			lease = self.sl.logger_arbiter.acquire('%s: grabAndExportData' % self.strTitle, PRIORITY_NORMAL)
+		except LoggerBusyError as e:
+			print('grabAndExportData(): %s, cannot get data from adc' % e)
+			return
 
 		try:
 			N_points = int(float(N_points_str))
@@ -474,10 +491,13 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 		if N_points < 64:
 			N_points = 64
 	
+		N_points = int(min(N_points, 1e6))
+	
 		try:
 			# Read from selected source
 			print("currentSelector = %s" % currentSelector)
-			self.sl.setup_write(self.sl.LOGGER_MUX[currentSelector], N_points)
+			if N_points <= self.sl.dev.MAX_SAMPLES_READ_BUFFER:
+				self.sl.setup_write(self.sl.LOGGER_MUX[currentSelector], N_points)
 			
 			##################################################
 			# Synchronize trigger as best as possible to the next multiple of time_quantum seconds:
@@ -491,20 +511,33 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 					time.sleep(1e-3)
 					time_now = time.time()
 				
-			self.sl.trigger_write()
-			if bSyncReadOnNextTimeQuantization:
-				print('time_now = %f, time_target = %f' % (time_now, time_target))
-			self.sl.wait_for_write()
-			(samples_out, ref_exp0) = self.sl.read_adc_samples_from_DDR2()
-			samples_out = samples_out.astype(dtype=np.float)/2**15
+			if N_points > self.sl.dev.MAX_SAMPLES_READ_BUFFER:
+				# more points than the logger holds: several captures, the first one is triggered right away.
+				# They are converted to float as they arrive, which avoids a second copy of all the samples
+				(samples_out, dead_times, spectrum, stats) = self.sl.capture_long(self.sl.LOGGER_MUX[currentSelector], N_points, out=np.empty(N_points, dtype=np.float64))
+				if stats is None:
+					# the first capture came back empty: nothing to export
+					print('grabAndExportData(): no samples received, nothing exported')
+					return
+				(mean, variance) = stats
+				samples_out /= 2**15
+				print('Dead time between captures: %d gaps, total = %f s' % (len(dead_times), np.sum(dead_times)))
+				print('Mean = %f, std dev = %f (fraction of full scale)' % (mean/2**15, np.sqrt(variance)/2**15))
+			else:
+				self.sl.trigger_write()
+				if bSyncReadOnNextTimeQuantization:
+					print('time_now = %f, time_target = %f' % (time_now, time_target))
+				self.sl.wait_for_write()
+				(samples_out, ref_exp0) = self.sl.read_adc_samples_from_DDR2()
+				samples_out = samples_out.astype(dtype=np.float)/2**15
 		except:
 			# ADC read failed.
 			print('Unhandled exception in ADC read')
 #            del self.sl
 #            raise
-			
-		# Signal to other functions that they can use the DDR2 logger
-		self.sl.bDDR2InUse = False
+		finally:
+			# Signal to other functions that they can use the DDR2 logger
+			lease.release()
 		
 		print('Elapsed time (Comm) = %f' % (time.perf_counter()-start_time))
 		start_time = time.perf_counter()
@@ -1284,19 +1317,16 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 						self.qlabel_detected_vco_gain[k].setStyleSheet("color: white; background-color: black")
 					
 				else:
-					samples = self.sl.ditherRead(2, k)
-					# There is an implicit (-) sign because the DDC has to shift the frequency to 0.
-					# This means that the detected gain will be positive when the VCO sign checkbox is correctly tuned
-					samples = -samples
-					samples = np.mean(samples)
-					# np.mean() returns a numpy.float, but the conversions functions expect an ndarray
-					samples = np.ndarray((1,), dtype=np.float, buffer=samples)
-
-					# TODO: fancier things with the real and imaginary part, to try to detect invalid readings?  Is this necessary?
-					# TODO: Compare many different readings to try to sort out any incorrect ones?
-					VCO_detected_gain_in_Hz_per_Volts = self.sl.scaleDitherResultsToHzPerVolts(samples, k)
+					# the lock-in results are read in the background, see DitherSampler.py: this never waits for the device
+					(VCO_detected_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers) = self.sl.dither_sampler.getVCOGainEstimate(k)
+					if VCO_detected_gain_in_Hz_per_Volts is None:
+						# no result yet since the dither was enabled or its settings changed
+						self.qlabel_detected_vco_gain[k].setText('...')
+						self.qlabel_detected_vco_gain[k].setStyleSheet("color: white; background-color: black")
+						continue
 					self.VCO_detected_gain_in_Hz_per_Volts[k] = VCO_detected_gain_in_Hz_per_Volts
 					self.qlabel_detected_vco_gain[k].setText('%.1e' % VCO_detected_gain_in_Hz_per_Volts)
+					self.qlabel_detected_vco_gain[k].setToolTip('%.2e +/- %.1e Hz/V (95 %% confidence)\nfrom %d lock-in results, %d outliers rejected' % (VCO_detected_gain_in_Hz_per_Volts, confidence_interval, N_results, N_outliers))
 					elapsed_time = time.perf_counter() - start_time
 	#                print('Elapsed time (timerDitherEvent) = %f ms' % (1000*elapsed_time))
 					
@@ -1315,13 +1345,28 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 
 		# Check if the sl object exists: otherwise this timer will keep throwing exceptions, filling up the console messages
 		# and preventing us form seeing the real cause.  We let only one exception go through and then disable 
+		try:
+			if self.state_read is not None and not self.state_read.done():
+				# the I/O thread hasn't got to our previous read yet
+				return
+
+			# Handle the LEDs display. The device state is read by the I/O thread (see DeviceIOThread.py), then refreshDisplays() gets called back
+			# on our thread, and the displays find the same snapshot in sl.state_hub
+			self.state_read = submit_request(self.sl, FunctionCallRequest(self.sl.readLEDs, max_age=self.getSharedDataMaxAge()), callback=self.refreshDisplays, priority=PRIORITY_DISPLAY, owner=self)
+		except:
+			print('SL object does not exist anymore. disabling timer in timerEvent')
+			self.killTimer(self.timerID)
+			self.timerID = 0
+			self.qchk_refresh.setChecked(False)
+			raise
+
+	@logCommsErrorsAndBreakoutOfFunction()
+	def refreshDisplays(self, ret):
 		try:
 			# Read out residuals and dump to disk:
 			if self.selected_ADC == 0:
 				pass
 					
-			# Handle the LEDs display
-			ret = self.sl.readLEDs()
 			if ret is not None:
 				(LED_G0, LED_R0, LED_G1, LED_R1, LED_G2, LED_R2) = ret
 				# print ('%d, %d, %d, %d, %d, %d' % (LED_G0, LED_R0, LED_G1, LED_R1, LED_G2, LED_R2))
@@ -1398,7 +1443,7 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 				self.display_phase = 0
 			
 		except:
-			print('SL object does not exist anymore. disabling timer in timerEvent')
+			print('SL object does not exist anymore. disabling timer in refreshDisplays')
 			self.killTimer(self.timerID)
 			self.timerID = 0
 			self.qchk_refresh.setChecked(False)
@@ -1410,31 +1455,41 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 	# timerEvent()
 	def displayDAC(self):
 		
-		# Check if another function is currently using the DDR2 logger:
-		if self.sl.bDDR2InUse:
-			print('displayDAC(): DDR2 logger in use, cannot get data from dac')
-			return  
-		
-		# For now: we grab the smallest chunk of points from the output (so as to not use too much time to refresh)
-		# and display the current average:
+		# The DAC current values are read from their registers, along with the rest of the device state (see DeviceStateHub.py),
+		# and averaged over the last few refreshes. In waveform mode, we instead grab the smallest chunk of points from the output
+		# with the logger (so as to not use too much time to refresh) and display its average:
+		bWaveformMode = self.spectrum.qchk_dac_waveform.isChecked()
+		if bWaveformMode:
+			snapshot = None
+		else:
+			snapshot = self.sl.state_hub.getSnapshot(max_age=self.getSharedDataMaxAge())
+			self.closeCaptureStreams(['DAC%d' % k for k in range(3)])
 		for k in range(3):
 			if self.output_controls[k]:
 				# Read from DAC #k
 				start_time = time.perf_counter()
 			
-				(samples_out, ref_exp0) = self.getADCdata(input_select="DAC%d" % k, N_samples=256)
-				if samples_out is None:
-					return
+				if bWaveformMode:
+					if self.qchk_refresh.isChecked():
+						(samples_out, ref_exp0) = self.getPipelinedADCdata("DAC%d" % k, input_select="DAC%d" % k, N_samples=256)
+					else:
+						(samples_out, ref_exp0) = self.getADCdata(input_select="DAC%d" % k, N_samples=256)
+					if samples_out is None:
+						return
+					samples_out = samples_out.astype(dtype=np.float)
+					# For the USB bug, compute the mean from the last points
+					current_output_in_counts = np.mean(samples_out[128:256])
+					self.dac_current_history[k].clear()
+				else:
+					current_output_in_counts = self.averageDACCurrent(k, snapshot)
 				elapsed_time = time.perf_counter() - start_time
 				if self.bDisplayTiming == True:
 					print('Elapsed time (read dac values) = %f ms' % (1000*elapsed_time))
-				samples_out = samples_out.astype(dtype=np.float)
 
 				VCO_gain_in_Hz_per_Volts = self.getVCOGainFromUI(k)
 					
 				# Update the display:           
-				# For the USB bug, compute the mean from the last points     
-				current_output_in_volts = self.sl.convertDACCountsToVolts(k, np.mean(samples_out[128:256]))
+				current_output_in_volts = self.sl.convertDACCountsToVolts(k, current_output_in_counts)
 				current_output_in_hz = current_output_in_volts * VCO_gain_in_Hz_per_Volts
 				self.spectrum.qthermo_dac_current[k].setValue(current_output_in_volts)
 				self.spectrum.qlabel_dac_current_value[k].setText('{:.4f} V\n{:.0f} MHz'.format(current_output_in_volts, current_output_in_hz/1e6))
@@ -1443,8 +1498,24 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 				if self.bDisplayTiming == True:
 					print('Elapsed time (displayDAC total) = %f ms' % (1000*elapsed_time))
 			
-
-	def displayDDC(self):
+	def averageDACCurrent(self, k, snapshot):
+		# mean of the current values of DAC #k over the last N snapshots, N from the UI
+		try:
+			N_average = max(1, int(float(self.spectrum.qedit_dac_averaging.text())))
+		except ValueError:
+			N_average = 1
+		history = self.dac_current_history[k]
+		if history.maxlen != N_average:
+			history = collections.deque(history, maxlen=N_average)
+			self.dac_current_history[k] = history
+		# a snapshot shared with the other windows can come back at our next refresh: only count it once
+		if snapshot.snapshot_number != self.dac_current_snapshot_number[k]:
+			history.append(snapshot.dac_currents[k])
+			self.dac_current_snapshot_number[k] = snapshot.snapshot_number
+		return np.mean(history)
+
+	def displayDDC(self, long_ddc_data=None):
+		# long_ddc_data is the result of getLongDDCdata(), see displayLongDDCdata()
 		# self.bDisplayTiming = True
 		
 		# Read from DDC0
@@ -1470,51 +1541,77 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 			# start_time = time.perf_counter()
 			# inst_freq = self.sl.read_ddc_samples_from_DDR2()
 
-			inst_freq = self.getADCdata(input_select='DDC%d' % self.selected_ADC, N_samples=N_points, bReadAsDDC=True)
-			if inst_freq is None:
-				return
+			if N_points > self.sl.dev.MAX_SAMPLES_READ_BUFFER:
+				# more points than the logger holds: the spectrum is averaged over several captures, see getLongDDCdata()
+				N_fft = self.sl.dev.MAX_SAMPLES_READ_BUFFER//2
+				if long_ddc_data is None:
+					# the captures take several refresh periods: they are made by the I/O thread (see DeviceIOThread.py), and we are called back
+					# with the result. We don't queue more of them in the meantime
+					if self.long_ddc_read is None or self.long_ddc_read.done():
+						self.long_ddc_read = submit_request(self.sl, InterruptibleCallRequest(self.getLongDDCdata, input_select='DDC%d' % self.selected_ADC, N_samples=N_points, N_fft=N_fft),
+							callback=self.displayLongDDCdata, priority=PRIORITY_DISPLAY, owner=self)
+					return
+				# only the statistics of the samples are captured, not the samples themselves
+				((mean_freq, variance_freq), spc) = long_ddc_data
+				inst_freq = None
+				self.inst_freq = None
+				self.qlbl_mean_freq_error.setText('Freq error: %.2f MHz' % (mean_freq/1e6))
+
+				# same layout as the single capture's spectrum below
+				fs_new = self.sl.fs
+				frequency_axis = np.arange(N_fft)/float(N_fft)*fs_new
+				last_index_shown = N_fft//2
+				window_NEB = 1.5*fs_new/N_fft   # Hann window, used by welch()
+				spc = np.concatenate((spc, np.zeros(N_fft - len(spc))))
+			else:
+				if self.qchk_refresh.isChecked():
+					inst_freq = self.getPipelinedADCdata('DDC', input_select='DDC%d' % self.selected_ADC, N_samples=N_points, bReadAsDDC=True)
+				else:
+					inst_freq = self.getADCdata(input_select='DDC%d' % self.selected_ADC, N_samples=N_points, bReadAsDDC=True)
+				if inst_freq is None:
+					return
 
-			self.inst_freq = inst_freq
+				self.inst_freq = inst_freq
 			
-			if self.bDisplayTiming == True:
-				print('Elapsed time (communication) = %f' % (time.perf_counter()-start_time))
+				if self.bDisplayTiming == True:
+					print('Elapsed time (communication) = %f' % (time.perf_counter()-start_time))
 
 			
 #            print('mean freq error = %f MHz, raw code = %f' % (np.mean(inst_freq)/1e6, np.mean(inst_freq)*2**10 / self.sl.fs*4))
-			self.qlbl_mean_freq_error.setText('Freq error: %.2f MHz' % (np.mean(inst_freq)/1e6))
+				self.qlbl_mean_freq_error.setText('Freq error: %.2f MHz' % (np.mean(inst_freq)/1e6))
 			
-			# Compute the spectrum:
-			# We first perform decimation on the data since we don't have useful information above the cut-off frequency anyway:
-			start_time = time.perf_counter()
-			N_decimation = 10
-			fs_new = self.sl.fs/N_decimation
-			#inst_freq_decimated = decimate(inst_freq, N_decimation, zero_phase=False)
-			inst_freq_decimated = decimate(detrend(inst_freq), N_decimation, zero_phase=False)
+				# Compute the spectrum:
+				# We first perform decimation on the data since we don't have useful information above the cut-off frequency anyway:
+				start_time = time.perf_counter()
+				N_decimation = 10
+				fs_new = self.sl.fs/N_decimation
+				#inst_freq_decimated = decimate(inst_freq, N_decimation, zero_phase=False)
+				inst_freq_decimated = decimate(detrend(inst_freq), N_decimation, zero_phase=False)
 			
 #            inst_freq_decimated = inst_freq
 #            fs_new = self.sl.fs
 			
-			# For debugging: we want to check
+				# For debugging: we want to check
 #            inst_freq_decimated = np.random.randn(100e3)
 #            print('Data std dev = %f Hz' % np.std(inst_freq_decimated))
 #            print('Data variance = %f Hz^2' % np.var(inst_freq_decimated))
-			if self.bDisplayTiming == True:
-				print('Elapsed time (decimation) = %f' % (time.perf_counter()-start_time))
-			start_time = time.perf_counter()
+				if self.bDisplayTiming == True:
+					print('Elapsed time (decimation) = %f' % (time.perf_counter()-start_time))
+				start_time = time.perf_counter()
 			
-			# Compute the spectrum of the decimated signal:
-			start_time = time.perf_counter()
-			N_fft = 2**(int(np.ceil(np.log2(len(inst_freq_decimated)))))
-			frequency_axis = np.linspace(0, (N_fft-1)/float(N_fft)*fs_new, N_fft)
-			last_index_shown = int(np.round(len(frequency_axis)/2))
-			window_function = np.blackman(len(inst_freq_decimated))
-			window_NEB = np.sum((window_function/np.sum(window_function))**2) * fs_new;
+				# Compute the spectrum of the decimated signal:
+				start_time = time.perf_counter()
+				N_fft = 2**(int(np.ceil(np.log2(len(inst_freq_decimated)))))
+				frequency_axis = np.linspace(0, (N_fft-1)/float(N_fft)*fs_new, N_fft)
+				last_index_shown = int(np.round(len(frequency_axis)/2))
+				window_function = np.blackman(len(inst_freq_decimated))
+				window_NEB = np.sum((window_function/np.sum(window_function))**2) * fs_new;
 #            print('window_NEB = %f Hz' % window_NEB)
 			
-			spc = np.fft.fft(inst_freq_decimated * window_function, N_fft)
-			spc = np.real(spc*np.conj(spc))/(sum(window_function)**2) # Spectrum is now scaled in power (Hz^2 per bin)
-			# Scale the spectrum to be a single-sided power spectral density in Hz^2/Hz:
-			spc[1:last_index_shown] = 2*spc[1:last_index_shown] / window_NEB
+				spc = np.fft.fft(inst_freq_decimated * window_function, N_fft)
+				spc = np.real(spc*np.conj(spc))/(sum(window_function)**2) # Spectrum is now scaled in power (Hz^2 per bin)
+				# Scale the spectrum to be a single-sided power spectral density in Hz^2/Hz:
+				spc[1:last_index_shown] = 2*spc[1:last_index_shown] / window_NEB
 
 #            # Compute the running average:
 			# Compute spectrum averaging with exponential smoothing (simple first-order IIR filter)
@@ -1592,7 +1689,11 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 				self.curve_DDC0_cumul_phase.setVisible(False)
 			elif self.qcombo_ddc_plot.currentIndex() == 1:
 				# Compute the phase noise time-domain standard deviation:
-				phasenoise_stddev = np.std(np.cumsum(inst_freq*2*np.pi/self.sl.fs))
+				if inst_freq is not None:
+					phasenoise_stddev = np.std(np.cumsum(inst_freq*2*np.pi/self.sl.fs))
+				else:
+					# the long captures don't keep the samples: integrate the phase noise PSD over the displayed band instead
+					phasenoise_stddev = np.sqrt(np.sum(spc[1:last_index_shown]/frequency_axis[1:last_index_shown]**2) * (frequency_axis[1]-frequency_axis[0]))
 				# Display the phase noise (equal to 1/f^2 times the frequency noise PSD)
 				self.curve_DDC0_spc.setData(frequency_axis[1:last_index_shown], 10*np.log10(spc[1:last_index_shown] + 1e-20) - 20*np.log10(frequency_axis[1:last_index_shown]))
 				if self.bAveragePhaseNoise:
@@ -1720,7 +1821,11 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 		# print("input_select = %s" % input_select)
 		# Grab data from the FPGA:
 		start_time = time.perf_counter()
-		(samples_out, ref_exp0) = self.getADCdata(input_select, N_samples)
+		if self.qchk_refresh.isChecked():
+			# the next capture is made while we process and plot this one
+			(samples_out, ref_exp0) = self.getPipelinedADCdata('ADC', input_select, N_samples)
+		else:
+			(samples_out, ref_exp0) = self.getADCdata(input_select, N_samples)
 		if (samples_out is None) or (ref_exp0 is None):
 			return
 		self.raw_adc_samples = samples_out.astype(dtype=np.float)
@@ -1731,6 +1836,119 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 		self.spectrum.updateScaleDisplays(samples_out)
 
 
+	def displayLongDDCdata(self, long_ddc_data):
+		if long_ddc_data is None:
+			# the read failed, see getLongDDCdata()
+			return
+		self.displayDDC(long_ddc_data)
+
+	def getLongDDCdata(self, input_select, N_samples, N_fft, between_chunks=None):
+		# same as getADCdata(bReadAsDDC=True), for more samples than the logger holds: see capture_long().
+		# between_chunks is called between the captures, see DeviceIOThread.InterruptibleCallRequest
+		# The samples are not kept, only their statistics, so that the memory used doesn't grow with N_samples.
+		# returns ((mean, variance), spc): the mean in Hz and variance in Hz^2 of the instantaneous frequency,
+		# spc being the one-sided frequency noise PSD in Hz^2/Hz, averaged over segments of N_fft samples, or None if the read failed
+		start_time = time.perf_counter()
+		
+		# Wait for our turn on the DDR2 logger, and block access to any other function until we are done:
+		try:
+			lease = self.sl.logger_arbiter.acquire('%s: getLongDDCdata' % self.strTitle, PRIORITY_DISPLAY)
+		except LoggerBusyError as e:
+			print('getLongDDCdata(): %s, cannot get data from ddc' % e)
+			return None
+
+		try:
+			(samples_out, dead_times, spectrum, stats) = self.sl.capture_long(input_select, N_samples, out=False, nperseg=N_fft, between_blocks=between_chunks)
+
+		except RP_PLL.CommsLoggeableError as e:
+			# log exception
+			logging.error("Exception occurred", exc_info=True)
+			return None
+
+		except RP_PLL.CommsError as e:
+			# do not log exception (because it's simply an obvious follow-up to a previous one, and we don't want to fill up the log with repeated information)
+			return None
+
+		finally:
+			# Tear-down, whether or not an exception occured: Signal to other functions that they can use the DDR2 logger
+			lease.release()
+		
+		if self.bDisplayTiming == True:
+			print('Elapsed time (Comm) = %f, dead time between captures = %f' % (time.perf_counter()-start_time, np.sum(dead_times)))
+
+		if spectrum is None or stats is None:
+			# the first capture came back empty, or too short for a single segment of N_fft samples
+			print('getLongDDCdata(): not enough samples received, no spectrum to display')
+			return None
+		(frequency_axis, spc) = spectrum
+		(mean, variance) = stats
+
+		# same scaling as read_ddc_samples_from_DDR2()
+		counts_to_Hz = 1./2**10 * self.sl.fs/4
+		spc = spc * counts_to_Hz**2
+		return ((mean * counts_to_Hz, variance * counts_to_Hz**2), spc)
+
+	def getPipelinedADCdata(self, stream_name, input_select, N_samples, bReadAsDDC=False):
+		# same results as getADCdata(), but the captures are made in advance by sl.capture_pipeline (see CapturePipeline.py),
+		# so the device captures the next frame while we process this one. The stream is restarted when the settings change.
+		if bReadAsDDC:
+			empty_return_value = None
+		else:
+			empty_return_value = (None, None)
+		start_time = time.perf_counter()
+
+		stream = self.capture_streams.get(stream_name)
+		if stream is not None and (stream.input_select, stream.N_samples, stream.bReadAsDDC) != (input_select, int(N_samples), bReadAsDDC):
+			stream.close()
+			stream = None
+		if stream is None:
+			stream = self.sl.capture_pipeline.addStream(input_select, N_samples, bReadAsDDC, owner='%s: %s display' % (self.strTitle, stream_name))
+			self.capture_streams[stream_name] = stream
+		# the other windows which display the same data get the same frames, see CapturePipeline.py
+		stream.max_age = self.getSharedDataMaxAge()
+
+		if self.sl.logger_arbiter.isHeldByCurrentThread():
+			# for example a system identification running from our event loop: no frame can come until it is done
+			return empty_return_value
+		frame = stream.takeFrame(timeout=self.CAPTURE_FRAME_TIMEOUT)
+		if frame is None:
+			# the capture failed (see CapturePipeline.run()), or the logger is busy with another function
+			return empty_return_value
+
+		if self.bDisplayTiming == True:
+			print('Elapsed time (Comm) = %f, frame age = %f' % (time.perf_counter()-start_time, time.perf_counter()-frame.read_time))
+
+		if bReadAsDDC:
+			return frame.samples
+
+		# the frame's samples are only valid until the next frame is taken
+		samples_out = frame.samples.astype(dtype=np.float)
+		self.raw_adc_samples = samples_out
+		ref_exp0 = frame.ref_exp0
+
+		# A little bit of data validation:
+		if input_select in ['ADC0', 'ADC1']:
+			if np.real(ref_exp0) == 0 and np.imag(ref_exp0) == 0:
+				print('getPipelinedADCdata(): Invalid complex exponential. Probably because of a version mismatch between the RP firmware and Python GUI.')
+				return empty_return_value
+		else:
+			ref_exp0 = 1.0
+		return (samples_out, ref_exp0)
+
+	def getSharedDataMaxAge(self):
+		# the data read by another window during the same refresh period is still fresh enough for us:
+		# this way, the device traffic doesn't grow with the number of windows
+		return self.SHARED_DATA_AGE_FRACTION*self.refresh_period
+
+	def closeCaptureStreams(self, stream_names=None):
+		# all of them by default
+		if stream_names is None:
+			stream_names = list(self.capture_streams.keys())
+		for stream_name in stream_names:
+			stream = self.capture_streams.pop(stream_name, None)
+			if stream is not None:
+				stream.close()
+
 	def getADCdata(self, input_select, N_samples, bReadAsDDC=False):
 		if bReadAsDDC:
 			empty_return_value = None
@@ -1738,12 +1956,12 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 			empty_return_value = (None, None)
 		start_time = time.perf_counter()
 		
-		# Check if another function is currently using the DDR2 logger:
-		if self.sl.bDDR2InUse:
-			print('grabAndDisplayADC(): DDR2 logger in use, cannot get data from adc')
+		# Wait for our turn on the DDR2 logger, and block access to any other function until we are done:
+		try:
+			lease = self.sl.logger_arbiter.acquire('%s: getADCdata' % self.strTitle, PRIORITY_DISPLAY)
+		except LoggerBusyError as e:
+			print('getADCdata(): %s, cannot get data from %s' % (e, input_select))
 			return empty_return_value
-		# Block access to the DDR2 Logger to any other function until we are done:
-		self.sl.bDDR2InUse = True
 
 		time_start = time.perf_counter()
 		try:
@@ -1776,7 +1994,7 @@ class XEM_GUI_MainWindow(QtGui.QWidget):
 
 		finally:
 			# Tear-down, whether or not an exception occured: Signal to other functions that they can use the DDR2 logger
-			self.sl.bDDR2InUse = False
+			lease.release()
 		
 		if self.bDisplayTiming == True:
 			print('Elapsed time (Comm) = %f' % (time.perf_counter()-start_time))
@@ -635,15 +635,25 @@ def test_displayDDC_withException():
         assert(gui_mainwindow.sl.bDDR2InUse == False)
 
 
-def inner_test_displayDAC(sl, gui_mainwindow, bCheckValues=True):
-    if gui_mainwindow.output_controls[0] == True:
-        gui_mainwindow.sl.random_seed = 0
-        expected_dacs = [326e-6+1e-4, 0, 0]
-        expected_labels = ["0.0004 V\n0 MHz", "", ""]
+def inner_test_displayDAC(sl, gui_mainwindow, bCheckValues=True, bWaveformMode=False):
+    gui_mainwindow.spectrum.qchk_dac_waveform.setChecked(bWaveformMode)
+    for k in range(3):
+        if gui_mainwindow.output_controls[k]:
+            gui_mainwindow.qedit_vco_gain[k].setText('1e9')
+    if bWaveformMode:
+        # average of a short logger capture, see SuperLaserLand_mock.read_adc_samples_from_DDR2()
+        if gui_mainwindow.output_controls[0] == True:
+            gui_mainwindow.sl.random_seed = 0
+            expected_dacs = [326e-6+1e-4, 0, 0]
+            expected_labels = ["0.0004 V\n0 MHz", "", ""]
+        else:
+            gui_mainwindow.sl.random_seed = 1
+            expected_dacs = [0, 460e-6+2e-4, 1.254e-3]
+            expected_labels = ["", "0.0007 V\n1 MHz", "0.0013 V\n1 MHz"]
     else:
-        gui_mainwindow.sl.random_seed = 1
-        expected_dacs = [0, 460e-6+2e-4, 1.254e-3]
-        expected_labels = ["", "0.0007 V\n1 MHz", "0.0013 V\n1 MHz"]
+        # current values from the state hub, see SuperLaserLand_mock.dac_currents
+        expected_dacs = [0.1, 0.2, 1.]
+        expected_labels = ["0.1000 V\n100 MHz", "0.2000 V\n200 MHz", "1.0000 V\n1000 MHz"]
 
     gui_mainwindow.displayDAC()
 
@@ -666,6 +676,35 @@ def test_displayDAC():
     gui_mainwindow = XEM_GUI_MainWindow(sl, 'Testing window', 0, (False, True, True), sp, '', '')
     inner_test_displayDAC(sl, gui_mainwindow)
 
+def test_displayDAC_waveform():
+    (app, sp, sl) = initGuiObjects()
+    gui_mainwindow = XEM_GUI_MainWindow(sl, 'Testing window', 0, (True, False, False), sp, '', '')
+    gui_mainwindow.qchk_refresh.setChecked(False)
+    inner_test_displayDAC(sl, gui_mainwindow, bWaveformMode=True)
+
+    gui_mainwindow = XEM_GUI_MainWindow(sl, 'Testing window', 0, (False, True, True), sp, '', '')
+    gui_mainwindow.qchk_refresh.setChecked(False)
+    inner_test_displayDAC(sl, gui_mainwindow, bWaveformMode=True)
+
+def test_averageDACCurrent():
+    (app, sp, sl) = initGuiObjects()
+    gui_mainwindow = XEM_GUI_MainWindow(sl, 'Testing window', 0, (True, False, False), sp, '', '')
+    gui_mainwindow.spectrum.qedit_dac_averaging.setText('3')
+    for dac0 in [100, 200, 300, 400]:
+        sl.dac_currents[0] = dac0
+        snapshot = sl.state_hub.getSnapshot()
+        average = gui_mainwindow.averageDACCurrent(0, snapshot)
+    # the mean of the last 3 snapshots
+    assert(close_enough(average, 300.))
+    # a snapshot shared with the other windows is only counted once
+    assert(close_enough(gui_mainwindow.averageDACCurrent(0, snapshot), 300.))
+    # the history is shortened along with the setting
+    gui_mainwindow.spectrum.qedit_dac_averaging.setText('1')
+    assert(close_enough(gui_mainwindow.averageDACCurrent(0, snapshot), 400.))
+    # an invalid setting means no averaging
+    gui_mainwindow.spectrum.qedit_dac_averaging.setText('abc')
+    assert(close_enough(gui_mainwindow.averageDACCurrent(0, sl.state_hub.getSnapshot()), 400.))
+
 # @pytest.mark.skip(reason="not fixed yet")
 def test_displayDAC_withException():
     (app, sp, sl) = initGuiObjects()
@@ -372,7 +372,8 @@ class initialConfiguration(QtWidgets.QDialog):
 		self.logger.info('Red_Pitaya_GUI{}: Programming FPGA ({}) with new bitfile'.format(self.logger_name, self.strSelectedPort))
 
 		# connect to the selected RedPitaya, send new bitfile, then send programming command to the shell:
-		self.dev.OpenTCPConnection(self.strSelectedIP, self.strSelectedPort)
+		# (a single connection is enough here, and the socket is closed directly below)
+		self.dev.OpenTCPConnection(self.strSelectedIP, self.strSelectedPort, bOpenBulkChannel=False)
 		self.dev.write_file_on_remote(strFilenameLocal=str(self.qedit_firmware.text()), strFilenameRemote='/opt/red_pitaya_top.bit')
 		time.sleep(2) # to handle slow SD cards
 		print("File written to remote host at /opt/red_pitaya_top.bit.")
@@ -395,7 +396,7 @@ class initialConfiguration(QtWidgets.QDialog):
 		self.logger.info('Red_Pitaya_GUI{}: Programming CPU ({}) with new file'.format(self.logger_name, self.strSelectedPort))
 
 		# connect to the selected RedPitaya
-		self.dev.OpenTCPConnection(self.strSelectedIP, self.strSelectedPort)
+		self.dev.OpenTCPConnection(self.strSelectedIP, self.strSelectedPort, bOpenBulkChannel=False)
 		# send new monitor-tcp version
 		self.dev.write_file_on_remote(strFilenameLocal=self.qedit_software.text(), strFilenameRemote='/opt/monitor-tcp-new')
 		print("CPU software update sent. Rebooting server using new version")